@@ -0,0 +1,32 @@
+import re
+
+# PURL breaks when there is a ":" in the URL, so these prefixes are stripped from ids
+ID_PREFIXES = ['urn:uuid:', 'http://purl.org/nhmuio/id/']
+NHM_PURL_PREFIX = 'http://purl.org/nhmuio/id/'
+UUID_REGEX = '[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}'
+_uuid = re.compile(UUID_REGEX)
+_leading_uuid = re.compile('^(' + UUID_REGEX + ').+', re.DOTALL)
+
+
+def normalize_id(value):
+    """The form ids are stored and resolved in: lowercase, without urn:uuid: or purl prefixes"""
+    if value is None:
+        return None
+    value = value.lower()
+    for prefix in ID_PREFIXES:
+        value = value.replace(prefix, '')
+    return value
+
+
+def normalize_materialsampleid(value):
+    # Some NHM datasets have purl IDs in materialsampleid.
+    # Sometimes there are multiple UUIDs in one column, when one specimen is spread over several sheets. This is a mistake, but nothing can be done now. Just make the first one work.
+    if value is None:
+        return None
+    value = value.replace(NHM_PURL_PREFIX, '')
+    match = _leading_uuid.match(value)
+    return match.group(1) if match else value
+
+
+def contains_uuid(value):
+    return value is not None and _uuid.search(value) is not None
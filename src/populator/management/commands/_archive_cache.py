@@ -0,0 +1,136 @@
+from populator.management.commands import _gbif_api
+from datetime import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+
+
+class ArchiveCache:
+    """
+    Persistent on-disk cache of DwC-As, keyed by dataset key. For every archive the index keeps the ETag,
+    Last-Modified, size and sha256 of the stored file, so the next download can be a conditional request. An
+    archive is unchanged when the server answers 304, or sends the same bytes again, and the previous version
+    was imported successfully. The least recently used archives are evicted once the cache is over max_bytes.
+    """
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, cache_dir='/srv/archive_cache', max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+        self._unchanged = set()
+        self._in_use = set()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index = self._load_index()
+
+    def location(self, dataset_key):
+        return os.path.join(self.cache_dir, f'{dataset_key}.zip')
+
+    def fetch(self, dataset_key, url):
+        """Returns the location of the archive in the cache, or None if it could not be downloaded"""
+        logger = logging.getLogger(__name__)
+        zip_file_location = self.location(dataset_key)
+        with self._lock:
+            entry = dict(self._index.get(dataset_key, {}))
+            self._unchanged.discard(dataset_key)
+            self._in_use.add(dataset_key)
+        if not os.path.exists(zip_file_location):
+            entry = {}
+
+        part_location = zip_file_location + '.part'
+        response = _gbif_api.get_dwca_if_modified(url, part_location, entry.get('etag'), entry.get('last_modified'))
+        if not response:
+            self._remove(part_location)
+            with self._lock:
+                self._in_use.discard(dataset_key)
+            return None
+
+        if response.status_code == 304:
+            logger.info(f'archive for {dataset_key} not modified')
+            unchanged = True
+        else:
+            sha256 = file_sha256(part_location)
+            unchanged = sha256 == entry.get('sha256')
+            if unchanged:
+                logger.info(f'archive for {dataset_key} downloaded again with identical content')
+                self._remove(part_location)
+            else:
+                os.replace(part_location, zip_file_location)
+                entry = {'sha256': sha256, 'size': os.path.getsize(zip_file_location), 'imported': False}
+            entry['etag'] = response.headers.get('ETag')
+            entry['last_modified'] = response.headers.get('Last-Modified')
+
+        entry['last_used'] = datetime.now().isoformat()
+        with self._lock:
+            if unchanged and entry.get('imported'):
+                self._unchanged.add(dataset_key)
+            self._index[dataset_key] = entry
+            self._evict()
+            self._save_index()
+        return zip_file_location
+
+    def is_unchanged(self, dataset_key):
+        """True if the last fetch returned exactly the archive that was imported before"""
+        with self._lock:
+            return dataset_key in self._unchanged
+
+    def mark_imported(self, dataset_key):
+        with self._lock:
+            if dataset_key in self._index:
+                self._index[dataset_key]['imported'] = True
+                self._save_index()
+
+    def release(self, dataset_key, zip_file_location=None):
+        """Called once the archive has been imported, after which it may be evicted. Usable as a prefetcher discard"""
+        with self._lock:
+            self._in_use.discard(dataset_key)
+            self._evict()
+            self._save_index()
+
+    def size(self):
+        with self._lock:
+            return sum(entry['size'] for entry in self._index.values())
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        total = self.size()
+        by_last_use = sorted(self._index.items(), key=lambda item: item[1]['last_used'])
+        for dataset_key, entry in by_last_use:
+            if total <= self.max_bytes:
+                break
+            if dataset_key in self._in_use:
+                continue
+            logging.getLogger(__name__).info(f'evicting archive for {dataset_key} from the cache')
+            self._remove(self.location(dataset_key))
+            del self._index[dataset_key]
+            total -= entry['size']
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.cache_dir, self.INDEX_FILE)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_index(self):
+        index_location = os.path.join(self.cache_dir, self.INDEX_FILE)
+        with open(index_location + '.part', 'w') as f:
+            json.dump(self._index, f)
+        os.replace(index_location + '.part', index_location)
+
+    def _remove(self, location):
+        try:
+            os.remove(location)
+        except FileNotFoundError:
+            pass
+
+
+def file_sha256(location):
+    sha256 = hashlib.sha256()
+    with open(location, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
@@ -0,0 +1,44 @@
+from datetime import datetime
+import logging
+
+
+class AdaptiveBatchSize:
+    """
+    Batch size which is adjusted after every batch so that one batch takes about target_seconds. It changes by at most
+    a factor of two at a time, and stays between minimum and maximum.
+    """
+    def __init__(self, initial=50000, target_seconds=5, minimum=1000, maximum=1000000):
+        self.size = initial
+        self.target_seconds = target_seconds
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def record(self, rows, seconds):
+        if rows < self.size and seconds < self.target_seconds:
+            return  # A short final batch says nothing about how long a full one takes
+        factor = min(2, max(0.5, self.target_seconds / seconds)) if seconds > 0 else 2
+        self.size = int(min(self.maximum, max(self.minimum, self.size * factor)))
+
+
+def keyset_batches(run_batch, batch_size=None, label='batch', start_after=None):
+    """
+    Calls run_batch(last key, limit) until there are no rows left, and yields what each batch returns. run_batch handles
+    up to limit rows with a key greater than the last key (start_after for the first batch), in key order, and returns
+    (the last key it handled, number of rows handled, result). Each batch is logged with its rows/s.
+    """
+    logger = logging.getLogger(__name__)
+    batch_size = batch_size or AdaptiveBatchSize()
+    last_key = start_after
+    while True:
+        start = datetime.now()
+        limit = batch_size.size
+        batch_last_key, rows, result = run_batch(last_key, limit)
+        if not rows:
+            return
+        seconds = (datetime.now() - start).total_seconds()
+        logger.info(f'{label}: {rows} rows in {seconds:.2f}s, {rows / max(seconds, 0.001):.0f} rows/s, batch size {limit}')
+        batch_size.record(rows, seconds)
+        yield result
+        if rows < limit:
+            return
+        last_key = batch_last_key
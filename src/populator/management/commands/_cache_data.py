@@ -1,9 +1,19 @@
-from django.db import connection
+from django.db import connection, transaction
+import contextlib
+import functools
 import logging
+from website import tables
 from website.models import Dataset, ResolvableObject
-from populator.models import ResolvableObjectMigration
+from populator.models import DroppedIndex, ResolvableObjectMigration
+from populator.management.commands import _history, _statistics
+from populator.management.commands._batching import AdaptiveBatchSize, keyset_batches
 from datetime import date, datetime
 
+DATA_INDEX = 'website_res_data_00a3fa_gin'  # The GinIndex on ResolvableObject.data
+REBUILD_FRACTION = 0.1  # Share of the records changed by a merge above which rebuilding the GIN index beats updating it
+REBUILD_MAINTENANCE_WORK_MEM = '1GB'
+PENDING_LIST_LIMIT = 65536  # kB, gin_pending_list_limit while merging, the default is 4MB
+
 
 def sync_datasets(migration_dataset_ids):
     start = datetime.now()
@@ -12,52 +22,161 @@ def sync_datasets(migration_dataset_ids):
     log_time(start, ', '.join([x.id for x in deleted_datasets]))
     deleted_datasets.update(deleted_date=date.today())
     log_time(start, 'synced datasets')
-    ResolvableObject.objects.filter(dataset__id__in=[x.id for x in deleted_datasets]).update(deleted_date=date.today())
+    deleted_dataset_ids = [x.id for x in deleted_datasets]
+    ResolvableObject.objects.filter(dataset__id__in=deleted_dataset_ids).update(deleted_date=date.today())
+    _statistics.recount(deleted_dataset_ids)  # Datasets are rarely removed, so they are counted again
 
 
-def merge_in_new_data(skipped_datasets=[], reset=False, step=5000):
-    logger = logging.getLogger(__name__)
+def merge_in_new_data(reset=False, batch_size=None, start_after=None, checkpoint=None, dataset_ids=None, dataset_merged=None, bulk=False):
+    """
+    Merges the migration table into website_resolvableobject one dataset at a time, all of them if dataset_ids is None.
+    Each dataset is one pass over its migration records in id order, which records history and inserts, updates and
+    undeletes records in the same statement, followed by marking its records which were not imported as deleted.
+    start_after maps dataset ids to the id their pass carries on after. checkpoint(dataset id, last id) is called in the
+    same transaction as each batch, and dataset_merged(dataset id) in the same one as the deletions, so that a merge
+    which stopped can carry on from its last completed batch. Returns {dataset id: {'inserted': n, 'updated': n,
+    'deleted': n}}. bulk picks the cheapest way to keep the GIN index on data up to date for the size of the merge, see
+    data_index_strategy.
+    """
     # if reset:
     #     reset()
     #     return
+    datasets = datasets_to_merge(dataset_ids)
+    if not datasets:
+        log_time(datetime.now(), 'no datasets to merge')
+        return {}
+    _history.ensure_partitions()
+    start_after = start_after or {}
+    batch_size = batch_size or AdaptiveBatchSize(initial=5000)
+    counts = {}
+    # Without the index, because a merge which dropped it could not build it again, there is none to keep up to date
+    has_index = restore_data_index()
+    index_strategy = data_index_strategy(dataset_ids) if bulk and has_index else contextlib.nullcontext()
+    try:
+        with index_strategy:
+            for dataset_id in datasets:
+                start = datetime.now()
+                run_batch = functools.partial(merge_batch, dataset_id=dataset_id, checkpoint=checkpoint)
+                batches = list(keyset_batches(run_batch, batch_size, label=f'merge {dataset_id}', start_after=start_after.get(dataset_id)))
+                with transaction.atomic():
+                    deleted = add_deleted_timestamps_for_missing_records(dataset_id)
+                    if dataset_merged:
+                        dataset_merged(dataset_id)
+                counts[dataset_id] = {'inserted': sum(inserted for inserted, updated in batches),
+                                      'updated': sum(updated for inserted, updated in batches), 'deleted': deleted}
+                log_time(start, '{}: {inserted} inserted, {updated} updated, {deleted} deleted'.format(dataset_id, **counts[dataset_id]))
+    except Exception as e:
+        logger = logging.getLogger(__name__)
+        logger.error(f'merge failed, it can be resumed from its last completed batch: {e}')
+        raise
+    return counts
+
+
+def datasets_to_merge(dataset_ids=None):
+    if dataset_ids is None:
+        return list(Dataset.objects.order_by('id').values_list('id', flat=True))
+    return sorted(set(dataset_ids))
+
+
+@contextlib.contextmanager
+def data_index_strategy(dataset_ids=None):
+    """
+    Keeps the GIN index on data up to date in the cheapest way for the number of records a merge changes. When it
+    changes a large share of the table, the index is dropped for the merge and built again afterwards, concurrently and
+    with more memory. Otherwise the GIN pending lists are made larger, so new entries are added to the index in bulk
+    rather than one by one, and flushed into it after the merge.
+    """
+    start = datetime.now()
+    changed, total = count_changed_records(dataset_ids), estimate_record_count()
+    rebuild = changed > total * REBUILD_FRACTION
+    log_time(start, f'{changed} of about {total} records change, GIN index strategy: {"rebuild" if rebuild else "pending list"}')
+    if rebuild:
+        # Its definition is kept until it is built again, see restore_data_index
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('SELECT pg_get_indexdef(%s::regclass)', [DATA_INDEX])
+            definition = cursor.fetchone()[0]
+            DroppedIndex.objects.create(name=DATA_INDEX, table='website_resolvableobject', definition=definition)
+            cursor.execute(f'DROP INDEX {DATA_INDEX}')
+    else:
+        set_pending_list_limit(PENDING_LIST_LIMIT)
+    try:
+        yield
+    finally:
+        start = datetime.now()
+        if rebuild:
+            build_data_index(definition)
+        else:
+            set_pending_list_limit(None)
+            log_time(start, f'flushed the pending lists of {DATA_INDEX}')
+
+
+def build_data_index(definition):
     start = datetime.now()
     with connection.cursor() as cursor:
-        cursor.execute('select count(*) from populator_resolvableobjectmigration;')
-        count = cursor.fetchone()[0]
-    log_time(start, 'count complete')
+        cursor.execute(f"SET maintenance_work_mem = '{REBUILD_MAINTENANCE_WORK_MEM}'")
+        try:
+            tables.create_index_concurrently('website_resolvableobject', DATA_INDEX, definition)
+        finally:
+            cursor.execute('RESET maintenance_work_mem')
+    DroppedIndex.objects.filter(name=DATA_INDEX).delete()
+    log_time(start, f'rebuilt {DATA_INDEX}')
 
-    _max = step if count <= step else count + step
-    try:
-        for i in range(0, _max, step):
-            start = datetime.now()
-            log_time(start, 'starting on offset {} and step {}'.format(i, step))
-            create_temp_updated_table()
-            log_time(start, 'created temp updated table')
 
-            start = datetime.now()
-            populate_temp_updated_table(offset=i, limit=step)
-            log_time(start, 'populated temp updated table')
+def restore_data_index():
+    """
+    Builds the GIN index on data again if a merge which dropped it stopped before it was built, or if building it was
+    interrupted, which leaves invalid indexes behind that are dropped first. Returns whether the index is there.
+    """
+    dropped = DroppedIndex.objects.filter(name=DATA_INDEX).first()
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT indisvalid, pg_get_indexdef(indexrelid) FROM pg_index WHERE indexrelid = to_regclass(%s)', [DATA_INDEX])
+        index = cursor.fetchone()
+    if index and index[0]:
+        DroppedIndex.objects.filter(name=DATA_INDEX).delete()  # Built, but the merge stopped before it was forgotten
+        return True
+    if not dropped and not index:
+        logging.getLogger(__name__).error(f'{DATA_INDEX} is missing and its definition is not known, it has to be created by hand')
+        return False
+    definition = dropped.definition if dropped else index[1]
+    log_time(datetime.now(), f'{DATA_INDEX} was left {"invalid" if index else "dropped"} by a merge which stopped, building it again')
+    with transaction.atomic(), connection.cursor() as cursor:
+        DroppedIndex.objects.update_or_create(name=DATA_INDEX, defaults={'table': 'website_resolvableobject', 'definition': definition})
+        # Dropping the index on the partitioned table drops the partition indexes attached to it, the rest by their names
+        cursor.execute(f'DROP INDEX IF EXISTS {DATA_INDEX}')
+        for partition in tables.get_partitions('website_resolvableobject'):
+            cursor.execute(f'DROP INDEX IF EXISTS {partition}_{DATA_INDEX}')
+    build_data_index(definition)
+    return True
+
 
-            start = datetime.now()
-            insert_history()
-            log_time(start, 'inserted history')
+def count_changed_records(dataset_ids=None):
+    # Imported records which are new or have different data, found with the (id, data_hash) indexes of both tables
+    scope = 'AND new.dataset_id IN %(dataset_ids)s' if dataset_ids is not None else ''
+    with connection.cursor() as cursor:
+        cursor.execute(f"""SELECT count(*) FROM populator_resolvableobjectmigration AS new
+                           LEFT JOIN website_resolvableobject AS old ON old.id = new.id
+                           WHERE old.data_hash IS DISTINCT FROM new.data_hash {scope}""",
+                       {'dataset_ids': tuple(dataset_ids or [''])})
+        return cursor.fetchone()[0]
 
-            start = datetime.now()
-            update_website_resolvableobject()
-            log_time(start, 'updated pre existing records')
 
-        start = datetime.now()
-        log_time(start, 'adding new records starting now')
-        add_new_records()
-        log_time(start, 'added all new records')
+def estimate_record_count():
+    # From the planner statistics, tables which were never analyzed count as empty
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT COALESCE(sum(greatest(reltuples, 0)), 0)::bigint FROM pg_class WHERE oid::regclass::text = ANY(%s)',
+                       [tables.get_leaf_partitions('website_resolvableobject')])
+        return cursor.fetchone()[0]
 
-        start = datetime.now()
-        add_deleted_timestamps_for_missing_records(skipped_datasets)
-        log_time(start, 'added deleted dates')
-    except Exception as e:
-        logger = logging.getLogger(__name__)
-        logger.error(e)
-        import pdb; pdb.set_trace()
+
+def set_pending_list_limit(limit):
+    # Storage parameters are set on the index of each partition. None flushes the pending lists and resets the limit
+    with connection.cursor() as cursor:
+        for index in tables.get_leaf_partitions(DATA_INDEX):
+            if limit:
+                cursor.execute(f'ALTER INDEX {index} SET (fastupdate = on, gin_pending_list_limit = {limit})')
+            else:
+                cursor.execute('SELECT gin_clean_pending_list(%s::regclass)', [index])
+                cursor.execute(f'ALTER INDEX {index} RESET (fastupdate, gin_pending_list_limit)')
 
 
 def reset():
@@ -80,70 +199,91 @@ def log_time(start, message):
     logger.info('{}    - time taken - {}'.format(message, str(time_string)[:7]))
 
 
-def create_temp_updated_table():
-    with connection.cursor() as cursor:
-        cursor.execute("""DROP TABLE IF EXISTS temp_updated;
-                          CREATE TABLE temp_updated (id TEXT PRIMARY KEY, changed_data JSONB, data JSONB);""")
-
-
-def populate_temp_updated_table(limit, offset):
-    with connection.cursor() as cursor:
-        cursor.execute("""INSERT INTO temp_updated(id, changed_data, data)
-                          SELECT new.id as id, jsonb_diff_val(old.data, new.data) AS changed_data, new.data AS data
-                          FROM
-                            (SELECT * FROM populator_resolvableobjectmigration as new
-                            ORDER BY new.id LIMIT {} OFFSET {}) AS new
-                          INNER JOIN website_resolvableobject AS old
-                              ON new.id = old.id AND new.dataset_id = old.dataset_id
-                          WHERE jsonb_diff_val(old.data, new.data) != '{{}}'
-                          ORDER BY new.id;""".format(limit, offset))
-
-
-def insert_history():
-    # Exclude records where the only thing that changes is the modified date
-    with connection.cursor() as cursor:
-        cursor.execute("""INSERT INTO populator_history(resolvable_object_id, changed_data, changed_date)
-                          SELECT id, changed_data, CURRENT_DATE
-                          FROM temp_updated
-                          WHERE NOT (changed_data ?& array['modified'])""")
+def merge_batch(last_id, limit, dataset_id, checkpoint=None, history_only=False):
+    with transaction.atomic():
+        batch_last_id, rows, inserted, updated = upsert_batch(last_id, limit, dataset_id, history_only)
+        if checkpoint and rows:
+            checkpoint(dataset_id, batch_last_id)
+    return batch_last_id, rows, (inserted, updated)
 
 
-def update_website_resolvableobject():
+def upsert_batch(last_id, limit, dataset_id, history_only=False):
+    # Returns the last id in the batch, the number of migration rows in it and the numbers of records inserted and
+    # updated. Every part of the statement sees the table as it was before it, so history gets the data being replaced.
+    # Identical data never has a diff, so the diff is only worked out (once, OFFSET 0 stops it being inlined into the
+    # WHERE) for records whose data_hash differs. Changes to nothing but the modified date are not kept as history.
+    # A record is updated if its data changed or it had been deleted, ids which belong to another dataset are left alone.
+    # Upserted ids which were not in the table before the statement were inserted (xmax = 0 would tell the same, but
+    # system columns cannot be returned from a partitioned table). The record counts lose what updated records were
+    # counted as before and gain what upserted records are now
+    where = 'AND new.id > %(last_id)s' if last_id is not None else ''
+    upsert, counts = '', '0, 0'
+    if not history_only:
+        upsert = f'''
+        , upserted AS (
+            INSERT INTO website_resolvableobject AS old (id, data, type, dataset_id, created_date, parent)
+            SELECT id, data, type, dataset_id, CURRENT_DATE, parent FROM batch
+            ON CONFLICT (id) DO UPDATE SET data = EXCLUDED.data, deleted_date = NULL
+            WHERE old.dataset_id = EXCLUDED.dataset_id
+                AND (old.data_hash IS DISTINCT FROM EXCLUDED.data_hash OR old.data_hash IS NULL OR old.deleted_date IS NOT NULL)
+            RETURNING old.id, old.dataset_id, old.type, {_statistics.BASIS_OF_RECORD.format('old')} AS basisofrecord
+        ), counted AS (
+            SELECT upserted.*, before.id IS NULL AS inserted, {_statistics.BASIS_OF_RECORD.format('before')} AS old_basisofrecord,
+                   before.deleted_date IS NOT NULL AS was_deleted
+            FROM upserted LEFT JOIN website_resolvableobject AS before ON before.id = upserted.id
+        ), deltas AS (
+            SELECT dataset_id, type, basisofrecord, false AS deleted, 1 AS delta FROM counted
+            UNION ALL
+            SELECT dataset_id, type, old_basisofrecord, was_deleted, -1 FROM counted WHERE NOT inserted
+        ), record_counts AS (
+            {_statistics.add_deltas('deltas')}
+        )'''
+        counts = '(SELECT count(*) FILTER (WHERE inserted) FROM counted), (SELECT count(*) FILTER (WHERE NOT inserted) FROM counted)'
     with connection.cursor() as cursor:
-        cursor.execute("""UPDATE website_resolvableobject 
-                          SET data = temp_updated.data, deleted_date = NULL
-                          FROM temp_updated
-                          WHERE website_resolvableobject.id = temp_updated.id""")
+        cursor.execute(f"""WITH batch AS (
+                              SELECT new.id, new.data, new.type, new.dataset_id, new.parent, new.data_hash
+                              FROM populator_resolvableobjectmigration AS new
+                              WHERE new.dataset_id = %(dataset_id)s {where}
+                              ORDER BY new.id
+                              LIMIT %(limit)s
+                           ), history AS (
+                              INSERT INTO populator_history(resolvable_object_id, changed_data, changed_date)
+                              SELECT batch.id, diff.changed_data, CURRENT_DATE
+                              FROM batch
+                              INNER JOIN website_resolvableobject AS old
+                                  ON batch.id = old.id AND batch.dataset_id = old.dataset_id
+                              CROSS JOIN LATERAL (SELECT jsonb_diff_val(old.data, batch.data) AS changed_data OFFSET 0) AS diff
+                              WHERE (old.data_hash IS DISTINCT FROM batch.data_hash OR old.data_hash IS NULL)
+                                  AND diff.changed_data != '{{}}' AND NOT (diff.changed_data ?& array['modified'])
+                           ){upsert}
+                           SELECT (SELECT max(id) FROM batch), (SELECT count(*) FROM batch), {counts}""",
+                       {'dataset_id': dataset_id, 'last_id': last_id, 'limit': limit})
+        return cursor.fetchone()
 
 
-def add_new_records():
-    # Add new records as darwincoreobjects, may be faster to use https://stackoverflow.com/questions/19363481/select-rows-which-are-not-present-in-other-table
-    with connection.cursor() as cursor:
-        cursor.execute("""
-        INSERT INTO website_resolvableobject(id, data, type, dataset_id, created_date, parent)
-        SELECT new.id, new.data, new.type, new.dataset_id, CURRENT_DATE, new.parent
-        FROM populator_resolvableobjectmigration AS new
-        LEFT JOIN website_resolvableobject AS old ON new.id = old.id
-        WHERE old.id IS NULL
-        """)
-
-def add_deleted_timestamps_for_missing_records(skipped_datasets):
-    where_clause = 'AND old.dataset_id NOT IN %(dataset_ids)s' if skipped_datasets else ''
-    sql = f"""
-        UPDATE website_resolvableobject
-            SET deleted_date = CURRENT_DATE
-        WHERE id IN (
-            SELECT old.id
-            FROM website_resolvableobject AS old
-            LEFT JOIN populator_resolvableobjectmigration AS new ON new.id = old.id
-            WHERE 
-                new.id IS NULL 
-                AND old.deleted_date IS NULL 
-                {where_clause} 
-            )
-        """
+def add_deleted_timestamps_for_missing_records(dataset_id):
+    # Records of the dataset whose id was not imported this time, found with the dataset_id index and the primary key of
+    # the migration table. An id which another dataset imported first is not missing, the record keeps being published
+    # by its dataset. They move from the active to the deleted record counts
     with connection.cursor() as cursor:
-        cursor.execute(sql, { 'dataset_ids': tuple(skipped_datasets) })
+        cursor.execute(f"""WITH deleted AS (
+                               UPDATE website_resolvableobject AS old
+                               SET deleted_date = CURRENT_DATE
+                               WHERE old.dataset_id = %(dataset_id)s
+                                   AND old.deleted_date IS NULL
+                                   AND NOT EXISTS (SELECT FROM populator_resolvableobjectmigration AS new
+                                                   WHERE new.id = old.id)
+                               RETURNING old.dataset_id, old.type, {_statistics.BASIS_OF_RECORD.format('old')} AS basisofrecord
+                           ), deltas AS (
+                               SELECT dataset_id, type, basisofrecord, true AS deleted, 1 AS delta FROM deleted
+                               UNION ALL
+                               SELECT dataset_id, type, basisofrecord, false, -1 FROM deleted
+                           ), record_counts AS (
+                               {_statistics.add_deltas('deltas')}
+                           )
+                           SELECT count(*) FROM deleted""",
+                       {'dataset_id': dataset_id})
+        return cursor.fetchone()[0]
 
 # https://stackoverflow.com/questions/56733112/how-to-create-new-database-connection-in-django
 #connections.ensure_defaults('default')
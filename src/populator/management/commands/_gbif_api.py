@@ -1,17 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
 import requests
 import sys
 import traceback
 
 GBIF_API_DATASET_URL = "https://api.gbif.org/v1/dataset/{}"
+SEARCH_PAGE_SIZE = 1000  # The most the GBIF API returns per page
+MAX_CONCURRENT_REQUESTS = 8
+REQUEST_TIMEOUT = (10, 60)  # Seconds to connect, seconds to wait for data
+
+
+def create_session():
+    # Keep-alive connections shared by all threads, retrying with backoff when GBIF is overloaded or rate limits us
+    retry = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONCURRENT_REQUESTS, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+session = create_session()
 
 
 def get_dataset_list():
+    # Pages through all the results, a failure on any page means we do not have the full list
+    datasets = []
+    offset = 0
     try:
-        response = requests.get(GBIF_API_DATASET_URL.format('search?limit=5000&publishingCountry=NO'))
-        response.raise_for_status()
-        json = response.json()
-        return json['results']
+        while True:
+            params = {'limit': SEARCH_PAGE_SIZE, 'offset': offset, 'publishingCountry': 'NO'}
+            response = session.get(GBIF_API_DATASET_URL.format('search'), params=params, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            json = response.json()
+            datasets.extend(json['results'])
+            if json['endOfRecords'] or not json['results']:
+                return datasets
+            offset += len(json['results'])
     except requests.exceptions.RequestException as e:
         _log_error(e)
         return []
@@ -19,7 +46,7 @@ def get_dataset_list():
 
 def get_dataset_detailed_info(dataset_key):
     try:
-        response = requests.get(GBIF_API_DATASET_URL.format(dataset_key))
+        response = session.get(GBIF_API_DATASET_URL.format(dataset_key), timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
         json = response.json()
         return json
@@ -28,16 +55,22 @@ def get_dataset_detailed_info(dataset_key):
         return []
 
 
+def get_datasets_detailed_info(dataset_keys):
+    # Fetched concurrently, returned in the same order as dataset_keys
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        return list(executor.map(get_dataset_detailed_info, dataset_keys))
+
+
 def get_dwc_endpoint(endpoints):
     darwin_core_endpoints = [endpoint for endpoint in endpoints if endpoint['type'] == 'DWC_ARCHIVE']
     return next(iter(darwin_core_endpoints), False)
 
 
-def get_dwca_and_store_as_tmp_zip(url):
+def get_dwca_and_store_as_tmp_zip(url, file_location='/tmp/tmp.zip'):
     try:
         response = requests.get(url, stream=True)
         response.raise_for_status()
-        with open('/tmp/tmp.zip', 'wb') as fd:
+        with open(file_location, 'wb') as fd:
             for chunk in response.iter_content(5000):
                 fd.write(chunk)
         return True
@@ -46,9 +79,33 @@ def get_dwca_and_store_as_tmp_zip(url):
         return False
 
 
+def get_dwca_if_modified(url, file_location, etag=None, last_modified=None):
+    # Returns the response, which has status 304 and nothing written to file_location if the archive is unchanged
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    try:
+        response = requests.get(url, stream=True, headers=headers)
+        response.raise_for_status()
+        if response.status_code == 304:
+            return response
+        with open(file_location, 'wb') as fd:
+            for chunk in response.iter_content(5000):
+                fd.write(chunk)
+        return response
+    except (requests.exceptions.SSLError, requests.exceptions.HTTPError) as e:
+        logging.warning(f'SSL or HTTP error {e}')
+        return False
+
+
 def _log_error(e):
     logging.basicConfig(format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     exc_info = sys.exc_info()
-    msg = "GET request code: %s. URL: %s\n\n%s" % (e.response.status_code, e.response.url, '\n'.join(traceback.format_exception(*exc_info)))
+    if e.response is not None:
+        msg = "GET request code: %s. URL: %s\n\n%s" % (e.response.status_code, e.response.url, '\n'.join(traceback.format_exception(*exc_info)))
+    else:  # Timeouts and connection errors have no response
+        msg = "GET request failed: %s. URL: %s\n\n%s" % (e, getattr(e.request, 'url', None), '\n'.join(traceback.format_exception(*exc_info)))
     logging.warning(msg)
 
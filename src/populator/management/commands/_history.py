@@ -0,0 +1,97 @@
+from django.db import connection, transaction
+import logging
+import re
+from datetime import date, datetime
+
+# populator_history is range partitioned by changed_date, with a partition per month named populator_history_<yyyy>_<mm>.
+# The months of past years can be compacted into a partition per year, populator_history_<yyyy>. Rows no other partition
+# takes go to populator_history_default, which is emptied into the partition of their month once it is created
+TABLE = 'populator_history'
+
+
+def add_months(day, months):
+    """The first day of the month months after the month of day"""
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def get_partitions(table=TABLE):
+    """(name, start, end) of the partitions of table by start date, without the default partition"""
+    with connection.cursor() as cursor:
+        cursor.execute("""SELECT inhrelid::regclass::text, pg_get_expr(relpartbound, inhrelid)
+                          FROM pg_inherits INNER JOIN pg_class ON pg_class.oid = inhrelid
+                          WHERE inhparent = %s::regclass""", [table])
+        partitions = []
+        for name, bound in cursor.fetchall():
+            match = re.match(r"FOR VALUES FROM \('([\d-]+)'\) TO \('([\d-]+)'\)", bound)
+            if match:
+                partitions.append((name, date.fromisoformat(match.group(1)), date.fromisoformat(match.group(2))))
+        return sorted(partitions, key=lambda partition: partition[1])
+
+
+def create_month_partition(day, table=TABLE):
+    """Creates the partition for the month of day unless there is one already, returns its name if it was created"""
+    start, end = add_months(day, 0), add_months(day, 1)
+    if any(start < partition_end and partition_start < end for name, partition_start, partition_end in get_partitions(table)):
+        return None
+    name = f'{table}_{start:%Y_%m}'
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING STORAGE)')
+        attach_partition(cursor, name, start, end, table)
+    return name
+
+
+def ensure_partitions(today=None):
+    """Partitions for this month and the next, so history written by a merge never ends up in the default partition"""
+    today = today or date.today()
+    return [name for name in [create_month_partition(today), create_month_partition(add_months(today, 1))] if name]
+
+
+def compact(keep_months=12, today=None):
+    """
+    Merges the monthly partitions of each year which ended more than keep_months months ago into one partition for the
+    year, returns the names of the new partitions. Every year is merged in a transaction of its own.
+    """
+    cutoff = add_months(today or date.today(), -keep_months)
+    years = sorted({start.year for name, start, end in get_partitions() if end == add_months(start, 1) and date(start.year + 1, 1, 1) <= cutoff})
+    return [compact_year(year) for year in years]
+
+
+def compact_year(year):
+    start_time = datetime.now()
+    start, end = date(year, 1, 1), date(year + 1, 1, 1)
+    months = [name for name, partition_start, partition_end in get_partitions() if start <= partition_start and partition_end <= end]
+    name = f'{TABLE}_{year}'
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING STORAGE)')
+        for month in months:
+            cursor.execute(f'INSERT INTO {name} SELECT * FROM {month}')
+            cursor.execute(f'DROP TABLE {month}')
+        attach_partition(cursor, name, start, end)
+        cursor.execute(f'ANALYZE {name}')
+    log_time(start_time, f'compacted {len(months)} monthly history partitions into {name}')
+    return name
+
+
+def drop_before(day):
+    """Drops the partitions which only hold history from before day, returns their names"""
+    dropped = [name for name, start, end in get_partitions() if end <= day]
+    with transaction.atomic(), connection.cursor() as cursor:
+        for name in dropped:
+            cursor.execute(f'DROP TABLE {name}')
+    return dropped
+
+
+def attach_partition(cursor, name, start, end, table=TABLE):
+    # Rows in the default partition which belong to the new partition are moved into it first, attaching fails otherwise
+    cursor.execute(f"""WITH moved AS (
+                           DELETE FROM {table}_default WHERE changed_date >= %(start)s AND changed_date < %(end)s RETURNING *
+                       )
+                       INSERT INTO {name} SELECT * FROM moved""", {'start': start, 'end': end})
+    cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')")
+
+
+def log_time(start, message):
+    logger = logging.getLogger(__name__)
+    time_string = datetime.now() - start
+    logger.info('{}    - time taken - {}'.format(message, str(time_string)[:7]))
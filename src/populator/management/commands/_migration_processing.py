@@ -1,7 +1,13 @@
-from django.db import connection, transaction, utils
+from django.db import connection
 from zipfile import ZipFile, BadZipFile
 from datetime import datetime, timedelta
+from collections import Counter
+from populator.identifiers import normalize_id, normalize_materialsampleid, contains_uuid
+from populator.management.commands._batching import keyset_batches
 import psycopg2 as p
+import functools
+import gzip
+import json
 import re
 import logging
 import os
@@ -44,7 +50,8 @@ def get_dataset_id(zip_file_location):
             return re.search(r'alternateIdentifier>(' + uuid_regex + ')</alternateIdentifier', eml).group(1)
 
 
-def import_dwca(dataset_id, zip_file_location='/tmp/tmp.zip'):
+def import_dwca(dataset_id, zip_file_location='/tmp/tmp.zip', table='temp', duplicates=None):
+    """The number of rows imported into the migration table, None if the archive could not be imported"""
     logger = logging.getLogger(__name__)
     supported_files = ['event.txt', 'occurrence.txt', 'taxon.txt', 'measurementorfact.txt']
     count = 0
@@ -58,10 +65,22 @@ def import_dwca(dataset_id, zip_file_location='/tmp/tmp.zip'):
                     logger.info('about to import ' + file_name)
                     now = datetime.now()
                     columns = get_columns(f.readline())
-                    create_temp_table(columns)
+                    id_column = get_id(file_name)
+                    if not id_column or id_column not in columns:
+                        error_msg = f"Could not sync ID column for file {file_name}"
+                        logger.error(error_msg)
+                        send_discord_error(dataset_id, error_msg, "ID Column Sync Error")
+                        return None
+
+                    duplicate_materialsampleids = set()
+                    if 'materialsampleid' in columns:
+                        with zf.open(f'{file_name}.txt') as counting_f:
+                            counting_f.readline()
+                            duplicate_materialsampleids = get_duplicate_materialsampleids(counting_f, columns, id_column)
+                    create_temp_table(get_temp_columns(columns), table)
                     logger.info(f'created empty temp table with columns: {columns}')
                     try:
-                        import_file(f)
+                        import_file(f, columns, id_column, get_id(core), duplicate_materialsampleids, table)
                     except p.errors.CharacterNotInRepertoire as e:
                         error_msg = f"Character encoding error in file {file_name}: {str(e)}"
                         logger.error(error_msg)
@@ -74,37 +93,25 @@ def import_dwca(dataset_id, zip_file_location='/tmp/tmp.zip'):
                         continue
                     logger.info(f'fin copy from stdin, took {datetime.now() - now}')
                     now = datetime.now()
-
-                    if not sync_id_column(get_id(file_name), get_id(core)):
-                        error_msg = f"Could not sync ID column for file {file_name}"
-                        logger.error(error_msg)
-                        send_discord_error(dataset_id, error_msg, "ID Column Sync Error")
-                        return 0
-
-                    purlfriendly_id_columns()
-                    record_duplicates(dataset_id, file_name)
-                    remove_duplicates()
-                    logger.info(f'fin get duplicates, took {datetime.now() - now}')
-                    now = datetime.now()
-                    create_index()
+                    create_index(table)
                     logger.info(f'fin creating index {count}, took {datetime.now() - now}')
                     now = datetime.now()
-                    count += insert_json_into_migration_table(dataset_id, file_name)
+                    count += insert_json_into_migration_table(dataset_id, file_name, table=table, duplicates=duplicates)
                     logger.info(f'fin inserted {count}, took {datetime.now() - now}')
     except BadZipFile:
         error_msg = f"Bad zip file for dataset {dataset_id}"
         logger.error(error_msg)
         send_discord_error(dataset_id, error_msg, "Bad Zip File Error")
-        return 0
+        return None
     except Exception as e:
         error_msg = f"Unexpected error processing dataset {dataset_id}: {str(e)}\n{traceback.format_exc()}"
         logger.error(error_msg)
         send_discord_error(dataset_id, error_msg, "Unexpected Error")
-        return 0
+        return None
     finally:
         # Clean up temp table in case of any unexpected failures
         with connection.cursor() as cursor:
-            cursor.execute('DROP TABLE IF EXISTS temp')
+            cursor.execute(f'DROP TABLE IF EXISTS {table}')
 
     return count
 
@@ -113,14 +120,139 @@ def get_columns(firstline):
     return firstline.decode("utf-8").rstrip().lower().split('\t')
 
 
-def import_file(f):
-    with connection.cursor() as cursor:
-        cursor.copy_from(file=f, table='temp', null="")
+def staging_table_name(dataset_id):
+    # For imports running side by side, each needs its own staging table
+    return 'temp_' + re.sub('[^0-9a-z]', '_', dataset_id.lower())
 
 
-def create_temp_table(columns):
+def import_file(f, columns, id_column, core_id=None, duplicate_materialsampleids=frozenset(), table='temp'):
+    stream = NormalizedIdStream(f, columns, id_column, core_id, duplicate_materialsampleids)
+    with connection.cursor() as cursor:
+        cursor.copy_from(file=stream, table=table, null=NormalizedIdStream.NULL.decode())
+
+
+def get_temp_columns(columns):
+    # NormalizedIdStream adds parent, and id if the file does not have one
+    return columns + ['parent'] + ([] if 'id' in columns else ['id'])
+
+
+class NormalizedIdStream:
+    """
+    File-like wrapper that COPY reads a DwC-A file through, so each row reaches the temp table already normalized.
+    The id column gets the value of id_column and the core id is kept as parent, both normalized with
+    populator.identifiers, and NHM materialsampleids become the id when they hold a UUID.
+    Empty fields are written as \\N, so an id which normalizes to '' is not confused with a missing one. Rows with
+    the wrong number of fields are passed through untouched, so that COPY rejects the file as it would without this.
+    """
+    NULL = b'\\N'
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, f, columns, id_column, core_id=None, duplicate_materialsampleids=frozenset()):
+        self._file = f
+        self._width = len(columns)
+        self._id_index = columns.index(id_column)
+        self._existing_id_index = columns.index('id') if 'id' in columns else None
+        self._keeps_parent = self._existing_id_index is not None and core_id and core_id != id_column  # So we do not lose the core ids
+        self._materialsampleid_index = columns.index('materialsampleid') if 'materialsampleid' in columns else None
+        self._duplicate_materialsampleids = duplicate_materialsampleids
+        self._buffer = bytearray()
+        self._remainder = b''
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            block = self._file.read(self.BLOCK_SIZE)
+            if block:
+                lines = (self._remainder + block).split(b'\n')
+                self._remainder = lines.pop()
+                self._buffer += b''.join(self._normalize_row(line) + b'\n' for line in lines)
+            else:
+                self._eof = True
+                if self._remainder:
+                    self._buffer += self._normalize_row(self._remainder)
+        if size < 0:
+            size = len(self._buffer)
+        chunk = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return chunk
+
+    def _normalize_row(self, line):
+        fields, carriage_return = _split_row(line)
+        if len(fields) != self._width:
+            return line
+
+        id_ = _decode_field(fields[self._id_index])
+        parent = _decode_field(fields[self._existing_id_index]) if self._keeps_parent else None
+        if self._materialsampleid_index is not None:
+            materialsampleid = normalize_materialsampleid(_decode_field(fields[self._materialsampleid_index]))
+            if materialsampleid in self._duplicate_materialsampleids:
+                materialsampleid = ''
+            if contains_uuid(materialsampleid):
+                id_ = materialsampleid
+
+        fields = [field or self.NULL for field in fields]
+        if self._materialsampleid_index is not None:
+            fields[self._materialsampleid_index] = _encode_field(materialsampleid)
+        if self._existing_id_index is not None:
+            fields[self._existing_id_index] = _encode_field(normalize_id(id_))
+            fields.append(_encode_field(normalize_id(parent)))
+        else:
+            fields.append(_encode_field(normalize_id(parent)))
+            fields.append(_encode_field(normalize_id(id_)))
+        return b'\t'.join(fields) + carriage_return
+
+
+def get_duplicate_materialsampleids(f, columns, id_column):
+    # Sometimes there are duplicate uuids in materialsampleid for multiple records when we have 2 or more specimens on 1 sheet. This is a mistake, but cannot be fixed now. Do not resolve any of these.
+    id_index, materialsampleid_index = columns.index(id_column), columns.index('materialsampleid')
+    counts = Counter()
+    for line in f:
+        fields, carriage_return = _split_row(line.rstrip(b'\n'))
+        if len(fields) == len(columns) and fields[id_index]:
+            counts[normalize_materialsampleid(_decode_field(fields[materialsampleid_index]))] += 1
+    return {materialsampleid for materialsampleid, count in counts.items() if count > 1 and materialsampleid is not None}
+
+
+def _split_row(line):
+    if line.endswith(b'\r'):
+        return line[:-1].split(b'\t'), b'\r'
+    return line.split(b'\t'), b''
+
+
+_copy_escapes = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+_copy_escape_sequence = re.compile(r'\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)', re.DOTALL)
+
+
+def _decode_field(field):
+    # Empty fields are NULL. Invalid UTF-8 is kept as is, for COPY to reject
+    if not field:
+        return None
+    value = field.decode('utf-8', 'surrogateescape')
+    if '\\' in value:
+        value = _copy_escape_sequence.sub(_unescape, value)
+    return value
+
+
+def _unescape(match):
+    sequence = match.group(1)
+    if sequence[0] == 'x' and len(sequence) > 1:
+        return chr(int(sequence[1:], 16))
+    if sequence[0] in '01234567':
+        return chr(int(sequence, 8))
+    return _copy_escapes.get(sequence, sequence)
+
+
+def _encode_field(value):
+    if value is None:
+        return NormalizedIdStream.NULL
+    value = value.replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t')
+    return value.encode('utf-8', 'surrogateescape')
+
+
+def create_temp_table(columns, table='temp'):
+    # Unlogged, it is thrown away after the import anyway
     with connection.cursor() as cursor:
-        cursor.execute('DROP TABLE IF EXISTS temp; CREATE TABLE temp ("' + '" text, "'.join(columns) + '" text);')
+        cursor.execute(f'DROP TABLE IF EXISTS {table}; CREATE UNLOGGED TABLE {table} ("' + '" text, "'.join(columns) + '" text);')
 
 
 def get_core(file_list):
@@ -142,124 +274,111 @@ def get_id(file_type):
         return False
 
 
-def sync_id_column(id_column, core_id):
-    try:
-        with connection.cursor() as cursor:
-            cursor.execute("ALTER TABLE temp ADD COLUMN parent text")
-            cursor.execute("SELECT COUNT(*) FROM information_schema.columns WHERE table_name='temp' and column_name='id';")
-            if cursor.fetchone()[0] == 0:
-                cursor.execute("ALTER TABLE temp ADD COLUMN id text")
-            elif core_id and core_id != id_column:
-                cursor.execute("UPDATE temp SET parent = id")  # So we do not lose the core ids
-            cursor.execute("UPDATE temp SET id = %s" % id_column)
-        with connection.cursor() as cursor:  # Some NHM datasets have purl IDs in materialsampleid
-            cursor.execute("SELECT COUNT(*) FROM information_schema.columns WHERE table_name='temp' and column_name='materialsampleid';")
-            if cursor.fetchone()[0] == 1:
-                cursor.execute("UPDATE temp SET materialsampleid = REPLACE(materialsampleid, 'http://purl.org/nhmuio/id/', '')")
-                # Sometimes there are multiple UUIDs in one column, when one specimen is spread over several sheets. This is a mistake, but nothing can be done now. Just make the first one work.
-                cursor.execute("UPDATE temp SET materialsampleid = REGEXP_REPLACE(materialsampleid, '^([0-9a-fA-F]{8}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{12}).+', '\\1')")
-                # Sometimes there are duplicate uuids in materialsampleid for multiple records when we have 2 or more specimens on 1 sheet. This is a mistake, but cannot be fixed now. Do not resolve any of these.
-                duplicates = 'SELECT materialsampleid FROM temp GROUP BY materialsampleid HAVING count(id) > 1'
-                cursor.execute("UPDATE temp SET materialsampleid = '' WHERE materialsampleid IN (" + duplicates + ")")
-                # Finally, put materialsampleid in the id column if they look like they are valid
-                cursor.execute("UPDATE temp SET id = materialsampleid WHERE materialsampleid ~ '[0-9a-fA-F]{8}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{12}'")
-        with connection.cursor() as cursor:  # Force all IDs to lowercase
-            cursor.execute("UPDATE temp SET id = LOWER(id)")
-            cursor.execute("UPDATE temp SET parent = LOWER(parent)")
-    except p.errors.UndefinedColumn:
-        logger = logging.getLogger(__name__)
-        error_msg = 'Undefined column error in sync_id_column'
-        logger.error(error_msg)
-        send_discord_error('unknown', error_msg, "Database Column Error")
-        return False
-    except utils.ProgrammingError as e:
-        logger = logging.getLogger(__name__)
-        error_msg = f'Programming error in sync_id_column: {e}'
-        logger.error(error_msg)
-        send_discord_error('unknown', error_msg, "Database Programming Error")
-        return False
-    return True
-
-
-def purlfriendly_id_columns():  # PURL breaks when there is a ":" in the URL
-    with connection.cursor() as cursor:
-        cursor.execute("UPDATE temp SET id = REPLACE(id, 'urn:uuid:', '')")
-        cursor.execute("UPDATE temp SET parent = REPLACE(parent, 'urn:uuid:', '')")
+def add_dataset_id(dataset_id, table='temp'):
     with connection.cursor() as cursor:
-        cursor.execute("UPDATE temp SET id = REPLACE(id, 'http://purl.org/nhmuio/id/', '')")
-        cursor.execute("UPDATE temp SET parent = REPLACE(parent, 'http://purl.org/nhmuio/id/', '')")
-
-
-def add_dataset_id(dataset_id):
-    with connection.cursor() as cursor:
-        cursor.execute("SELECT COUNT(*) FROM information_schema.columns WHERE table_name='temp' and column_name='datasetid';")
+        cursor.execute("SELECT COUNT(*) FROM information_schema.columns WHERE table_name=%s and column_name='datasetid';", [table])
         if cursor.fetchone()[0] == 0:
-            cursor.execute('ALTER TABLE temp ADD COLUMN datasetid text')
-            cursor.execute("UPDATE temp SET datasetid = '%s'" % dataset_id)
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN datasetid text')
+            cursor.execute(f"UPDATE {table} SET datasetid = '%s'" % dataset_id)
 
 
-def record_duplicates(dataset_id, core_type, file='/srv/duplicates.txt'):
-    with connection.cursor() as cursor:
-        query = ("""
-        SELECT 
-            temp.id AS id, 
-            row_to_json(temp) AS new_data, 
-            '{0}' AS new_datasetid, 
-            '{1}' AS new_core_type, 
-            j.data AS old_data, 
-            j.dataset_id AS old_datasetid
-        FROM temp 
-        LEFT JOIN populator_resolvableobjectmigration AS j ON j.id = temp.id
-        WHERE j.id IS NOT NULL
-        """).format(dataset_id, core_type)
-        outputquery = "COPY ({0}) TO STDOUT (DELIMITER '|')".format(query)
-
-        with open(file, 'a') as f:
-            cursor.copy_expert(outputquery, f)
-
-
-def remove_duplicates():
+def get_temp_count(table='temp'):
     with connection.cursor() as cursor:
-        select = 'SELECT temp.id FROM temp LEFT JOIN populator_resolvableobjectmigration as j on j.id = temp.id ' \
-                 'WHERE j.id IS NOT NULL'
-        query = 'DELETE FROM temp WHERE temp.id IN ({})'.format(select)
-        cursor.execute(query)
-
-
-def get_temp_count():
-    with connection.cursor() as cursor:
-        cursor.execute('SELECT COUNT(*) FROM temp;')
+        cursor.execute(f'SELECT COUNT(*) FROM {table};')
         return cursor.fetchone()[0]
 
 
-def insert_json_into_migration_table(dataset_id, core_type, step=300000):
-    count = 0
-    temp_count = get_temp_count()
-    _max = step if temp_count <= step else temp_count + step
-    for i in range(0, _max, step):
-        logger = logging.getLogger(__name__)
-        logger.info('Migration loop: {}'.format(i))
-        make_json_sql = (f"SELECT temp.id, json_strip_nulls(row_to_json(temp)), '{dataset_id}', '{core_type}', temp.parent"
-                         f" FROM temp ORDER BY temp.id LIMIT {step} OFFSET {i};")
-        insert_sql = 'INSERT INTO populator_resolvableobjectmigration(id, data, dataset_id, type, parent) ' + make_json_sql
-        with connection.cursor() as cursor:
-            cursor.execute(insert_sql)
-            count += cursor.rowcount
-        #db = create_keepalive_connection()
-        #with db.cursor() as cursor:
-        #    cursor.execute(insert_sql)
-        #    count += cursor.rowcount
-        #db.close()
+def insert_json_into_migration_table(dataset_id, core_type, batch_size=None, table='temp', duplicates=None):
+    # Batches are keyset based (rows after the last (id, ctid) of the previous batch), so each one only reads its own rows
+    # from the index. The ctid keeps rows with the same id apart, so a batch can end between them without skipping any
+    logger = logging.getLogger(__name__)
+    payloads = duplicates.payloads if duplicates else False
+    insert_batch = functools.partial(insert_migration_batch, dataset_id, core_type, table, payloads)
+    count, skipped = 0, 0
+    for inserted, batch_duplicates in keyset_batches(insert_batch, batch_size, label=f'migration insert {dataset_id} {core_type}'):
+        count += inserted
+        skipped += len(batch_duplicates)
+        if duplicates:
+            duplicates.write(dataset_id, batch_duplicates)
+    if skipped:
+        logger.info(f'skipped {skipped} rows of {dataset_id} {core_type} with ids which were already imported')
     return count
 
 
-def create_index():
+def insert_migration_batch(dataset_id, core_type, table, payloads, last_key, limit):
+    # Rows with an id which is already in the migration table, from this or another dataset, are skipped by the insert
+    # and returned as duplicates. duplicate_of is the dataset which has the id, it is null if that was imported at the
+    # same time by another import. Rows without an id are left out, they cannot be resolved. Of the rows of a file with
+    # the same id the first one is kept, the insert takes them in ctid order and they are numbered the same way
+    where = f'({table}.id, {table}.ctid) > (%(last_id)s, %(last_ctid)s::tid)' if last_key is not None else f'{table}.id IS NOT NULL'
+    last_id, last_ctid = last_key or (None, None)
+    payload = ", 'data', duplicate.data, 'old_data', old.data" if payloads else ''
+    sql = f"""
+        WITH batch AS (
+            SELECT {table}.id, {table}.ctid, json_strip_nulls(row_to_json({table})) AS data, {table}.parent
+            FROM {table}
+            WHERE {where}
+            ORDER BY {table}.id, {table}.ctid
+            LIMIT %(limit)s
+        ), inserted AS (
+            INSERT INTO populator_resolvableobjectmigration(id, data, dataset_id, type, parent)
+            SELECT id, data, %(dataset_id)s, %(core_type)s, parent FROM batch ORDER BY id, ctid
+            ON CONFLICT (id) DO NOTHING
+            RETURNING id
+        ), duplicate AS (
+            SELECT id, data, row_number() OVER (PARTITION BY id ORDER BY ctid) AS copy FROM batch
+        ), last AS (
+            SELECT id, ctid::text FROM batch ORDER BY id DESC, ctid DESC LIMIT 1
+        )
+        SELECT (SELECT id FROM last), (SELECT ctid FROM last), (SELECT count(*) FROM batch), (SELECT count(*) FROM inserted),
+            (SELECT json_agg(json_build_object(
+                 'id', duplicate.id, 'dataset_id', %(dataset_id)s, 'type', %(core_type)s,
+                 'duplicate_of', COALESCE(old.dataset_id, CASE WHEN duplicate.copy > 1 THEN %(dataset_id)s END){payload}))
+             FROM duplicate
+             LEFT JOIN populator_resolvableobjectmigration AS old ON old.id = duplicate.id
+             WHERE duplicate.copy > 1 OR NOT EXISTS (SELECT FROM inserted WHERE inserted.id = duplicate.id))"""
+    with connection.cursor() as cursor:
+        cursor.execute(sql, {'last_id': last_id, 'last_ctid': last_ctid, 'limit': limit, 'dataset_id': dataset_id, 'core_type': core_type})
+        batch_last_id, batch_last_ctid, rows, inserted, duplicates = cursor.fetchone()
+        return (batch_last_id, batch_last_ctid), rows, (inserted, duplicates or [])
+
+
+class DuplicateLog:
+    """
+    Log of the rows which were not imported because their id had already been imported, as gzipped JSON lines with
+    one file per dataset in directory. Each line has the id, the dataset and core type of the row and the dataset which
+    has the id, with payloads also the data of both.
+    """
+    def __init__(self, directory, payloads=False):
+        self.directory = directory
+        self.payloads = payloads
+
+    def path(self, dataset_id):
+        return os.path.join(self.directory, re.sub(r'[^\w-]', '_', dataset_id) + '.jsonl.gz')
+
+    def write(self, dataset_id, duplicates):
+        # Every write appends a gzip member, which reads back as one stream. Imports running side by side write to
+        # files of their own
+        if not duplicates:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with gzip.open(self.path(dataset_id), 'at', encoding='utf-8') as f:
+            f.writelines(json.dumps(duplicate, ensure_ascii=False) + '\n' for duplicate in duplicates)
+
+    def read(self, dataset_id):
+        if not os.path.exists(self.path(dataset_id)):
+            return []
+        with gzip.open(self.path(dataset_id), 'rt', encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+
+def create_index(table='temp'):
     #db = create_keepalive_connection()
     #with db.cursor() as cursor:
     #    cursor.execute('CREATE INDEX idx_id ON temp(id)')
     #db.close()
     with connection.cursor() as cursor:
-        cursor.execute('CREATE INDEX idx_id ON temp(id)')
+        cursor.execute(f'CREATE INDEX idx_id_{table} ON {table}(id)')
 
 
 def create_keepalive_connection():
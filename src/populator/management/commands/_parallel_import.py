@@ -0,0 +1,48 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from django.db import connections
+from populator.management.commands import _migration_processing
+import multiprocessing
+
+
+def import_archives(archives, workers=1, duplicates=None):
+    """
+    Imports each (dataset key, zip file location) into the migration table and yields (dataset key, row count) once
+    it is done. With workers > 1 the datasets are imported side by side in forked processes, each with its own
+    connection and staging table, and are yielded in the order they finish. archives is consumed lazily, a new one
+    is only taken once a worker is free. Rows skipped as duplicates are written to the DuplicateLog duplicates.
+    """
+    if workers <= 1:
+        for dataset_key, zip_file_location in archives:
+            yield dataset_key, _migration_processing.import_dwca(dataset_key, zip_file_location, duplicates=duplicates)
+        return
+
+    # Forked processes must not share the parent's connection, each one opens its own. All of them are started
+    # straight away, as the parent uses its connection again while the imports run
+    connections.close_all()
+    pending = {}
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        wait([executor.submit(_start_worker) for _ in range(workers)])
+        for dataset_key, zip_file_location in archives:
+            while len(pending) >= workers:
+                yield from _finished(pending)
+            pending[executor.submit(import_in_worker, dataset_key, zip_file_location, duplicates)] = dataset_key
+        while pending:
+            yield from _finished(pending)
+
+
+def import_in_worker(dataset_key, zip_file_location, duplicates=None):
+    try:
+        table = _migration_processing.staging_table_name(dataset_key)
+        return _migration_processing.import_dwca(dataset_key, zip_file_location, table, duplicates=duplicates)
+    finally:
+        connections.close_all()
+
+
+def _start_worker():
+    pass
+
+
+def _finished(pending):
+    done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+        yield pending.pop(future), future.result()
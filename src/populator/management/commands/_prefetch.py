@@ -0,0 +1,108 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from populator.management.commands import _gbif_api
+import logging
+import os
+import threading
+
+
+class ArchivePrefetcher:
+    """
+    Downloads DwC-As ahead of the importer, so that the network and the database are busy at the same time.
+    With workers > 0, up to `workers` archives after the one currently being imported are fetched in the
+    background, each into its own file in download_dir. Archives stay on disk until they are released. Once
+    disk_budget bytes are held, no new download starts until the importer releases something. An archive only
+    counts towards the budget once it has been downloaded, so the downloads in flight can overshoot it.
+    download(dataset key, url) and discard(dataset key, zip file location) can be replaced, e.g. by an ArchiveCache.
+    """
+    def __init__(self, download_dir='/tmp/archives', workers=0, disk_budget=None, download=None, discard=None):
+        self.download_dir = download_dir
+        self.workers = workers
+        self.disk_budget = disk_budget
+        self.download = download or self.download_archive
+        self.discard = discard or self.delete_archive
+        self._held = {}  # dataset key -> (zip file location, size in bytes)
+        self._next_to_start = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def download_archive(self, dataset_key, url):
+        zip_file_location = os.path.join(self.download_dir, f'{dataset_key}.zip')
+        if _gbif_api.get_dwca_and_store_as_tmp_zip(url, zip_file_location):
+            return zip_file_location
+        return None
+
+    def delete_archive(self, dataset_key, zip_file_location):
+        try:
+            os.remove(zip_file_location)
+        except FileNotFoundError:
+            pass
+
+    def fetch(self, archives):
+        """Yields (dataset key, zip file location or None if the download failed) for each (dataset key, url), in order"""
+        os.makedirs(self.download_dir, exist_ok=True)
+        if not self.workers:
+            for dataset_key, url in archives:
+                yield dataset_key, self._store(dataset_key, self.download(dataset_key, url))
+            return
+
+        self._closed = False
+        self._next_to_start = 0
+        archives = enumerate(archives)
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            self._submit(executor, archives, pending)
+            while pending:
+                dataset_key, future = pending.popleft()
+                zip_file_location = future.result()
+                self._submit(executor, archives, pending)
+                yield dataset_key, zip_file_location
+        finally:
+            with self._condition:
+                self._closed = True
+                self._condition.notify_all()
+            for dataset_key, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def release(self, dataset_key):
+        """Discards a downloaded archive once it has been imported, freeing its share of the disk budget"""
+        with self._condition:
+            held = self._held.pop(dataset_key, None)
+            self._condition.notify_all()
+        if held:
+            self.discard(dataset_key, held[0])
+
+    def held_bytes(self):
+        with self._condition:
+            return sum(size for location, size in self._held.values())
+
+    def _submit(self, executor, archives, pending):
+        while len(pending) < self.workers:
+            try:
+                position, (dataset_key, url) = next(archives)
+            except StopIteration:
+                return
+            pending.append((dataset_key, executor.submit(self._prefetch, position, dataset_key, url)))
+
+    def _prefetch(self, position, dataset_key, url):
+        # Downloads start strictly in order, otherwise a later archive could take the budget the importer is waiting for
+        with self._condition:
+            if self._budget_full():
+                logging.getLogger(__name__).info(f'disk budget full, waiting to download {dataset_key}')
+            self._condition.wait_for(lambda: self._closed or (position == self._next_to_start and not self._budget_full()))
+            if self._closed:
+                return None
+            self._next_to_start += 1
+            self._condition.notify_all()
+        return self._store(dataset_key, self.download(dataset_key, url))
+
+    def _store(self, dataset_key, zip_file_location):
+        if zip_file_location:
+            with self._condition:
+                self._held[dataset_key] = (zip_file_location, os.path.getsize(zip_file_location))
+        return zip_file_location
+
+    def _budget_full(self):
+        return self.disk_budget is not None and sum(size for location, size in self._held.values()) >= self.disk_budget
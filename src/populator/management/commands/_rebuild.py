@@ -0,0 +1,105 @@
+from django.db import connection
+import functools
+import logging
+from populator.management.commands import _cache_data, _history, _statistics
+from website import tables
+from populator.management.commands._batching import AdaptiveBatchSize, keyset_batches
+from datetime import datetime
+
+LIVE = 'website_resolvableobject'
+NEXT = 'website_resolvableobject_next'
+PREVIOUS = 'website_resolvableobject_old'
+SWAP_LOCK_TIMEOUT = '10s'  # Gives up on the swap rather than queueing API reads behind it for long
+
+
+def rebuild_resolvableobject(dataset_ids=None, batch_size=None, start_after=None, checkpoint=None, dataset_merged=None):
+    """
+    Merges the migration table by building the next generation of website_resolvableobject next to the live one, then
+    swapping it in, so the live table never takes in-place updates. Gives the same records and history as
+    merge_in_new_data, and takes the same arguments. The generation it replaces is kept as website_resolvableobject_old
+    until the next rebuild, and rollback() swaps it back in. History is recorded in batches which are checkpointed like
+    the merge batches, the datasets only count as merged once the new table is live.
+    """
+    datasets = _cache_data.datasets_to_merge(dataset_ids)
+    if not datasets:
+        log_time(datetime.now(), 'no datasets to merge')
+        return
+
+    start = datetime.now()
+    _history.ensure_partitions()
+    start_after = start_after or {}
+    batch_size = batch_size or AdaptiveBatchSize(initial=5000)
+    for dataset_id in datasets:
+        run_batch = functools.partial(_cache_data.merge_batch, dataset_id=dataset_id, checkpoint=checkpoint, history_only=True)
+        list(keyset_batches(run_batch, batch_size, label=f'history {dataset_id}', start_after=start_after.get(dataset_id)))
+    log_time(start, f'recorded history for {len(datasets)} datasets')
+
+    start = datetime.now()
+    create_next_table()
+    loaded = load_next_table(tuple(datasets) if dataset_ids is not None else None)
+    log_time(start, f'loaded {loaded} records into {NEXT}')
+
+    start = datetime.now()
+    tables.copy_indexes_constraints_and_triggers(LIVE, NEXT, '_next')
+    with connection.cursor() as cursor:
+        cursor.execute(f'VACUUM ANALYZE {NEXT}')
+    log_time(start, f'indexed {NEXT}')
+
+    start = datetime.now()
+    tables.swap(LIVE, [(LIVE, PREVIOUS, '', '_old'), (NEXT, LIVE, '_next', '')], drop=PREVIOUS, lock_timeout=SWAP_LOCK_TIMEOUT)
+    _statistics.recount(datasets if dataset_ids is not None else None)  # Only the merged datasets changed
+    if dataset_merged:
+        for dataset_id in datasets:
+            dataset_merged(dataset_id)
+    log_time(start, f'swapped in {NEXT}, the previous generation is kept as {PREVIOUS}')
+
+
+def rollback():
+    """Swaps the previous generation back in, the current one becomes the previous generation"""
+    tables.swap(LIVE, [(LIVE, NEXT, '', '_next'), (PREVIOUS, LIVE, '_old', ''), (NEXT, PREVIOUS, '_next', '_old')],
+                lock_timeout=SWAP_LOCK_TIMEOUT)
+    _statistics.recount()
+
+
+def has_previous_generation():
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT to_regclass(%s) IS NOT NULL', [PREVIOUS])
+        return cursor.fetchone()[0]
+
+
+def create_next_table():
+    # Partitioned like the live table, without indexes, they are built once the table is loaded
+    tables.create_copy(LIVE, NEXT, partitions=tables.partition_count(LIVE))
+
+
+def load_next_table(dataset_ids=None):
+    # The same rules as the in-place merge: imported records replace the data of the records with the same id and
+    # dataset, which are undeleted, and new ids are added. Records of merged datasets whose id was not imported get a
+    # deleted date and everything else is copied over as it is. dataset_ids None merges every dataset
+    new_scope = 'AND new.dataset_id IN %(dataset_ids)s' if dataset_ids is not None else ''
+    old_scope = 'AND old.dataset_id IN %(dataset_ids)s' if dataset_ids is not None else ''
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO {NEXT}(id, data, type, created_date, deleted_date, dataset_id, parent, data_hash)
+            SELECT new.id, new.data, COALESCE(old.type, new.type), COALESCE(old.created_date, CURRENT_DATE), NULL,
+                   new.dataset_id, CASE WHEN old.id IS NULL THEN new.parent ELSE old.parent END, new.data_hash
+            FROM populator_resolvableobjectmigration AS new
+            LEFT JOIN {LIVE} AS old ON old.id = new.id
+            WHERE (old.id IS NULL OR old.dataset_id = new.dataset_id) {new_scope}
+            UNION ALL
+            SELECT old.id, old.data, old.type, old.created_date,
+                   CASE WHEN old.deleted_date IS NULL {old_scope}
+                            AND NOT EXISTS (SELECT FROM populator_resolvableobjectmigration AS imported WHERE imported.id = old.id)
+                        THEN CURRENT_DATE ELSE old.deleted_date END,
+                   old.dataset_id, old.parent, old.data_hash
+            FROM {LIVE} AS old
+            WHERE NOT EXISTS (SELECT FROM populator_resolvableobjectmigration AS new
+                              WHERE new.id = old.id AND new.dataset_id = old.dataset_id {new_scope})
+        """, {'dataset_ids': dataset_ids})
+        return cursor.rowcount
+
+
+def log_time(start, message):
+    logger = logging.getLogger(__name__)
+    time_string = datetime.now() - start
+    logger.info('{}    - time taken - {}'.format(message, str(time_string)[:7]))
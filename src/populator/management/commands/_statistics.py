@@ -0,0 +1,33 @@
+from django.db import connection, transaction
+
+# The record counts in populator_recordcount are kept up to date by the statements which change the resolver table:
+# they return the dataset, type, basis of record and deleted state each record had before and has after the change, as
+# deltas of -1 and +1, which add_deltas() adds to the counts in the same statement. recount() counts them again from the
+# resolver table, after it has been swapped or changed without deltas
+
+BASIS_OF_RECORD = "COALESCE({}.data ->> 'basisofrecord', '')"
+
+
+def add_deltas(deltas):
+    """
+    Statement for a WITH query which adds the deltas in the query named deltas, with the columns dataset_id, type,
+    basisofrecord, deleted and delta, to the record counts
+    """
+    return f"""INSERT INTO populator_recordcount AS recordcount (dataset_id, type, basisofrecord, deleted, count)
+               SELECT dataset_id, type, basisofrecord, deleted, sum(delta) FROM {deltas}
+               GROUP BY dataset_id, type, basisofrecord, deleted
+               HAVING sum(delta) <> 0
+               ON CONFLICT (dataset_id, type, basisofrecord, deleted) DO UPDATE SET count = recordcount.count + EXCLUDED.count"""
+
+
+def recount(dataset_ids=None):
+    """Counts the records of the datasets, or of all of them if dataset_ids is None, again from the resolver table"""
+    if dataset_ids is not None and not dataset_ids:
+        return
+    scope = 'WHERE dataset_id IN %(dataset_ids)s' if dataset_ids is not None else ''
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM populator_recordcount {scope}', {'dataset_ids': tuple(dataset_ids or [])})
+        cursor.execute(f"""INSERT INTO populator_recordcount (dataset_id, type, basisofrecord, deleted, count)
+                           SELECT dataset_id, type, {BASIS_OF_RECORD.format('website_resolvableobject')}, deleted_date IS NOT NULL, count(*)
+                           FROM website_resolvableobject {scope}
+                           GROUP BY 1, 2, 3, 4""", {'dataset_ids': tuple(dataset_ids or [])})
@@ -0,0 +1,74 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from datetime import datetime
+
+
+class Command(BaseCommand):
+    help = 'Compares the speed and results of jsonb_diff_val with the original plpgsql version, on pairs of DwC records'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000, help='Number of old/new record pairs to diff')
+        parser.add_argument('--existing', action='store_true', help='Use records from the resolver and the migration table instead of generated ones')
+
+    def handle(self, *args, **options):
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE IF EXISTS benchmark_jsonb_diff')
+            if options['existing']:
+                cursor.execute("""CREATE TEMPORARY TABLE benchmark_jsonb_diff AS
+                                  SELECT old.data AS old, new.data AS new
+                                  FROM populator_resolvableobjectmigration AS new
+                                  INNER JOIN website_resolvableobject AS old ON new.id = old.id
+                                  LIMIT %s""", [options['rows']])
+            else:
+                cursor.execute(GENERATE_PAIRS, [options['rows']])
+            cursor.execute('SELECT COUNT(*), COUNT(*) FILTER (WHERE old <> new) FROM benchmark_jsonb_diff')
+            pairs, changed = cursor.fetchone()
+            if not pairs:
+                raise CommandError('No records to compare')
+            self.stdout.write(f'{pairs} pairs, {changed} with changes')
+
+            for function in ['jsonb_diff_val_plpgsql', 'jsonb_diff_val']:
+                start = datetime.now()
+                cursor.execute(f"SELECT COUNT(*) FROM benchmark_jsonb_diff WHERE {function}(old, new) != '{{}}'")
+                seconds = (datetime.now() - start).total_seconds()
+                self.stdout.write(f'{function}: {seconds:.2f}s, {pairs / max(seconds, 0.001):.0f} rows/s, {cursor.fetchone()[0]} diffs')
+
+            cursor.execute("""SELECT COUNT(*) FROM benchmark_jsonb_diff
+                              WHERE jsonb_diff_val(old, new) IS DISTINCT FROM jsonb_diff_val_plpgsql(old, new)""")
+            differing = cursor.fetchone()[0]
+            self.stdout.write(f'{differing} differing results')
+            cursor.execute('DROP TABLE benchmark_jsonb_diff')
+        if differing:
+            raise CommandError('jsonb_diff_val does not give the same results as jsonb_diff_val_plpgsql')
+
+
+# Occurrence records shaped like the ones in the migration table. Most are unchanged, some have a field changed, a
+# field added or a field removed, like a weekly re-import. % is doubled as the query has parameters
+GENERATE_PAIRS = """
+    CREATE TEMPORARY TABLE benchmark_jsonb_diff AS
+    WITH records AS (
+        SELECT i, jsonb_build_object(
+            'id', md5(i::text), 'occurrenceid', 'urn:uuid:' || md5(i::text), 'type', 'PhysicalObject',
+            'modified', '2021-01-05', 'basisofrecord', 'PreservedSpecimen', 'institutioncode', 'O',
+            'collectioncode', 'V', 'catalognumber', (100000 + i)::text, 'recordedby', 'Collector ' || (i %% 500),
+            'individualcount', (i %% 7 + 1)::text, 'preparations', 'Herbarium sheet', 'year', (1850 + i %% 170)::text,
+            'month', (i %% 12 + 1)::text, 'day', (i %% 28 + 1)::text, 'country', 'Norway', 'countrycode', 'NO',
+            'stateprovince', 'Oslo', 'county', 'Oslo', 'locality', 'Locality number ' || i,
+            'decimallatitude', (58 + (i %% 1000) / 100.0)::text, 'decimallongitude', (5 + (i %% 2500) / 100.0)::text,
+            'coordinateuncertaintyinmeters', '100', 'identifiedby', 'Identifier ' || (i %% 300),
+            'scientificname', 'Genus species' || (i %% 4000) || ' L.', 'kingdom', 'Plantae', 'phylum', 'Tracheophyta',
+            'class', 'Magnoliopsida', 'order', 'Asterales', 'family', 'Asteraceae', 'genus', 'Genus',
+            'specificepithet', 'species' || (i %% 4000), 'scientificnameauthorship', 'L.',
+            'occurrenceremarks', repeat('Remarks about the specimen. ', i %% 5)
+        ) AS data
+        FROM generate_series(1, %s) AS i
+    )
+    SELECT data AS old,
+        CASE
+            WHEN i %% 10 = 0 THEN data || jsonb_build_object('locality', 'Changed locality ' || i, 'modified', '2022-02-02')
+            WHEN i %% 50 = 1 THEN data || jsonb_build_object('typestatus', 'Holotype')
+            WHEN i %% 50 = 2 THEN data - 'occurrenceremarks'
+            ELSE data
+        END AS new
+    FROM records
+"""
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from populator.models import RecordCount
+from website.views import ResolvableObjectViewSet
+from datetime import datetime
+
+
+class Command(BaseCommand):
+    help = 'Resolves a sample of ids through the resolver view, and reports the queries and latency per request'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=1000, help='Number of ids to resolve')
+
+    def handle(self, *args, **options):
+        ids = sample_ids(options['requests'])
+        if not ids:
+            raise CommandError('No records to resolve')
+
+        # Every other id is requested the way PURLs often carry it, prefixed and in upper case
+        view = ResolvableObjectViewSet.as_view({'get': 'retrieve'})
+        factory = RequestFactory()
+        queries, seconds, misses = [], [], 0
+        for i, id_ in enumerate(ids):
+            requested = id_ if i % 2 else 'urn:uuid:' + id_.upper()
+            request = factory.get(f'/{requested}/', HTTP_ACCEPT='application/ld+json')
+            start = datetime.now()
+            with CaptureQueriesContext(connection) as captured:
+                response = view(request, id__iexact=requested)
+                response.render()
+            seconds.append((datetime.now() - start).total_seconds())
+            queries.append(len(captured))
+            misses += response.status_code != 200
+
+        seconds.sort()
+        self.stdout.write(f'{len(ids)} requests, {sum(queries) / len(queries):.2f} queries per request (max {max(queries)}), {misses} not resolved')
+        self.stdout.write(f'p50 {percentile(seconds, 50) * 1000:.1f}ms, p99 {percentile(seconds, 99) * 1000:.1f}ms, max {seconds[-1] * 1000:.1f}ms')
+
+
+def sample_ids(count):
+    # TABLESAMPLE reads a percentage of the table's pages instead of sorting all of it like ORDER BY random() would
+    total = RecordCount.objects.total() or 1
+    percent = min(100, count * 200 / total)
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT id FROM website_resolvableobject TABLESAMPLE SYSTEM ({percent}) LIMIT %s', [count])
+        return [id_ for id_, in cursor.fetchall()]
+
+
+def percentile(values, percent):
+    """The value percent % of the sorted values are at or below"""
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
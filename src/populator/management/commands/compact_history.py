@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from populator.management.commands import _history
+from datetime import date
+
+
+class Command(BaseCommand):
+    help = 'Merges the monthly partitions of past years in the history table into yearly ones, and drops old history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-months', type=int, default=12, help='Years which ended less than this many months ago keep their monthly partitions')
+        parser.add_argument('--drop-before', type=date.fromisoformat, help='Drop history recorded before this date (YYYY-MM-DD), by whole partitions')
+
+    def handle(self, *args, **options):
+        if options['drop_before']:
+            for name in _history.drop_before(options['drop_before']):
+                self.stdout.write(f'Dropped {name}')
+        for name in _history.compact(keep_months=options['keep_months']):
+            self.stdout.write(f'Compacted {name}')
+        for name in _history.ensure_partitions():
+            self.stdout.write(f'Created {name}')
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from populator.models import RecordCount, Statistic
+from populator.management.commands import _statistics
+
+
+class Command(BaseCommand):
+    help = 'Counts the records in the resolver again by dataset, type, basis of record and deleted state, instead of relying on the counts kept by the merge'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dataset', action='append', help='Only count the records of this dataset, can be given more than once')
+
+    def handle(self, *args, **options):
+        _statistics.recount(options['dataset'])
+        total_count = Statistic.objects.set_total_count(RecordCount.objects.total())
+        self.stdout.write(f'Counted, total count now {total_count}')
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from website import tables
+from datetime import datetime
+
+
+class Command(BaseCommand):
+    help = 'Vacuums and analyzes the partitions of the resolver table one at a time, optionally rebuilding their indexes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reindex', action='store_true', help='Also rebuild the indexes of each partition, concurrently')
+        parser.add_argument('--partition', action='append', help='Only this partition, can be given more than once')
+
+    def handle(self, *args, **options):
+        partitions = tables.get_partitions('website_resolvableobject') or ['website_resolvableobject']
+        unknown = set(options['partition'] or []) - set(partitions)
+        if unknown:
+            raise CommandError(f'Not a partition of website_resolvableobject: {", ".join(sorted(unknown))}')
+        partitions = options['partition'] or partitions
+        with connection.cursor() as cursor:
+            for partition in partitions:
+                start = datetime.now()
+                cursor.execute(f'VACUUM (ANALYZE) {partition}')
+                if options['reindex']:
+                    cursor.execute(f'REINDEX TABLE CONCURRENTLY {partition}')
+                self.stdout.write(f'{partition}: {str(datetime.now() - start)[:7]}')
+            # Partitions have their own statistics, the planner also needs the ones of the partitioned table
+            cursor.execute('ANALYZE website_resolvableobject')
@@ -1,9 +1,13 @@
 from django.core.management.base import BaseCommand, CommandError
-from populator.models import Statistic, ResolvableObject
+from populator.models import RecordCount, Statistic, ResolvableObject, ResolvableObjectMigration, Run, RunDataset
 from website.models import Dataset
-from populator.management.commands import _gbif_api, _migration_processing, _cache_data
+from website import result_cache
+from populator.management.commands import _gbif_api, _migration_processing, _cache_data, _prefetch, _archive_cache, _parallel_import, _rebuild
+import functools
 import logging
+import os
 from django.db import connection
+from django.utils import timezone
 from datetime import datetime
 
 
@@ -14,74 +18,153 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--reset', action='store_true', help='Resets (clears cache) from GBIF')
         parser.add_argument('--skip', action='store_true', help='Skips ingestion and goes straight to merging - use if the script failed at merging stage')
+        parser.add_argument('--resume', action='store_true', help='Carries on with the last run which did not finish, from where it stopped')
+        parser.add_argument('--prefetch', type=int, default=0, help='Number of archives to download in the background while the current one is imported')
+        parser.add_argument('--disk-budget', type=int, default=None, help='Maximum MB of downloaded archives waiting to be imported before prefetching pauses')
+        parser.add_argument('--download-dir', default='/tmp/archives', help='Directory the archives are downloaded to')
+        parser.add_argument('--archive-cache', default=None, help='Directory to keep archives in between runs, so unchanged archives are neither downloaded nor imported again')
+        parser.add_argument('--archive-cache-size', type=int, default=20480, help='Maximum MB kept in the archive cache, least recently used archives are evicted first')
+        parser.add_argument('--import-workers', type=int, default=1, help='Number of datasets imported in parallel, each in its own process and staging table')
+        parser.add_argument('--duplicates-dir', default='/srv/duplicates', help='Directory for the logs of rows skipped because their id was already imported, one directory per run')
+        parser.add_argument('--duplicate-payloads', action='store_true', help='Also logs the data of both rows for each duplicate, not just the ids and datasets')
+        parser.add_argument('--rebuild', action='store_true', help='Merges into a new copy of the resolver table which is swapped in when it is ready, instead of updating the live table in place')
+        parser.add_argument('--bulk-merge', action='store_true', help='Drops and rebuilds the GIN index on data around the merge if it changes many records, or merges into larger GIN pending lists if it changes few')
+        parser.add_argument('--dataset', default=None, help='Downloads, imports and merges only the dataset with this key, even if it is unchanged')
 
     def handle(self, *args, **options):
-        dataset_list = _gbif_api.get_dataset_list()
+        overall_start = datetime.now()
+        if options['dataset'] and (options['resume'] or options['skip']):
+            raise CommandError('--dataset cannot be used with --resume or --skip')
+        run = Run.objects.resumable() if options['resume'] else None
+        if run:
+            # The checkpoints of a rebuild only cover the history it recorded, not the live table, so a run is always
+            # merged the way it started
+            self.logger.info(f"resuming run {run.id} from stage {run.stage}, merging {'by rebuild' if run.rebuild else 'in place'}")
+        elif options['dataset']:
+            # Everything else in the migration table is left alone, ingest clears out the old rows of this dataset
+            run = Run.objects.create(dataset_key=options['dataset'], rebuild=options['rebuild'])
+        else:
+            # Set up for import
+            if not options['skip']:
+                reset_import_table()
+            run = Run.objects.create(stage=Run.MERGING if options['skip'] else Run.LISTING, rebuild=options['rebuild'])
+
+        if run.stage == Run.LISTING:
+            self.list_datasets(run)
+            run.set_stage(Run.INGESTING)
+        if run.stage == Run.INGESTING:
+            self.ingest(run, options)
+            run.set_stage(Run.MERGING)
+        log_time(overall_start, f'finished all datasets {run.datasets.count()}, merging in starts next')
+
+        # A --skip run lists no datasets, and syncing against an empty list would mark every dataset deleted. That goes
+        # for a --skip run which is resumed too, when options['skip'] is no longer set
+        if not run.dataset_key and run.datasets.exists():
+            start = datetime.now()
+            _cache_data.sync_datasets([dataset.dataset_key for dataset in run.datasets.all()])
+            log_time(start, 'caching complete')
+
+        # Only the datasets which were imported are merged, the records of all the others are left as they are
+        start = datetime.now()
+        if run.rebuild:
+            merge = _rebuild.rebuild_resolvableobject  # Builds its indexes from scratch anyway
+        else:
+            merge = functools.partial(_cache_data.merge_in_new_data, bulk=options['bulk_merge'])
+        merge(dataset_ids=run.datasets_to_merge(), start_after=run.merge_positions(), checkpoint=run.checkpoint_merge,
+              dataset_merged=functools.partial(run.set_dataset_stage, stage=RunDataset.MERGED))
+        run.datasets.filter(stage=RunDataset.IMPORTED).update(stage=RunDataset.MERGED)  # Failed imports stay downloaded
+        run.finished = timezone.now()
+        run.set_stage(Run.FINISHED)
+        log_time(start, 'merging complete')
+        start = datetime.now()
+        total_count = Statistic.objects.set_total_count(RecordCount.objects.total())
+        Statistic.objects.set_generation()  # Cached responses are revalidated against it, cached pages go stale
+        result_cache.clear()  # Frees what the stale pages took, for the backends shared between processes
+        log_time(start, 'finished! total  count now set {}'.format(total_count))
+
+    def list_datasets(self, run):
+        # Datasets already listed by a run which is being resumed keep their state, sync_dataset has already updated them
+        dataset_list = [{'key': run.dataset_key}] if run.dataset_key else _gbif_api.get_dataset_list()
+        listed = set(run.datasets.values_list('dataset_key', flat=True))
 
-        # Skip some datasets
+        # Skip some datasets, unless one was asked for by name
         big = {
                'crop wild relatives, global': '07044577-bd82-4089-9f3a-f4a9d2170b2e',
                'artsobs': 'b124e1e0-4755-430f-9eab-894f25a9b59c',
                'Visuelle undersøkelser - petroleumsvirksomhet': 'b6b4502f-ffc8-4048-a91b-af502288faa8'
                }
 
-        # Set up for import
-        if not options['skip']:
-            create_duplicates_file()
-            reset_import_table()
-        dataset_ids = []
-        unchanged_dataset_ids = []
-        overall_start = datetime.now()
-
-        # Iterate over GBIF datasets
-        for dataset in dataset_list:
-            if options['skip'] or dataset['key'] in big.values():
-                self.logger.info('skip')
-                continue
-            start = datetime.now()
-
-            # Get dataset details
-            dataset_details = _gbif_api.get_dataset_detailed_info(dataset['key'])
+        # Iterate over GBIF datasets, with their details fetched concurrently up front
+        dataset_list = [dataset for dataset in dataset_list if (run.dataset_key or dataset['key'] not in big.values()) and dataset['key'] not in listed]
+        start = datetime.now()
+        all_dataset_details = _gbif_api.get_datasets_detailed_info([dataset['key'] for dataset in dataset_list])
+        log_time(start, f'fetched details for {len(dataset_list)} datasets')
+        for dataset, dataset_details in zip(dataset_list, all_dataset_details):
+            if not dataset_details and run.dataset_key:
+                raise CommandError(f'Could not get dataset {run.dataset_key} from GBIF')
             endpoint = _gbif_api.get_dwc_endpoint(dataset_details['endpoints'])
             self.logger.info(dataset_details['title'])
 
+            if not endpoint and run.dataset_key:
+                raise CommandError(f'Dataset {run.dataset_key} has no Darwin Core archive')
             if not endpoint:
                 self.logger.info('Metadata only dataset, skipping')
                 continue
-            if not sync_dataset(dataset_details):
+            if not sync_dataset(dataset_details) and not run.dataset_key:
                 self.logger.info('Dataset is unchanged, skipping')
-                dataset_ids.append(dataset['key'])
-                unchanged_dataset_ids.append(dataset['key'])
+                RunDataset.objects.create(run=run, dataset_key=dataset['key'], unchanged=True, stage=RunDataset.IMPORTED)
                 continue
 
             self.logger.info(endpoint['url'])
-
-            stored = _gbif_api.get_dwca_and_store_as_tmp_zip(endpoint['url'])
-            if stored:
-                _migration_processing.import_dwca(dataset['key'])
+            RunDataset.objects.create(run=run, dataset_key=dataset['key'], url=endpoint['url'])
+
+    def ingest(self, run, options):
+        # Anything a stopped run had imported of a dataset which it had not finished is thrown away
+        to_import = run.datasets.filter(unchanged=False, stage__in=[RunDataset.LISTED, RunDataset.DOWNLOADED]).order_by('id')
+        archives = [(dataset.dataset_key, dataset.url) for dataset in to_import]
+        ResolvableObjectMigration.objects.filter(dataset_id__in=[dataset_key for dataset_key, url in archives]).delete()
+
+        # Download and import, with the next archives being downloaded while the current one is imported
+        disk_budget = options['disk_budget'] * 1024 * 1024 if options['disk_budget'] else None
+        archive_cache = None
+        if options['archive_cache']:
+            archive_cache = _archive_cache.ArchiveCache(options['archive_cache'], max_bytes=options['archive_cache_size'] * 1024 * 1024)
+            prefetcher = _prefetch.ArchivePrefetcher(workers=options['prefetch'], disk_budget=disk_budget, download=archive_cache.fetch, discard=archive_cache.release)
+        else:
+            prefetcher = _prefetch.ArchivePrefetcher(download_dir=options['download_dir'], workers=options['prefetch'], disk_budget=disk_budget)
+        duplicates = _migration_processing.DuplicateLog(os.path.join(options['duplicates_dir'], f'run-{run.id}'), payloads=options['duplicate_payloads'])
+        start = datetime.now()
+        to_import = archives_to_import(run, prefetcher, prefetcher.fetch(archives), archive_cache)
+        for dataset_key, count in _parallel_import.import_archives(to_import, workers=options['import_workers'], duplicates=duplicates):
+            if count is None:
+                # Left as downloaded, so the merge does not take its records for deleted and a resumed run tries again.
+                # Whatever it got into the migration table before failing is thrown away, a --skip run would merge it
+                self.logger.error(f'import of dataset {dataset_key} failed, its records are left as they are')
+                ResolvableObjectMigration.objects.filter(dataset_id=dataset_key).delete()
+                forget_modified(dataset_key)
             else:
-                self.logger.info(f"Could not download dataset {dataset['key']}")
-            dataset_ids.append(dataset['key'])
-            log_time(start, f"fin inserting dataset {dataset['key']}")
-
-        log_time(overall_start, f'finished all datasets {len(dataset_ids)}, merging in starts next')
-
-        if not options['skip']:
+                if archive_cache and count:
+                    archive_cache.mark_imported(dataset_key)
+                run.set_dataset_stage(dataset_key, RunDataset.IMPORTED)
+            prefetcher.release(dataset_key)
+            log_time(start, f"fin inserting dataset {dataset_key}")
             start = datetime.now()
-            _cache_data.sync_datasets(dataset_ids)
-            log_time(start, 'caching complete')
-
-        start = datetime.now()
-        _cache_data.merge_in_new_data(skipped_datasets=unchanged_dataset_ids)
-        log_time(start, 'merging complete')
-        start = datetime.now()
-        total_count = Statistic.objects.set_total_count()
-        log_time(start, 'finished! total  count now set {}'.format(total_count))
 
 
-def create_duplicates_file(file='/srv/duplicates.txt'):
-    with open(file, 'w') as f:
-        f.write('id|new_data|new_datasetid|new_coretype|old_data|old_datasetid\n')
+def archives_to_import(run, prefetcher, fetched, archive_cache):
+    # Passes on the downloaded archives which need importing, the others are released straight away
+    logger = logging.getLogger(__name__)
+    for dataset_key, zip_file_location in fetched:
+        if not zip_file_location:
+            logger.info(f"Could not download dataset {dataset_key}")  # Stays listed, so a resumed run tries again
+        elif archive_cache and archive_cache.is_unchanged(dataset_key):
+            logger.info('Archive is identical to the one imported last time, skipping')
+            run.set_dataset_stage(dataset_key, RunDataset.IMPORTED, unchanged=True)
+        else:
+            run.set_dataset_stage(dataset_key, RunDataset.DOWNLOADED)
+            yield dataset_key, zip_file_location
+            continue
+        prefetcher.release(dataset_key)
 
 
 def sync_dataset(dataset):
@@ -91,7 +174,7 @@ def sync_dataset(dataset):
     del dataset['title'], dataset['doi']
     try:
         dataset_object = Dataset.objects.get(id=key)
-        if dataset_object.data['modified'] == dataset['modified']:
+        if dataset_object.data.get('modified') == dataset['modified']:
             return False
         dataset_object.data = dataset
         dataset_object.save()
@@ -100,6 +183,14 @@ def sync_dataset(dataset):
     return dataset_object
 
 
+def forget_modified(dataset_key):
+    # The dataset was synced when it was listed, without its modified date the next run takes it as changed and
+    # imports it again
+    for dataset in Dataset.objects.filter(id=dataset_key):
+        dataset.data.pop('modified', None)
+        dataset.save(update_fields=['data'])
+
+
 def reset_import_table():
     with connection.cursor() as cursor:
         cursor.execute('TRUNCATE populator_resolvableobjectmigration')
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+from populator.models import RecordCount, Statistic
+from website import result_cache
+from populator.management.commands import _rebuild
+
+
+class Command(BaseCommand):
+    help = 'Swaps back in the generation of the resolver table which the last populate_resolver --rebuild replaced'
+
+    def handle(self, *args, **options):
+        if not _rebuild.has_previous_generation():
+            raise CommandError(f'There is no {_rebuild.PREVIOUS} table to roll back to')
+        _rebuild.rollback()
+        total_count = Statistic.objects.set_total_count(RecordCount.objects.total())
+        Statistic.objects.set_generation()
+        result_cache.clear()
+        self.stdout.write(f'Rolled back, total count now {total_count}')
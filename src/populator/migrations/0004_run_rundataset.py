@@ -0,0 +1,39 @@
+# Generated by Django 3.1.14 on 2026-10-18 15:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('populator', '0003_auto_20230103_1620'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Run',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(default='listing', max_length=20)),
+                ('started', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('merge_last_id', models.CharField(blank=True, max_length=200, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RunDataset',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dataset_key', models.CharField(max_length=200)),
+                ('url', models.TextField(blank=True, null=True)),
+                ('unchanged', models.BooleanField(default=False)),
+                ('stage', models.CharField(default='listed', max_length=20)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='datasets', to='populator.run')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='rundataset',
+            constraint=models.UniqueConstraint(fields=('run', 'dataset_key'), name='one_dataset_per_run'),
+        ),
+    ]
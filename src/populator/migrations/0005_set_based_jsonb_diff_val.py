@@ -0,0 +1,59 @@
+from django.db import migrations
+
+# The original function from jsonb_diff_val.py, kept as jsonb_diff_val_plpgsql to compare against
+PLPGSQL_BODY = ("(val1 JSONB, val2 JSONB)"
+                " RETURNS JSONB AS $$"
+                " DECLARE"
+                "   result JSONB;"
+                "   v RECORD;"
+                " BEGIN"
+                "    result = val1;"
+                "    FOR v IN SELECT * FROM jsonb_each(val2) LOOP"
+                "      IF result @> jsonb_build_object(v.key,v.value)"
+                "         THEN result = result - v.key;"
+                "      ELSIF result ? v.key THEN CONTINUE;"
+                "      ELSE"
+                "         result = result || jsonb_build_object(v.key, NULL);"
+                "      END IF;"
+                "    END LOOP;"
+                "    RETURN result;"
+                " END;"
+                " $$ LANGUAGE plpgsql;")
+
+# Same result as the plpgsql version: the keys of val1 whose value is not contained in val2, plus the keys only in
+# val2 set to null. Worked out as one set operation instead of building a new JSONB value for every key. Identical
+# objects are not taken apart at all, and plain values are compared with =, which for them is the same as @>.
+# Anything which is not a pair of objects goes to the plpgsql version, so odd input gives the same result as before
+SET_BASED = ("CREATE OR REPLACE FUNCTION jsonb_diff_val(val1 JSONB, val2 JSONB)"
+             " RETURNS JSONB AS $$"
+             "   SELECT CASE"
+             "     WHEN val1 IS NULL THEN NULL"
+             "     WHEN val2 IS NULL THEN val1"
+             "     WHEN val1 = val2 AND jsonb_typeof(val1) = 'object' THEN '{}'::jsonb"
+             "     WHEN jsonb_typeof(val1) <> 'object' OR jsonb_typeof(val2) <> 'object' THEN jsonb_diff_val_plpgsql(val1, val2)"
+             "     ELSE COALESCE((SELECT jsonb_object_agg(diff.key, diff.value) FROM ("
+             "       SELECT old.key, old.value FROM jsonb_each(val1) AS old"
+             "       WHERE NOT val2 ? old.key"
+             "          OR (old.value IS DISTINCT FROM val2 -> old.key"
+             "              AND (jsonb_typeof(old.value) NOT IN ('object', 'array')"
+             "                   OR NOT jsonb_build_object(old.key, old.value) @> jsonb_build_object(old.key, val2 -> old.key)))"
+             "       UNION ALL"
+             "       SELECT new.key, 'null'::jsonb FROM jsonb_each(val2) AS new"
+             "       WHERE NOT val1 ? new.key"
+             "     ) AS diff), '{}'::jsonb)"
+             "   END"
+             " $$ LANGUAGE sql IMMUTABLE;")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('populator', '0004_run_rundataset'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            ['CREATE OR REPLACE FUNCTION jsonb_diff_val_plpgsql' + PLPGSQL_BODY, SET_BASED],
+            ['CREATE OR REPLACE FUNCTION jsonb_diff_val' + PLPGSQL_BODY, 'DROP FUNCTION IF EXISTS jsonb_diff_val_plpgsql(JSONB, JSONB);'],
+        ),
+    ]
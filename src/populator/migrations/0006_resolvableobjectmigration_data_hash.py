@@ -0,0 +1,27 @@
+# Generated by Django 3.1.14 on 2026-10-18 15:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('populator', '0005_set_based_jsonb_diff_val'),
+        ('website', '0005_resolvableobject_data_hash'),  # For set_data_hash()
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resolvableobjectmigration',
+            name='data_hash',
+            field=models.CharField(blank=True, editable=False, max_length=32, null=True),
+        ),
+        migrations.RunSQL(
+            'CREATE TRIGGER populator_resolvableobjectmigration_data_hash BEFORE INSERT OR UPDATE OF data ON populator_resolvableobjectmigration FOR EACH ROW EXECUTE PROCEDURE set_data_hash();',
+            'DROP TRIGGER IF EXISTS populator_resolvableobjectmigration_data_hash ON populator_resolvableobjectmigration;'
+        ),
+        migrations.AddIndex(
+            model_name='resolvableobjectmigration',
+            index=models.Index(fields=['id', 'data_hash'], name='populator_migration_hash_idx'),
+        ),
+    ]
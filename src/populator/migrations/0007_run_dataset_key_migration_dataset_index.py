@@ -0,0 +1,22 @@
+# Generated by Django 3.1.14 on 2026-10-18 16:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('populator', '0006_resolvableobjectmigration_data_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='run',
+            name='dataset_key',
+            field=models.CharField(blank=True, max_length=200, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='resolvableobjectmigration',
+            index=models.Index(fields=['dataset_id', 'id'], name='populator_mig_dataset_idx'),
+        ),
+    ]
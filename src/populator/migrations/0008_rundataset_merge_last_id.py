@@ -0,0 +1,22 @@
+# Generated by Django 3.1.14 on 2026-10-18 16:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('populator', '0007_run_dataset_key_migration_dataset_index'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='run',
+            name='merge_last_id',
+        ),
+        migrations.AddField(
+            model_name='rundataset',
+            name='merge_last_id',
+            field=models.CharField(blank=True, max_length=200, null=True),
+        ),
+    ]
@@ -0,0 +1,144 @@
+from django.contrib.postgres.indexes import BrinIndex
+from django.db import connection, migrations, models, transaction
+import django.db.models.deletion
+from datetime import date
+import re
+
+# The statements are written out here rather than taken from _history and website.tables, so the migration keeps doing
+# what it did when it was written however those modules change
+TABLE = 'populator_history'
+CONVERTING = TABLE + '_converting'
+SUFFIX = '_converting'
+BATCH_SIZE = 50000
+
+
+def add_months(day, months):
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def copy_indexes_constraints_and_triggers(cursor):
+    # The primary key of a partitioned table has to include the partition key, it is added by convert()
+    cursor.execute("""SELECT pg_index.indexrelid::regclass::text, pg_get_indexdef(pg_index.indexrelid), pg_constraint.contype
+                      FROM pg_index
+                      LEFT JOIN pg_constraint ON pg_constraint.conindid = pg_index.indexrelid AND pg_constraint.conrelid = pg_index.indrelid
+                      WHERE pg_index.indrelid = %s::regclass""", [TABLE])
+    for name, definition, constraint_type in cursor.fetchall():
+        if name == f'{TABLE}_pkey':
+            continue
+        if constraint_type:
+            cursor.execute('SELECT pg_get_constraintdef(oid) FROM pg_constraint WHERE conindid = %s::regclass AND conrelid = %s::regclass',
+                           [name, TABLE])
+            cursor.execute(f'ALTER TABLE {CONVERTING} ADD CONSTRAINT {name}{SUFFIX} {cursor.fetchone()[0]}')
+        else:
+            cursor.execute(re.sub(r'^(CREATE (?:UNIQUE )?INDEX) \S+ ON (?:ONLY )?\S+ ', rf'\1 {name}{SUFFIX} ON {CONVERTING} ', definition))
+
+    # Foreign keys of a partitioned table are inherited by its partitions, which have conparentid set
+    cursor.execute("""SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+                      WHERE conrelid = %s::regclass AND contype NOT IN ('p', 'u', 'x', 'n') AND conparentid = 0""", [TABLE])
+    for name, definition in cursor.fetchall():
+        cursor.execute(f'ALTER TABLE {CONVERTING} ADD CONSTRAINT {name} {definition}')
+
+    cursor.execute('SELECT pg_get_triggerdef(oid) FROM pg_trigger WHERE tgrelid = %s::regclass AND NOT tgisinternal', [TABLE])
+    for definition, in cursor.fetchall():
+        cursor.execute(re.sub(r' ON \S+ ', f' ON {CONVERTING} ', definition, count=1))
+
+
+def swap():
+    # No foreign keys reference the history table, so it is dropped and the copy renamed in its place with its
+    # indexes and partitions
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SET LOCAL lock_timeout = '10s'")
+        cursor.execute(f'DROP TABLE {TABLE}')
+        cursor.execute('SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = %s::regclass', [CONVERTING])
+        for index, in cursor.fetchall():
+            cursor.execute(f'ALTER INDEX {index} RENAME TO {index[:-len(SUFFIX)]}')
+        cursor.execute('SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = %s::regclass', [CONVERTING])
+        for partition, in cursor.fetchall():
+            new_partition = TABLE + partition[len(CONVERTING):]
+            cursor.execute('SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = %s::regclass', [partition])
+            for index, in cursor.fetchall():
+                if index.startswith(partition):
+                    cursor.execute(f'ALTER INDEX {index} RENAME TO {new_partition}{index[len(partition):]}')
+            cursor.execute(f'ALTER TABLE {partition} RENAME TO {new_partition}')
+        cursor.execute(f'ALTER TABLE {CONVERTING} RENAME TO {TABLE}')
+
+
+def convert(partitioned):
+    # Copies the table into a new one in batches which each commit on their own, then swaps it in. Only
+    # populate_resolver writes history, it must not run until the migration is done. Partitioned, it has a partition
+    # for each month from the first one with history to the next one, and a default partition
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {CONVERTING}')
+        partition_by = ' PARTITION BY RANGE (changed_date)' if partitioned else ''
+        cursor.execute(f'CREATE TABLE {CONVERTING} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING STORAGE){partition_by}')
+        if partitioned:
+            cursor.execute(f'CREATE TABLE {CONVERTING}_default PARTITION OF {CONVERTING} DEFAULT')
+            cursor.execute(f'SELECT min(changed_date) FROM {TABLE}')
+            month = add_months(cursor.fetchone()[0] or date.today(), 0)
+            while month <= add_months(date.today(), 1):
+                cursor.execute(f"""CREATE TABLE {CONVERTING}_{month:%Y_%m} PARTITION OF {CONVERTING}
+                                   FOR VALUES FROM ('{month}') TO ('{add_months(month, 1)}')""")
+                month = add_months(month, 1)
+
+        last_id = 0
+        while last_id is not None:
+            cursor.execute(f"""WITH batch AS (
+                                   INSERT INTO {CONVERTING} SELECT * FROM {TABLE} WHERE id > %s ORDER BY id LIMIT %s
+                                   RETURNING id
+                               )
+                               SELECT max(id) FROM batch""", [last_id, BATCH_SIZE])
+            last_id = cursor.fetchone()[0]
+
+        copy_indexes_constraints_and_triggers(cursor)
+        primary_key = 'id, changed_date' if partitioned else 'id'
+        cursor.execute(f'ALTER TABLE {CONVERTING} ADD CONSTRAINT {TABLE}_pkey{SUFFIX} PRIMARY KEY ({primary_key})')
+        # The id sequence would be dropped with the table which owns it
+        cursor.execute(f"SELECT pg_get_serial_sequence('{TABLE}', 'id')")
+        cursor.execute(f'ALTER SEQUENCE {cursor.fetchone()[0]} OWNED BY {CONVERTING}.id')
+    swap()
+    with connection.cursor() as cursor:
+        cursor.execute(f'ANALYZE {TABLE}')
+
+
+def partition(apps, schema_editor):
+    convert(partitioned=True)
+
+
+def unpartition(apps, schema_editor):
+    convert(partitioned=False)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('website', '0007_partition_resolvableobject'),
+        ('populator', '0008_rundataset_merge_last_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition, unpartition),
+        # The (resolvable_object, changed_date) index takes over from the foreign key index. Dropped by name, as
+        # AlterField would also drop and recreate the foreign key, which it cannot find on a partitioned table
+        migrations.SeparateDatabaseAndState(
+            database_operations=[migrations.RunSQL(
+                [f'DROP INDEX IF EXISTS {TABLE}_resolvable_object_id_067ca1f0', f'DROP INDEX IF EXISTS {TABLE}_resolvable_object_id_067ca1f0_like'],
+                [f'CREATE INDEX {TABLE}_resolvable_object_id_067ca1f0 ON {TABLE} (resolvable_object_id)',
+                 f'CREATE INDEX {TABLE}_resolvable_object_id_067ca1f0_like ON {TABLE} (resolvable_object_id varchar_pattern_ops)'],
+            )],
+            state_operations=[migrations.AlterField(
+                model_name='history',
+                name='resolvable_object',
+                field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, to='website.resolvableobject'),
+            )],
+        ),
+        migrations.AddIndex(
+            model_name='history',
+            index=models.Index(fields=['resolvable_object', 'changed_date'], name='populator_hist_object_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='history',
+            index=BrinIndex(fields=['changed_date'], name='populator_hist_date_brin'),
+        ),
+    ]
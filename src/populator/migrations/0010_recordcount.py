@@ -0,0 +1,36 @@
+# Generated by Django 3.1.14 on 2026-10-18 16:39
+
+from django.db import migrations, models
+
+
+# Counted here rather than by _statistics.recount(), so the migration keeps doing what it did when it was written
+COUNT_RECORDS = """INSERT INTO populator_recordcount (dataset_id, type, basisofrecord, deleted, count)
+                   SELECT dataset_id, type, COALESCE(data ->> 'basisofrecord', ''), deleted_date IS NOT NULL, count(*)
+                   FROM website_resolvableobject
+                   GROUP BY 1, 2, 3, 4"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('populator', '0009_partition_history'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecordCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dataset_id', models.CharField(max_length=200)),
+                ('type', models.CharField(max_length=200)),
+                ('basisofrecord', models.TextField(blank=True, default='')),
+                ('deleted', models.BooleanField()),
+                ('count', models.BigIntegerField()),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='recordcount',
+            constraint=models.UniqueConstraint(fields=('dataset_id', 'type', 'basisofrecord', 'deleted'), name='populator_recordcount_key'),
+        ),
+        migrations.RunSQL(COUNT_RECORDS, migrations.RunSQL.noop),
+    ]
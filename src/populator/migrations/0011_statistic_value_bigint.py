@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-18 16:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('populator', '0010_recordcount'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='statistic',
+            name='value',
+            field=models.BigIntegerField(),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.14 on 2026-10-18 17:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('populator', '0011_statistic_value_bigint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='run',
+            name='rebuild',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.1.14 on 2026-10-18 17:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('populator', '0012_run_rebuild'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DroppedIndex',
+            fields=[
+                ('name', models.CharField(max_length=63, primary_key=True, serialize=False)),
+                ('table', models.CharField(max_length=63)),
+                ('definition', models.TextField()),
+            ],
+        ),
+    ]
@@ -1,6 +1,8 @@
 from django.db import models
 from django.db.models import JSONField
+from django.contrib.postgres.indexes import BrinIndex
 from website.models import ResolvableObject
+import time
 
 
 class ResolvableObjectMigration(models.Model):
@@ -9,14 +11,24 @@ class ResolvableObjectMigration(models.Model):
     data = JSONField()
     type = models.CharField(max_length=200)
     dataset_id = models.CharField(max_length=200)
+    data_hash = models.CharField(max_length=32, null=True, blank=True, editable=False)  # md5 of data, set by a trigger
+
+    class Meta:
+        indexes = [models.Index(fields=['id', 'data_hash'], name='populator_migration_hash_idx'),
+                   models.Index(fields=['dataset_id', 'id'], name='populator_mig_dataset_idx')]
 
 
 class History(models.Model):
-    resolvable_object = models.ForeignKey(ResolvableObject, on_delete=models.DO_NOTHING)
+    resolvable_object = models.ForeignKey(ResolvableObject, on_delete=models.DO_NOTHING, db_index=False)
     changed_data = JSONField()
     changed_date = models.DateField(auto_now=True)
     #models.UniqueConstraint(fields=['resolvable_object', 'changed_date'], name='one_ro_per_date')
 
+    class Meta:
+        # The table is partitioned by changed_date (migration 0009, see _history), so its primary key is (id, changed_date)
+        indexes = [models.Index(fields=['resolvable_object', 'changed_date'], name='populator_hist_object_date_idx'),
+                   BrinIndex(fields=['changed_date'], name='populator_hist_date_brin')]
+
 
 # Need to store count of dwc objects manually as it's too time consuming to calculate on the fly
 class StatisticsManager(models.Manager):
@@ -26,23 +38,117 @@ class StatisticsManager(models.Manager):
         except self.model.DoesNotExist:
             return self.set_total_count()
 
-    def set_total_count(self):
-        statistic, created = self.update_or_create(name='total_count', defaults={'value': ResolvableObject.objects.count()})
+    def set_total_count(self, value=None):
+        """Stores the number of records, counted in the resolver table unless it is given"""
+        if value is None:
+            value = ResolvableObject.objects.count()
+        statistic, created = self.update_or_create(name='total_count', defaults={'value': value})
         return statistic.value
 
-    def get_preserved_specimen_count(self):
-        try:
-            return self.get(name='total_count').value
-        except self.model.DoesNotExist:
-            return self.set_total_count()
+    def get_generation(self):
+        """The time the resolver data last changed, in seconds since the epoch, None if it was never populated"""
+        return self.filter(name='generation').values_list('value', flat=True).first()
 
-    def set_preserved_specimen_count(self):
-        statistic, created = self.update_or_create(name='preserved_specimen_count',
-                                                   defaults={'value': ResolvableObject.object.filter(data__basisofrecord='Preservedspecimen').count()})
-        return statistic.value
+    def set_generation(self):
+        """Marks the resolver data as changed now, the generation only ever goes up"""
+        generation = max(int(time.time()), (self.get_generation() or 0) + 1)
+        self.update_or_create(name='generation', defaults={'value': generation})
+        return generation
+
+    def get_preserved_specimen_count(self):
+        return RecordCount.objects.filter(basisofrecord__iexact='preservedspecimen').total()
 
 
 class Statistic(models.Model):
     name = models.CharField(primary_key=True, max_length=100)
-    value = models.IntegerField()
+    value = models.BigIntegerField()
     objects = StatisticsManager()
+
+
+class RecordCountQuerySet(models.QuerySet):
+    def total(self):
+        return self.aggregate(total=models.Sum('count'))['total'] or 0
+
+    def summary(self):
+        """Totals of active and deleted records, overall and by dataset, type and basis of record"""
+        summary = {'total': 0, 'active': 0, 'deleted': 0, 'datasets': {}, 'types': {}, 'basisofrecord': {}}
+        for dataset_id, type_, basisofrecord, deleted, count in self.values_list('dataset_id', 'type', 'basisofrecord', 'deleted', 'count'):
+            state = 'deleted' if deleted else 'active'
+            summary['total'] += count
+            summary[state] += count
+            for group, key in [('datasets', dataset_id), ('types', type_), ('basisofrecord', basisofrecord)]:
+                counts = summary[group].setdefault(key, {'active': 0, 'deleted': 0})
+                counts[state] += count
+        return summary
+
+
+# Counts of the records in the resolver by dataset, type, basis of record and whether they are deleted. The merge keeps
+# them up to date with the changes it makes, see _statistics. Records without a basis of record have it as ''
+class RecordCount(models.Model):
+    dataset_id = models.CharField(max_length=200)
+    type = models.CharField(max_length=200)
+    basisofrecord = models.TextField(blank=True, default='')
+    deleted = models.BooleanField()
+    count = models.BigIntegerField()
+    objects = RecordCountQuerySet.as_manager()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['dataset_id', 'type', 'basisofrecord', 'deleted'], name='populator_recordcount_key')]
+
+
+class RunManager(models.Manager):
+    def resumable(self):
+        """The latest run which did not finish, if any"""
+        return self.exclude(stage=Run.FINISHED).order_by('-started').first()
+
+
+# State of a populate_resolver run, so that a run which stopped can be resumed where it left off
+class Run(models.Model):
+    LISTING, INGESTING, MERGING, FINISHED = 'listing', 'ingesting', 'merging', 'finished'
+    stage = models.CharField(max_length=20, default=LISTING)
+    started = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    dataset_key = models.CharField(max_length=200, null=True, blank=True)  # Set when only this dataset is refreshed
+    rebuild = models.BooleanField(default=False)  # Merged by rebuilding the resolver table, which a resume carries on with
+    objects = RunManager()
+
+    def set_stage(self, stage):
+        self.stage = stage
+        self.save(update_fields=['stage'])
+
+    def set_dataset_stage(self, dataset_key, stage, **fields):
+        self.datasets.filter(dataset_key=dataset_key).update(stage=stage, **fields)
+
+    def checkpoint_merge(self, dataset_key, last_id):
+        self.datasets.filter(dataset_key=dataset_key).update(merge_last_id=last_id)
+
+    def merge_positions(self):
+        """The id the merge of each dataset carries on after"""
+        return dict(self.datasets.filter(merge_last_id__isnull=False).values_list('dataset_key', 'merge_last_id'))
+
+    def datasets_to_merge(self):
+        """Keys of the datasets this run imported, or None for a --skip run which merges the whole migration table"""
+        if not self.dataset_key and not self.datasets.exists():
+            return None
+        return list(self.datasets.filter(unchanged=False, stage=RunDataset.IMPORTED).values_list('dataset_key', flat=True))
+
+
+class RunDataset(models.Model):
+    LISTED, DOWNLOADED, IMPORTED, MERGED = 'listed', 'downloaded', 'imported', 'merged'
+    run = models.ForeignKey(Run, on_delete=models.CASCADE, related_name='datasets')
+    dataset_key = models.CharField(max_length=200)
+    url = models.TextField(null=True, blank=True)
+    unchanged = models.BooleanField(default=False)  # Not imported, its records are kept as they are
+    stage = models.CharField(max_length=20, default=LISTED)
+    merge_last_id = models.CharField(max_length=200, null=True, blank=True)  # High-water mark of its merge batches
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['run', 'dataset_key'], name='one_dataset_per_run')]
+
+
+# Definitions of the indexes a merge dropped to build them again afterwards, kept until they are, so that one which stopped
+# in between can be built again by the next merge (see _cache_data.restore_data_index)
+class DroppedIndex(models.Model):
+    name = models.CharField(max_length=63, primary_key=True)
+    table = models.CharField(max_length=63)
+    definition = models.TextField()  # As given by pg_get_indexdef
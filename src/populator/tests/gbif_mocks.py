@@ -0,0 +1,22 @@
+import responses
+
+# Responses of the GBIF API and the archives of two datasets, for the tests which run populate_resolver from the
+# listing of the datasets on. Called in tests decorated with @responses.activate
+GBIF_API_DATASET_URL = 'https://api.gbif.org/v1/dataset/{}'
+SMALL_TEST_FILE = 'populator/tests/mock_data/dwca-seabird_estimates-v1.0.zip'
+SMALL_TEST_FILE_B = 'populator/tests/mock_data/dwca-molltax-v1.195.zip'
+DATASET_URLS = ['http://data.gbif.no/archive.do?r=dataset', 'http://data.gbif.no/archive.do?r=datasetb']
+
+
+def mock_two_datasets():
+    """Mocks the listing and the archives of two datasets, of 20191 and 23227 records, returns their archive urls"""
+    mock_datasets = [{'title': 'A', 'doi': 'doi:mine', 'key': 'd34ed8a4-d3cb-473c-a11c-79c5fec4d649', 'modified': '2021-01-05T08:24:15.254+0000'},
+                     {'title': 'B', 'doi': 'doi:mine', 'key': 'a34ed8a4-d3cb-473c-a11c-79c5fec4d640', 'modified': '2021-01-05T08:24:15.254+0000'}]
+    mock_json = {'offset': 0, 'limit': 200, 'endOfRecords': 1, 'count': 2, 'results': mock_datasets}
+    responses.add(responses.GET, GBIF_API_DATASET_URL.format('search?limit=1000&offset=0&publishingCountry=NO'), json=mock_json, status=200)
+    for dataset, url, test_file in zip(mock_datasets, DATASET_URLS, [SMALL_TEST_FILE, SMALL_TEST_FILE_B]):
+        details = dict(dataset, endpoints=[{'type': 'DWC_ARCHIVE', 'url': url}])
+        responses.add(responses.GET, GBIF_API_DATASET_URL.format(dataset['key']), json=details, status=200)
+        with open(test_file, 'rb') as dwc_zip_stream:
+            responses.add(responses.GET, url, body=dwc_zip_stream.read(), status=200, content_type='application/zip', stream=True)
+    return list(DATASET_URLS)
@@ -0,0 +1,110 @@
+from populator.management.commands._archive_cache import ArchiveCache
+from django.test import SimpleTestCase
+import os
+import responses
+import shutil
+import tempfile
+
+
+class ArchiveCacheTest(SimpleTestCase):
+    URL = 'http://data.gbif.no/archive.do?r=dataset'
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _mock_archive(self, body=b'archive', status=200, headers=None):
+        responses.add(responses.GET, self.URL, body=body, status=status, headers=headers or {'ETag': '"v1"', 'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+
+    @responses.activate
+    def test_stores_archive_and_metadata(self):
+        self._mock_archive()
+        cache = ArchiveCache(self.cache_dir)
+        zip_file_location = cache.fetch('a', self.URL)
+        with open(zip_file_location, 'rb') as f:
+            self.assertEqual(f.read(), b'archive')
+        self.assertFalse(cache.is_unchanged('a'))
+        entry = ArchiveCache(self.cache_dir)._index['a']  # Index survives between runs
+        self.assertEqual(entry['etag'], '"v1"')
+        self.assertEqual(entry['last_modified'], 'Wed, 21 Oct 2015 07:28:00 GMT')
+        self.assertEqual(entry['size'], 7)
+        self.assertEqual(len(entry['sha256']), 64)
+
+    @responses.activate
+    def test_sends_conditional_request_and_handles_not_modified(self):
+        self._mock_archive()
+        cache = ArchiveCache(self.cache_dir)
+        cache.fetch('a', self.URL)
+        cache.mark_imported('a')
+        responses.reset()
+        self._mock_archive(body=b'', status=304)
+
+        cache = ArchiveCache(self.cache_dir)
+        zip_file_location = cache.fetch('a', self.URL)
+        self.assertEqual(responses.calls[0].request.headers['If-None-Match'], '"v1"')
+        self.assertEqual(responses.calls[0].request.headers['If-Modified-Since'], 'Wed, 21 Oct 2015 07:28:00 GMT')
+        self.assertTrue(cache.is_unchanged('a'))
+        with open(zip_file_location, 'rb') as f:
+            self.assertEqual(f.read(), b'archive')
+
+    @responses.activate
+    def test_identical_bytes_are_unchanged(self):
+        self._mock_archive(headers={})
+        cache = ArchiveCache(self.cache_dir)
+        cache.fetch('a', self.URL)
+        cache.mark_imported('a')
+        cache.fetch('a', self.URL)
+        self.assertTrue(cache.is_unchanged('a'))
+
+    @responses.activate
+    def test_changed_bytes_are_changed(self):
+        self._mock_archive(body=b'one')
+        cache = ArchiveCache(self.cache_dir)
+        cache.fetch('a', self.URL)
+        cache.mark_imported('a')
+        responses.reset()
+        self._mock_archive(body=b'two')
+        zip_file_location = cache.fetch('a', self.URL)
+        self.assertFalse(cache.is_unchanged('a'))
+        with open(zip_file_location, 'rb') as f:
+            self.assertEqual(f.read(), b'two')
+
+    @responses.activate
+    def test_archive_that_was_never_imported_is_changed(self):
+        self._mock_archive()
+        cache = ArchiveCache(self.cache_dir)
+        cache.fetch('a', self.URL)
+        cache.fetch('a', self.URL)
+        self.assertFalse(cache.is_unchanged('a'))
+
+    @responses.activate
+    def test_failed_download_returns_none(self):
+        self._mock_archive(status=500)
+        cache = ArchiveCache(self.cache_dir)
+        with self.assertLogs():
+            self.assertIsNone(cache.fetch('a', self.URL))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    @responses.activate
+    def test_evicts_least_recently_used(self):
+        self._mock_archive(body=b'x' * 10)
+        cache = ArchiveCache(self.cache_dir, max_bytes=25)
+        for dataset_key in 'abc':
+            cache.fetch(dataset_key, self.URL)
+            cache.release(dataset_key)
+        self.assertEqual(sorted(cache._index.keys()), ['b', 'c'])
+        self.assertFalse(os.path.exists(cache.location('a')))
+        self.assertEqual(cache.size(), 20)
+
+    @responses.activate
+    def test_does_not_evict_archives_in_use(self):
+        self._mock_archive(body=b'x' * 10)
+        cache = ArchiveCache(self.cache_dir, max_bytes=15)
+        cache.fetch('a', self.URL)
+        cache.fetch('b', self.URL)
+        self.assertTrue(os.path.exists(cache.location('a')))
+        cache.release('a')
+        self.assertFalse(os.path.exists(cache.location('a')))
+        self.assertTrue(os.path.exists(cache.location('b')))
@@ -0,0 +1,47 @@
+from populator.management.commands._batching import AdaptiveBatchSize, keyset_batches
+from django.test import SimpleTestCase
+
+
+class AdaptiveBatchSizeTest(SimpleTestCase):
+    def test_grows_when_batches_are_fast(self):
+        batch_size = AdaptiveBatchSize(initial=1000, target_seconds=4)
+        batch_size.record(1000, 1)
+        self.assertEqual(batch_size.size, 2000)  # At most doubles
+
+    def test_shrinks_when_batches_are_slow(self):
+        batch_size = AdaptiveBatchSize(initial=1000, target_seconds=4, minimum=10)
+        batch_size.record(1000, 5)
+        self.assertEqual(batch_size.size, 800)
+        batch_size.record(800, 100)
+        self.assertEqual(batch_size.size, 400)  # At most halves
+
+    def test_stays_within_bounds(self):
+        batch_size = AdaptiveBatchSize(initial=1000, target_seconds=4, minimum=900, maximum=1500)
+        batch_size.record(1000, 0.1)
+        self.assertEqual(batch_size.size, 1500)
+        batch_size.record(1500, 100)
+        self.assertEqual(batch_size.size, 900)
+
+    def test_ignores_short_fast_batches(self):
+        batch_size = AdaptiveBatchSize(initial=1000, target_seconds=4)
+        batch_size.record(10, 0.1)
+        self.assertEqual(batch_size.size, 1000)
+
+
+class KeysetBatchesTest(SimpleTestCase):
+    def test_passes_last_key_of_previous_batch(self):
+        keys = list(range(25))
+        calls = []
+
+        def run_batch(last_key, limit):
+            calls.append((last_key, limit))
+            batch = [key for key in keys if last_key is None or key > last_key][:limit]
+            return (batch[-1] if batch else None), len(batch), sum(batch)
+
+        with self.assertLogs('populator.management.commands._batching'):
+            results = list(keyset_batches(run_batch, AdaptiveBatchSize(initial=10, minimum=10, maximum=10)))
+        self.assertEqual(calls, [(None, 10), (9, 10), (19, 10)])
+        self.assertEqual(sum(results), sum(keys))
+
+    def test_stops_when_there_are_no_rows(self):
+        self.assertEqual(list(keyset_batches(lambda last_key, limit: (None, 0, 0))), [])
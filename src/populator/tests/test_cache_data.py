@@ -1,5 +1,6 @@
 from populator.management.commands import _cache_data as cache_data
-from populator.models import History, ResolvableObjectMigration
+from populator.management.commands._batching import AdaptiveBatchSize
+from populator.models import DroppedIndex, History, ResolvableObjectMigration
 from django.test import TestCase, TransactionTestCase
 from datetime import date, timedelta
 from website.models import ResolvableObject, Dataset
@@ -7,6 +8,7 @@ from django.forms.models import model_to_dict
 from datetime import date
 from website.models import Dataset
 from django.db import connection
+from unittest import mock
 
 
 class SyncDatasetTest(TestCase):
@@ -49,26 +51,26 @@ class SyncDatasetTest(TestCase):
 class DeletedTimestampsTest(TestCase):
     def setUp(self):
         self.dataset = Dataset.objects.create(id='dataset_id', data={'title': 'My dataset'})
-
-    def test_does_not_add_deleted_datestamp_for_single_skipped_datasets(self):
         ResolvableObject.objects.create(id='1', data={'none': 'none'}, dataset=self.dataset, type='occurrence')
-        cache_data.add_deleted_timestamps_for_missing_records([self.dataset.id])
-        self.assertEqual(ResolvableObject.objects.first().deleted_date, None)
-
-    def test_does_not_add_deleted_datestamp_for_multiple_skipped_datasets(self):
-        ResolvableObject.objects.create(id='1', data={'none': 'none'}, dataset=self.dataset, type='occurrence')
-        cache_data.add_deleted_timestamps_for_missing_records([self.dataset.id, 'different_dataset_id'])
-        self.assertEqual(ResolvableObject.objects.first().deleted_date, None)
 
     def test_adds_deleted_datestamp(self):
-        ResolvableObject.objects.create(id='1', data={'none': 'none'}, dataset=self.dataset, type='occurrence')
-        cache_data.add_deleted_timestamps_for_missing_records(['different_dataset_id'])
+        self.assertEqual(cache_data.add_deleted_timestamps_for_missing_records(self.dataset.id), 1)
         self.assertEqual(ResolvableObject.objects.first().deleted_date, date.today())
 
-    def test_handles_empty_skipped_dataset_list(self):
-        ResolvableObject.objects.create(id='1', data={'none': 'none'}, dataset=self.dataset, type='occurrence')
-        cache_data.add_deleted_timestamps_for_missing_records([])
-        self.assertEqual(ResolvableObject.objects.first().deleted_date, date.today())
+    def test_does_not_add_deleted_datestamp_for_other_datasets(self):
+        self.assertEqual(cache_data.add_deleted_timestamps_for_missing_records('different_dataset_id'), 0)
+        self.assertEqual(ResolvableObject.objects.first().deleted_date, None)
+
+    def test_does_not_add_deleted_datestamp_for_imported_records(self):
+        ResolvableObjectMigration.objects.create(id='1', data={'none': 'none'}, dataset_id=self.dataset.id, type='occurrence')
+        cache_data.add_deleted_timestamps_for_missing_records(self.dataset.id)
+        self.assertEqual(ResolvableObject.objects.first().deleted_date, None)
+
+    def test_does_not_add_deleted_datestamp_for_ids_imported_with_another_dataset(self):
+        # The import skips ids another dataset imported first, the record is still published by its own dataset
+        ResolvableObjectMigration.objects.create(id='1', data={'none': 'none'}, dataset_id='different_dataset_id', type='occurrence')
+        self.assertEqual(cache_data.add_deleted_timestamps_for_missing_records(self.dataset.id), 0)
+        self.assertEqual(ResolvableObject.objects.first().deleted_date, None)
 
 
 class CacheDataTest(TransactionTestCase):
@@ -86,18 +88,99 @@ class CacheDataTest(TransactionTestCase):
     def assert_json_equal(self, iterable1, iterable2):  # Necessary as assertEqual does not compare json fields
         self.assertEqual([model_to_dict(x) for x in iterable1], [model_to_dict(x) for x in iterable2])
 
-    def test_create_temp_updated_table(self):
+    def test_upsert_batch(self):
         self.create_ro({'scientificname': 'same', 'location': 'old original'})
         self.create_ro_migration({'scientificname': 'same', 'location': 'new updated'})
         self.create_ro({'scientificname': 'same', 'location': 'same'}, id_='b')
         self.create_ro_migration({'scientificname': 'same', 'location': 'same'}, id_='b')
-        cache_data.create_temp_updated_table()
-        cache_data.populate_temp_updated_table(2, 0)
-        with connection.cursor() as cursor:
-            cursor.execute('SELECT * FROM temp_updated')
-            results = cursor.fetchall()
-        expected = [('a', '{"location": "old original"}', '{"location": "new updated", "scientificname": "same"}')]
-        self.assertEqual(results, expected)
+        self.create_ro_migration({'location': 'new'}, id_='c')
+        self.assertEqual(cache_data.upsert_batch(None, 3, self.dataset.id), ('c', 3, 1, 1))
+        self.assertEqual(list(History.objects.values_list('resolvable_object_id', 'changed_data')), [('a', {'location': 'old original'})])
+        self.assertEqual(ResolvableObject.objects.get(id='a').data, {'scientificname': 'same', 'location': 'new updated'})
+
+    def test_upsert_batch_continues_after_last_id(self):
+        for id_ in 'abc':
+            self.create_ro({'location': 'old'}, id_=id_)
+            self.create_ro_migration({'location': 'new'}, id_=id_)
+        self.assertEqual(cache_data.upsert_batch('a', 1, self.dataset.id), ('b', 1, 0, 1))
+        self.assertEqual([x.resolvable_object_id for x in History.objects.all()], ['b'])
+
+    def test_upsert_batch_only_records_history(self):
+        self.create_ro({'location': 'old'})
+        self.create_ro_migration({'location': 'new'})
+        self.create_ro_migration({'location': 'new'}, id_='b')
+        self.assertEqual(cache_data.upsert_batch(None, 2, self.dataset.id, history_only=True), ('b', 2, 0, 0))
+        self.assertEqual(History.objects.count(), 1)
+        self.assertEqual(list(ResolvableObject.objects.values_list('id', 'data')), [('a', {'location': 'old'})])
+
+    def test_merges_in_several_batches(self):
+        for id_ in 'abcdefg':
+            self.create_ro({'location': 'old'}, id_=id_)
+            self.create_ro_migration({'location': 'new'}, id_=id_)
+        cache_data.merge_in_new_data(batch_size=AdaptiveBatchSize(initial=3, minimum=3, maximum=3))
+        self.assertEqual(History.objects.count(), 7)
+        self.assertEqual(set(x.data['location'] for x in ResolvableObject.objects.all()), {'new'})
+
+    def test_checkpoints_each_batch_and_resumes_after_it(self):
+        for id_ in 'abcdef':
+            self.create_ro({'location': 'old'}, id_=id_)
+            self.create_ro_migration({'location': 'new'}, id_=id_)
+        checkpoints = []
+
+        def checkpoint(dataset_id, last_id):
+            checkpoints.append((dataset_id, last_id))
+            if last_id == 'd':
+                raise RuntimeError('stopped')
+
+        with self.assertRaises(RuntimeError), self.assertLogs():
+            cache_data.merge_in_new_data(batch_size=AdaptiveBatchSize(initial=2, minimum=2, maximum=2), checkpoint=checkpoint)
+        self.assertEqual(checkpoints, [('dataset_id', 'b'), ('dataset_id', 'd')])
+        self.assertEqual(History.objects.count(), 2)  # The batch which failed is rolled back with its checkpoint
+        cache_data.merge_in_new_data(batch_size=AdaptiveBatchSize(initial=2, minimum=2, maximum=2), start_after={'dataset_id': 'b'})
+        self.assertEqual(History.objects.count(), 6)
+        self.assertEqual(set(x.data['location'] for x in ResolvableObject.objects.all()), {'new'})
+
+    def test_calls_dataset_merged_with_the_deletions(self):
+        self.create_ro({'location': 'old'})
+        merged = []
+        cache_data.merge_in_new_data(dataset_merged=merged.append)
+        self.assertEqual(merged, ['dataset_id'])
+
+    def test_returns_counts_for_each_dataset(self):
+        other = Dataset.objects.create(id='other', data={'title': 'Other dataset'})
+        self.create_ro({'location': 'old'}, id_='a')
+        self.create_ro_migration({'location': 'new'}, id_='a')
+        self.create_ro({'location': 'old'}, id_='b')
+        self.create_ro({'location': 'same'}, id_='c')
+        self.create_ro_migration({'location': 'same'}, id_='c')
+        ResolvableObjectMigration.objects.create(id='d', type='occurrence', dataset_id=other.id, data={'location': 'new'})
+        counts = cache_data.merge_in_new_data()
+        self.assertEqual(counts, {'dataset_id': {'inserted': 0, 'updated': 1, 'deleted': 1},
+                                  'other': {'inserted': 1, 'updated': 0, 'deleted': 0}})
+
+    def test_merges_only_the_given_datasets(self):
+        other = Dataset.objects.create(id='other', data={'title': 'Other dataset'})
+        self.create_ro({'location': 'old'}, id_='a')
+        self.create_ro_migration({'location': 'new'}, id_='a')
+        self.create_ro({'location': 'old'}, id_='b')  # Missing from the new import
+        ResolvableObject.objects.create(id='c', type='occurrence', dataset=other, data={'location': 'old'})
+        ResolvableObjectMigration.objects.create(id='c', type='occurrence', dataset_id=other.id, data={'location': 'new'})
+        ResolvableObject.objects.create(id='d', type='occurrence', dataset=other, data={'location': 'old'})
+        ResolvableObjectMigration.objects.create(id='e', type='occurrence', dataset_id=other.id, data={'location': 'new'})
+        cache_data.merge_in_new_data(dataset_ids=[self.dataset.id])
+        self.assertEqual(ResolvableObject.objects.get(id='a').data, {'location': 'new'})
+        self.assertIsNotNone(ResolvableObject.objects.get(id='b').deleted_date)
+        self.assertEqual(ResolvableObject.objects.get(id='c').data, {'location': 'old'})
+        self.assertIsNone(ResolvableObject.objects.get(id='d').deleted_date)
+        self.assertFalse(ResolvableObject.objects.filter(id='e').exists())
+        self.assertEqual([x.resolvable_object_id for x in History.objects.all()], ['a'])
+
+    def test_merges_nothing_if_no_datasets_are_given(self):
+        self.create_ro({'location': 'old'}, id_='a')
+        self.create_ro_migration({'location': 'new'}, id_='b')
+        with self.assertLogs():
+            self.assertEqual(cache_data.merge_in_new_data(dataset_ids=[]), {})
+        self.assertEqual(list(ResolvableObject.objects.values_list('id', 'deleted_date')), [('a', None)])
 
     def test_records_old_version_of_modified_data_items_in_history_table(self):
         self.create_ro({'scientificname': 'same', 'location': 'old original'})
@@ -142,6 +225,14 @@ class CacheDataTest(TransactionTestCase):
         cache_data.merge_in_new_data()
         self.assertEqual(list(History.objects.all()), [])
 
+    def test_only_compares_records_with_a_different_data_hash(self):
+        self.create_ro({'location': 'old'})
+        self.create_ro_migration({'location': 'new'})
+        with connection.cursor() as cursor:  # Only changes to data update the hash, so this makes them look the same
+            cursor.execute("UPDATE website_resolvableobject SET data_hash = (SELECT data_hash FROM populator_resolvableobjectmigration)")
+        cache_data.merge_in_new_data()
+        self.assertEqual(list(History.objects.all()), [])
+
     def test_new_entry_does_not_add_to_history_table(self):
         self.create_ro_migration({'new_record_added_to_dataset': 'should not be included in history'})
         cache_data.merge_in_new_data()
@@ -167,7 +258,7 @@ class CacheDataTest(TransactionTestCase):
             ResolvableObject(id='a', data={'new_record': 'new'}, type='occurrence', dataset=self.dataset),
             ResolvableObject(id='b', data={'new_record': 'new'}, type='occurrence', dataset=self.dataset),
         ]
-        self.assert_json_equal(ResolvableObject.objects.all(), expected)
+        self.assert_json_equal(ResolvableObject.objects.order_by('id'), expected)
 
     def test_adds_deleted_datestamp_for_removed_records_in_resolvable_object_table(self):
         self.create_ro({'no_change': 'same'})
@@ -175,12 +266,30 @@ class CacheDataTest(TransactionTestCase):
         expected = ResolvableObject(id='a', data={'no_change': 'same'}, deleted_date=date.today(), type='occurrence', dataset=self.dataset)
         self.assert_json_equal(ResolvableObject.objects.all(), [expected])
 
+    def test_keeps_record_whose_id_another_dataset_imported_first(self):
+        # As left by an import in which the other dataset took the id, the import skips this dataset's copy of it
+        Dataset.objects.create(id='other', data={'title': 'Other dataset'})
+        self.create_ro({'location': 'mine'})
+        ResolvableObjectMigration.objects.create(id='a', type='occurrence', dataset_id='other', data={'location': 'theirs'})
+        counts = cache_data.merge_in_new_data()
+        self.assertEqual(counts['dataset_id']['deleted'], 0)
+        record = ResolvableObject.objects.get()
+        self.assertEqual((record.dataset_id, record.data, record.deleted_date), ('dataset_id', {'location': 'mine'}, None))
+
     def test_does_not_overwrite_preexisting_deleted_datestamps(self):
         past_date_d = date.today() - timedelta(days=4)
         ResolvableObject.objects.create(id='1', data={'none': 'none'}, deleted_date=past_date_d, dataset=self.dataset, type='occurrence')
         cache_data.merge_in_new_data()
         self.assertEqual(ResolvableObject.objects.first().deleted_date, past_date_d)
 
+    def test_undeletes_record_which_is_added_again_unchanged(self):
+        self.create_ro({'key': 'value'})
+        cache_data.merge_in_new_data()
+        self.create_ro_migration({'key': 'value'})
+        cache_data.merge_in_new_data()
+        self.assertEqual(ResolvableObject.objects.get().deleted_date, None)
+        self.assertEqual(list(History.objects.all()), [])
+
     def test_record_is_deleted_and_then_gets_added_again(self):
         # I have no idea what to do here. For the moment we can assume it's a blip and remove the deleted date again?
         self.create_ro({'key': 'value'})
@@ -190,3 +299,82 @@ class CacheDataTest(TransactionTestCase):
         cache_data.merge_in_new_data()
         self.assertEqual(ResolvableObject.objects.count(), 1)
         self.assertEqual(ResolvableObject.objects.first().deleted_date, None)
+
+
+class DataIndexStrategyTest(TransactionTestCase):
+    def setUp(self):
+        self.dataset = Dataset.objects.create(id='dataset_id', data={'title': 'My dataset'})
+        for i in range(20):
+            ResolvableObject.objects.create(id=f'old{i}', type='occurrence', dataset=self.dataset, data={'location': 'same'})
+            ResolvableObjectMigration.objects.create(id=f'old{i}', type='occurrence', dataset_id=self.dataset.id, data={'location': 'same'})
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE website_resolvableobject')
+
+    def _index(self):
+        with connection.cursor() as cursor:
+            cursor.execute("""SELECT indisvalid, (SELECT count(*) FROM pg_inherits WHERE inhparent = indexrelid) FROM pg_index
+                              WHERE indexrelid = to_regclass(%s)""", [cache_data.DATA_INDEX])
+            return cursor.fetchone()
+
+    def _reloptions(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT DISTINCT reloptions FROM pg_class INNER JOIN pg_inherits ON inhrelid = pg_class.oid WHERE inhparent = %s::regclass',
+                           [cache_data.DATA_INDEX])
+            return cursor.fetchall()
+
+    def test_rebuilds_the_index_when_many_records_change(self):
+        for i in range(5):
+            ResolvableObjectMigration.objects.create(id=f'new{i}', type='occurrence', dataset_id=self.dataset.id, data={'location': 'new'})
+        with self.assertLogs('populator.management.commands._cache_data') as logs:
+            cache_data.merge_in_new_data(bulk=True)
+        self.assertIn('5 of about 20 records change, GIN index strategy: rebuild', logs.output[0])
+        self.assertEqual(self._index(), (True, 16))
+        self.assertEqual(ResolvableObject.objects.filter(data__contains={'location': 'new'}).count(), 5)
+
+    def test_builds_the_index_a_stopped_merge_dropped(self):
+        for i in range(5):
+            ResolvableObjectMigration.objects.create(id=f'new{i}', type='occurrence', dataset_id=self.dataset.id, data={'location': 'new'})
+        with mock.patch.object(cache_data.tables, 'create_index_concurrently', side_effect=RuntimeError('stopped')), \
+                self.assertLogs('populator.management.commands._cache_data'), self.assertRaises(RuntimeError):
+            cache_data.merge_in_new_data(bulk=True)
+        self.assertIsNone(self._index())
+        self.assertTrue(DroppedIndex.objects.filter(name=cache_data.DATA_INDEX).exists())
+        with self.assertLogs('populator.management.commands._cache_data') as logs:
+            cache_data.merge_in_new_data(bulk=True)
+        self.assertIn('was left dropped by a merge which stopped', logs.output[0])
+        self.assertEqual(self._index(), (True, 16))
+        self.assertFalse(DroppedIndex.objects.exists())
+
+    def test_drops_what_an_interrupted_build_left_and_builds_the_index_again(self):
+        # As left by create_index_concurrently stopping while it attached the partition indexes
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP INDEX {cache_data.DATA_INDEX}')
+            cursor.execute(f'CREATE INDEX website_resolvableobject_p0_{cache_data.DATA_INDEX} ON website_resolvableobject_p0 USING gin (data)')
+            cursor.execute(f'CREATE INDEX website_resolvableobject_p1_{cache_data.DATA_INDEX} ON website_resolvableobject_p1 USING gin (data)')
+            cursor.execute(f'CREATE INDEX {cache_data.DATA_INDEX} ON ONLY website_resolvableobject USING gin (data)')
+            cursor.execute(f'ALTER INDEX {cache_data.DATA_INDEX} ATTACH PARTITION website_resolvableobject_p0_{cache_data.DATA_INDEX}')
+        self.assertEqual(self._index(), (False, 1))
+        with self.assertLogs('populator.management.commands._cache_data') as logs:
+            cache_data.merge_in_new_data(bulk=True)
+        self.assertIn('was left invalid by a merge which stopped', logs.output[0])
+        self.assertEqual(self._index(), (True, 16))
+        self.assertFalse(DroppedIndex.objects.exists())
+
+    def test_enlarges_the_pending_lists_when_few_records_change(self):
+        ResolvableObjectMigration.objects.filter(id='old0').update(data={'location': 'new'})
+        during_merge = []
+        set_pending_list_limit = cache_data.set_pending_list_limit
+
+        def set_and_record(limit):
+            set_pending_list_limit(limit)
+            if limit:
+                during_merge.extend(self._reloptions())
+
+        with mock.patch.object(cache_data, 'set_pending_list_limit', side_effect=set_and_record), \
+                self.assertLogs('populator.management.commands._cache_data') as logs:
+            cache_data.merge_in_new_data(bulk=True)
+        self.assertIn('1 of about 20 records change, GIN index strategy: pending list', logs.output[0])
+        self.assertEqual(during_merge, [(['fastupdate=on', f'gin_pending_list_limit={cache_data.PENDING_LIST_LIMIT}'],)])
+        self.assertEqual(self._reloptions(), [(None,)])
+        self.assertEqual(self._index(), (True, 16))
+        self.assertEqual(ResolvableObject.objects.filter(data__contains={'location': 'new'}).count(), 1)
@@ -1,5 +1,6 @@
 from populator.management.commands import _gbif_api as gbif_api
 from django.test import TestCase
+import requests
 import responses
 
 class GbifApiTest(TestCase):
@@ -10,7 +11,7 @@ class GbifApiTest(TestCase):
     def test_get_dataset_list(self):
         mock_datasets = [{'key': 'a124e1e0-4755-430f-9eab-894f25a9b59c'}, {'key': 'd34ed8a4-d3cb-473c-a11c-79c5fec4d649'}, {'key': 'd34ed8a4-d3cb-473c-a11c-79c5fec4d649'}]
         mock_json = {'offset': 0, 'limit': 200, 'endOfRecords': 1, 'count': 1, 'results': mock_datasets}
-        api_url = self.GBIF_API_DATASET_URL.format('search?limit=5000&publishingCountry=NO')
+        api_url = self.GBIF_API_DATASET_URL.format('search?limit=1000&offset=0&publishingCountry=NO')
         responses.add(responses.GET, api_url, json=mock_json, status=200)  # A mock for the API call
 
         dataset_list = gbif_api.get_dataset_list()
@@ -18,13 +19,53 @@ class GbifApiTest(TestCase):
         self.assertEqual(responses.calls[0].request.url, api_url)
         self.assertEqual(dataset_list, mock_datasets)
 
+    @responses.activate
+    def test_get_dataset_list_pages_through_all_results(self):
+        first_page = [{'key': str(i)} for i in range(gbif_api.SEARCH_PAGE_SIZE)]
+        responses.add(responses.GET, self.GBIF_API_DATASET_URL.format('search?limit=1000&offset=0&publishingCountry=NO'),
+                      json={'offset': 0, 'endOfRecords': False, 'results': first_page}, status=200)
+        responses.add(responses.GET, self.GBIF_API_DATASET_URL.format('search?limit=1000&offset=1000&publishingCountry=NO'),
+                      json={'offset': 1000, 'endOfRecords': True, 'results': [{'key': 'last'}]}, status=200)
+        dataset_list = gbif_api.get_dataset_list()
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(dataset_list, first_page + [{'key': 'last'}])
+
+    @responses.activate
+    def test_get_dataset_list_returns_nothing_if_a_page_fails(self):
+        responses.add(responses.GET, self.GBIF_API_DATASET_URL.format('search?limit=1000&offset=0&publishingCountry=NO'),
+                      json={'offset': 0, 'endOfRecords': False, 'results': [{'key': 'a'}]}, status=200)
+        responses.add(responses.GET, self.GBIF_API_DATASET_URL.format('search?limit=1000&offset=1&publishingCountry=NO'), json={}, status=404)
+        with self.assertLogs():
+            self.assertEqual(gbif_api.get_dataset_list(), [])
+
+    @responses.activate
+    def test_get_datasets_detailed_info_keeps_order(self):
+        keys = ['a', 'b', 'c', 'd']
+        for key in keys:
+            responses.add(responses.GET, self.GBIF_API_DATASET_URL.format(key), json={'key': key}, status=200)
+        self.assertEqual(gbif_api.get_datasets_detailed_info(keys), [{'key': key} for key in keys])
+
+    def test_session_retries_and_pools_connections(self):
+        adapter = gbif_api.session.get_adapter(self.GBIF_API_DATASET_URL.format('search'))
+        self.assertEqual(adapter.max_retries.status_forcelist, [429, 500, 502, 503, 504])
+        self.assertGreater(adapter.max_retries.backoff_factor, 0)
+        self.assertEqual(adapter._pool_maxsize, gbif_api.MAX_CONCURRENT_REQUESTS)
+
+    @responses.activate
+    def test_logs_requests_without_a_response(self):
+        key = 'd34ed8a4-d3cb-473c-a11c-79c5fec4d649'
+        responses.add(responses.GET, self.GBIF_API_DATASET_URL.format(key), body=requests.exceptions.ConnectTimeout())
+        with self.assertLogs() as cm:
+            self.assertEqual(gbif_api.get_dataset_detailed_info(key), [])
+        self.assertTrue('WARNING:root:GET request failed' in cm.output[0])
+
     @responses.activate
     def _logs_when_get_dataset_list_api_fails(self):
-        url = self.GBIF_API_DATASET_URL.format('search?limit=5000&publishingCountry=NO')
+        url = self.GBIF_API_DATASET_URL.format('search?limit=1000&offset=0&publishingCountry=NO')
         responses.add(responses.GET, url, json={}, status=500)
         with self.assertLogs() as cm:
             dataset_list = gbif_api.get_dataset_list()
-            self.assertTrue('WARNING:root:GET request code: 500. URL: https://api.gbif.org/v1/dataset/search?limit=5000&publishingCountry=NO' in cm.output[0])
+            self.assertTrue('WARNING:root:GET request code: 500. URL: https://api.gbif.org/v1/dataset/search?limit=1000&offset=0&publishingCountry=NO' in cm.output[0])
 
     @responses.activate
     def test_returns_false_when_get_dwca_fails(self):
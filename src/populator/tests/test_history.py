@@ -0,0 +1,61 @@
+from populator.management.commands import _history
+from populator.models import History
+from website.models import ResolvableObject, Dataset
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from datetime import date
+from io import StringIO
+
+
+class HistoryPartitionsTest(TestCase):
+    def setUp(self):
+        dataset = Dataset.objects.create(id='dataset_id', data={'title': 'My dataset'})
+        self.resolvable_object = ResolvableObject.objects.create(id='a', type='occurrence', dataset=dataset, data={})
+
+    def _add_history(self, *days):
+        for day in days:
+            history = History.objects.create(resolvable_object=self.resolvable_object, changed_data={'day': str(day)})
+            History.objects.filter(id=history.id).update(changed_date=day)  # changed_date is set to today on save
+        # Checks the deferred foreign key now, a partition with pending checks cannot be dropped in the same transaction
+        with connection.cursor() as cursor:
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+    def _partition_counts(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT tableoid::regclass::text, count(*) FROM populator_history GROUP BY 1')
+            return dict(cursor.fetchall())
+
+    def test_history_is_stored_in_the_partition_of_its_month(self):
+        self._add_history(date.today())
+        self.assertEqual(self._partition_counts(), {f'populator_history_{date.today():%Y_%m}': 1})
+
+    def test_creates_month_partition_with_the_rows_from_the_default_partition(self):
+        self._add_history(date(2020, 3, 5), date(2020, 3, 31), date(2020, 4, 1))
+        self.assertEqual(self._partition_counts(), {'populator_history_default': 3})
+        self.assertEqual(_history.create_month_partition(date(2020, 3, 20)), 'populator_history_2020_03')
+        self.assertIsNone(_history.create_month_partition(date(2020, 3, 1)))
+        self.assertEqual(self._partition_counts(), {'populator_history_2020_03': 2, 'populator_history_default': 1})
+
+    def test_compacts_the_months_of_past_years(self):
+        for month in [1, 2, 12]:
+            _history.create_month_partition(date(2020, month, 1))
+        _history.create_month_partition(date(2021, 6, 1))
+        self._add_history(date(2020, 1, 1), date(2020, 2, 29), date(2020, 12, 31), date(2021, 6, 15))
+        self.assertEqual(_history.compact(keep_months=6, today=date(2021, 12, 15)), ['populator_history_2020'])
+        self.assertEqual(self._partition_counts(), {'populator_history_2020': 3, 'populator_history_2021_06': 1})
+        self.assertIn(('populator_history_2020', date(2020, 1, 1), date(2021, 1, 1)), _history.get_partitions())
+        self.assertEqual(History.objects.filter(changed_date__year=2020).count(), 3)
+
+    def test_keeps_months_of_recent_years(self):
+        _history.create_month_partition(date(2020, 12, 1))
+        self.assertEqual(_history.compact(keep_months=12, today=date(2021, 12, 1)), [])
+
+    def test_drops_old_partitions(self):
+        _history.create_month_partition(date(2019, 5, 1))
+        _history.create_month_partition(date(2020, 1, 1))
+        self._add_history(date(2019, 5, 2), date(2020, 1, 2))
+        out = StringIO()
+        call_command('compact_history', '--drop-before', '2020-01-01', stdout=out)
+        self.assertIn('Dropped populator_history_2019_05', out.getvalue())
+        self.assertEqual(list(History.objects.values_list('changed_date', flat=True)), [date(2020, 1, 2)])
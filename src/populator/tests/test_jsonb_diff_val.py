@@ -0,0 +1,55 @@
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from io import StringIO
+import json
+
+
+class JsonbDiffValTest(TestCase):
+    CASES = [
+        ({'a': '1', 'b': '2'}, {'a': '1', 'b': '2'}),
+        ({'a': '1', 'b': '2'}, {'a': '1', 'b': 'changed'}),
+        ({'a': '1', 'b': '2'}, {'a': '1'}),
+        ({'a': '1'}, {'a': '1', 'new': 'x'}),
+        ({}, {}),
+        ({}, {'a': '1'}),
+        ({'a': '1'}, {}),
+        ({'a': None}, {'a': None}),
+        ({'a': None}, {'a': '1'}),
+        ({'a': 1}, {'a': '1'}),
+        ({'a': 1}, {'a': [1]}),
+        ({'a': [1, 2]}, {'a': [1]}),
+        ({'a': [1]}, {'a': [1, 2]}),
+        ({'a': [1, 2]}, {'a': 1}),
+        ({'a': {'x': 1, 'y': 2}}, {'a': {'x': 1}}),
+        ({'a': {'x': 1}}, {'a': {'x': 1, 'y': 2}}),
+        ({'a': True, 'b': 1.5}, {'a': False, 'b': 1.50}),
+        ({'id': 'x', 'modified': '2011-01-01', 'scientificname': 'a'}, {'id': 'x', 'modified': '2022-02-02', 'locality': 'b'}),
+        (None, {'a': '1'}),
+        ({'a': '1'}, None),
+        (None, None),
+        ([1, 2], {'a': '1'}),
+        ('scalar', {}),
+    ]
+
+    def _diff(self, function, old, new):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT {function}(%s::jsonb, %s::jsonb)::text',
+                           [None if old is None else json.dumps(old), None if new is None else json.dumps(new)])
+            return cursor.fetchone()[0]
+
+    def test_same_result_as_plpgsql_version(self):
+        for old, new in self.CASES:
+            with self.subTest(old=old, new=new):
+                self.assertEqual(self._diff('jsonb_diff_val', old, new), self._diff('jsonb_diff_val_plpgsql', old, new))
+
+    def test_diff(self):
+        self.assertEqual(json.loads(self._diff('jsonb_diff_val', {'a': '1', 'b': '2', 'c': '3'}, {'a': '1', 'b': 'new', 'd': '4'})),
+                         {'b': '2', 'c': '3', 'd': None})
+        self.assertEqual(self._diff('jsonb_diff_val', {'a': '1'}, {'a': '1'}), '{}')
+
+    def test_benchmark_command_checks_results_match(self):
+        out = StringIO()
+        call_command('benchmark_jsonb_diff', '--rows', '500', stdout=out)
+        self.assertIn('500 pairs', out.getvalue())
+        self.assertIn('0 differing results', out.getvalue())
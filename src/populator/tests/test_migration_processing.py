@@ -1,10 +1,14 @@
 from populator.management.commands import _migration_processing as migration_processing
-from populator.management.commands.populate_resolver import create_duplicates_file
+from populator.management.commands._batching import AdaptiveBatchSize
 from populator.models import ResolvableObjectMigration
 from django.db import connection, transaction
 from django.test import TestCase, TransactionTestCase
 from django.forms.models import model_to_dict
+from zipfile import ZipFile
+import io
 import os
+import psycopg2 as p
+import tempfile
 
 
 class MigrationProcessingTest(TestCase):
@@ -79,115 +83,95 @@ class MigrationProcessingTest(TestCase):
             cursor.fetchall()
             self.assertEqual(headings, [col[0] for col in cursor.description])
 
-    def test_sync_id_column_add_new_id_col(self):
+    def _import_rows(self, columns, rows, id_column, core_id):
+        body = '\n'.join('\t'.join(row) for row in rows).encode('utf-8')
+        duplicate_materialsampleids = set()
+        if 'materialsampleid' in columns:
+            duplicate_materialsampleids = migration_processing.get_duplicate_materialsampleids(io.BytesIO(body), columns, id_column)
+        migration_processing.create_temp_table(migration_processing.get_temp_columns(columns))
+        migration_processing.import_file(io.BytesIO(body), columns, id_column, core_id, duplicate_materialsampleids)
         with connection.cursor() as cursor:
-            cursor.execute("CREATE TABLE temp (eventid text, heading2 text, heading3 text)")
-            cursor.execute("INSERT INTO temp VALUES ('urn:uuid:ba128c35-5e8f-408f-8597-00b1972dace1', 'a', 'b')")
-            self.assertTrue(migration_processing.sync_id_column('eventid', 'eventid'))
             cursor.execute('SELECT * FROM temp')
             columns = [col[0] for col in cursor.description]
-            self.assertEqual(dict(zip(columns, cursor.fetchone())), {'eventid': 'urn:uuid:ba128c35-5e8f-408f-8597-00b1972dace1', 'id': 'urn:uuid:ba128c35-5e8f-408f-8597-00b1972dace1', 'heading2': 'a', 'heading3': 'b', 'parent': None})
-
-    def test_sync_id_column_replace_id_col(self):
-        with connection.cursor() as cursor:
-            cursor.execute("CREATE TABLE temp (id text, occurrenceid text,  eventid text, heading text)")
-            cursor.execute("INSERT INTO temp VALUES ('urn:uuid:1', 'urn:uuid:2', 'urn:uuid:1', 'b')")
-            self.assertTrue(migration_processing.sync_id_column('occurrenceid', 'occurrenceid'))
-            cursor.execute('SELECT * FROM temp')
-            columns = [col[0] for col in cursor.description]
-            self.assertEqual(dict(zip(columns, cursor.fetchone())), {'id': 'urn:uuid:2', 'occurrenceid':'urn:uuid:2', 'eventid': 'urn:uuid:1', 'heading': 'b', 'parent': None})
-
-    def test_sync_id_with_purl_materialsampleid_url(self):
-        with connection.cursor() as cursor:
-            cursor.execute("CREATE TABLE temp (id text, occurrenceid text, materialsampleid text)")
-            cursor.execute("INSERT INTO temp VALUES ('urn:uuid:1', 'urn:uuid:1', 'http://purl.org/nhmuio/id/82b6903f-7613-4aba-b83b-948d0df6391a')")
-            self.assertTrue(migration_processing.sync_id_column('occurrenceid', 'occurrenceid'))
-            cursor.execute('SELECT * FROM temp')
-            columns = [col[0] for col in cursor.description]
-            self.assertEqual(dict(zip(columns, cursor.fetchone())), {'id': '82b6903f-7613-4aba-b83b-948d0df6391a', 'occurrenceid': 'urn:uuid:1', 'materialsampleid': '82b6903f-7613-4aba-b83b-948d0df6391a', 'parent': None})
-
-    def test_sync_id_with_purl_materialsampleid_uuid(self):
-        with connection.cursor() as cursor:
-            cursor.execute("CREATE TABLE temp (id text, occurrenceid text, materialsampleid text)")
-            cursor.execute("INSERT INTO temp VALUES ('urn:uuid:1', 'urn:uuid:1', 'b55cbe46-5f2f-4c07-8223-9d4b0c8ed811')")
-            self.assertTrue(migration_processing.sync_id_column('occurrenceid', 'occurrenceid'))
-            cursor.execute('SELECT * FROM temp')
-            columns = [col[0] for col in cursor.description]
-            self.assertEqual(dict(zip(columns, cursor.fetchone())), {'id': 'b55cbe46-5f2f-4c07-8223-9d4b0c8ed811', 'occurrenceid': 'urn:uuid:1', 'materialsampleid': 'b55cbe46-5f2f-4c07-8223-9d4b0c8ed811', 'parent': None})
-
-    def test_sync_id_with_multiple_materialsampleid(self):
-        with connection.cursor() as cursor:
-            cursor.execute("CREATE TABLE temp (id text, occurrenceid text, materialsampleid text)")
-            cursor.execute("INSERT INTO temp VALUES ('urn:uuid:1', 'urn:uuid:1', 'b55cbe46-5f2f-4c07-8223-9d4b0c8ed811|a55cbe46-5f2f-4c07-8223-9d4b0c8ed811')")
-            self.assertTrue(migration_processing.sync_id_column('occurrenceid', 'occurrenceid'))
-            cursor.execute('SELECT * FROM temp')
-            columns = [col[0] for col in cursor.description]
-            # Note that the second othercatalognumber gets deleted
-            self.assertEqual(dict(zip(columns, cursor.fetchone())), {'id': 'b55cbe46-5f2f-4c07-8223-9d4b0c8ed811', 'occurrenceid': 'urn:uuid:1', 'materialsampleid': 'b55cbe46-5f2f-4c07-8223-9d4b0c8ed811', 'parent': None})
-
-    def test_sync_id_with_duplicate_materialsampleid(self):
-        with connection.cursor() as cursor:
-            cursor.execute("CREATE TABLE temp (id text, occurrenceid text, materialsampleid text)")
-            cursor.execute("INSERT INTO temp VALUES ('urn:uuid:1', 'urn:uuid:1', 'b55cbe46-5f2f-4c07-8223-9d4b0c8ed811')")
-            cursor.execute("INSERT INTO temp VALUES ('urn:uuid:2', 'urn:uuid:2', 'b55cbe46-5f2f-4c07-8223-9d4b0c8ed811')")
-            cursor.execute("INSERT INTO temp VALUES ('urn:uuid:3', 'urn:uuid:3', '3136D80A-E74C-11E4-A2DC-00155D012A60')")
-            cursor.execute("INSERT INTO temp VALUES ('urn:uuid:4', 'urn:uuid:4', '3136D80A-E74C-11E4-A2DC-00155D012A60,5FF9E4CE-E74D-11E4-891B-00155D012A60')")
-            cursor.execute("INSERT INTO temp VALUES ('urn:uuid:5', 'urn:uuid:5', 'http://purl.org/nhmuio/id/bdb4f713-5ef6-472b-9e9c-3d03dcb4b6b7')")
-            cursor.execute("INSERT INTO temp VALUES ('urn:uuid:6', 'urn:uuid:6', 'bdb4f713-5ef6-472b-9e9c-3d03dcb4b6b7')")
-            self.assertTrue(migration_processing.sync_id_column('occurrenceid', 'occurrenceid'))
-            cursor.execute('SELECT * FROM temp')
-            self.assertEqual([('urn:uuid:1', 'urn:uuid:1', '', None), ('urn:uuid:2', 'urn:uuid:2', '', None),
-                              ('urn:uuid:3', 'urn:uuid:3', '', None), ('urn:uuid:4', 'urn:uuid:4', '', None),
-                              ('urn:uuid:5', 'urn:uuid:5', '', None), ('urn:uuid:6', 'urn:uuid:6', '', None)], cursor.fetchall())
-
-    def test_sync_id_with_invalid_materialsampleid(self):
-        with connection.cursor() as cursor:
-            cursor.execute("CREATE TABLE temp (id text, occurrenceid text, materialsampleid text)")
-            cursor.execute("INSERT INTO temp VALUES ('urn:uuid:1', 'urn:uuid:1', 'abc')")
-            self.assertTrue(migration_processing.sync_id_column('occurrenceid', 'occurrenceid'))
-            cursor.execute('SELECT * FROM temp')
-            columns = [col[0] for col in cursor.description]
-
-    def test_sync_id_ids_are_always_converted_to_lowercase(self):
-        with connection.cursor() as cursor:
-            cursor.execute("CREATE TABLE temp (id text, occurrenceid text, materialsampleid text)")
-            cursor.execute("INSERT INTO temp VALUES ('urn:uuid:1A', 'urn:uuid:1A', 'ABC')")
-            migration_processing.sync_id_column('materialsampleid', 'occurrenceid')
-            cursor.execute('SELECT * FROM temp')
-            self.assertEqual([('abc', 'urn:uuid:1A', 'ABC', 'urn:uuid:1a')], cursor.fetchall())
-
-    def test_purlfriendly_id_with_urn_prefix(self):
-        with connection.cursor() as cursor:
-            cursor.execute("CREATE TABLE temp (id text, parent text)")
-            cursor.execute("INSERT INTO temp VALUES ('urn:uuid:1', '')")
-            migration_processing.purlfriendly_id_columns()
-            cursor.execute('SELECT * FROM temp')
-            columns = [col[0] for col in cursor.description]
-            self.assertEqual(dict(zip(columns, cursor.fetchone())), {'id': '1', 'parent': ''})
-
-    def test_purlfriendly_id_with_url(self):
-        with connection.cursor() as cursor:
-            cursor.execute("CREATE TABLE temp (id text, parent text)")
-            cursor.execute("INSERT INTO temp VALUES ('', 'http://purl.org/nhmuio/id/1')")
-            migration_processing.purlfriendly_id_columns()
-            cursor.execute('SELECT * FROM temp')
-            columns = [col[0] for col in cursor.description]
-            self.assertEqual(dict(zip(columns, cursor.fetchone())), {'id': '', 'parent': '1'})
-
-    def test_sync_occurrence_id_column_with_event_core(self):
-        with connection.cursor() as cursor:
-            cursor.execute("CREATE TABLE temp (id text, occurrenceid text, heading2 text, heading3 text)")
-            cursor.execute("INSERT INTO temp VALUES ('urn:uuid:1', 'urn:uuid:2', 'a', 'b')")
-            self.assertTrue(migration_processing.sync_id_column('occurrenceid', 'eventid'))  # Should keep eventid as parent
-            cursor.execute('SELECT * FROM temp')
-            columns = [col[0] for col in cursor.description]
-            self.assertEqual(dict(zip(columns, cursor.fetchone())), {'id': 'urn:uuid:2','occurrenceid':'urn:uuid:2', 'parent': 'urn:uuid:1', 'heading2': 'a', 'heading3': 'b'})
-
-    def test_sync_id_column_with_no_coreid_col_returns_false(self):
-        with connection.cursor() as cursor:
-            cursor.execute("CREATE TABLE temp (id text, heading text)")  # This happens e.g. http://data.nina.no:8080/ipt/archive.do?r=arko_strandeng occurrence.txt
-            cursor.execute("INSERT INTO temp VALUES ('urn:uuid:1', 'b')")
-            self.assertFalse(migration_processing.sync_id_column('occurrenceid', 'occurrenceid'))
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def test_import_file_adds_new_id_col(self):
+        rows = self._import_rows(['eventid', 'heading2', 'heading3'], [('urn:uuid:ba128c35-5e8f-408f-8597-00b1972dace1', 'a', 'b')], 'eventid', 'eventid')
+        self.assertEqual(rows, [{'eventid': 'urn:uuid:ba128c35-5e8f-408f-8597-00b1972dace1', 'id': 'ba128c35-5e8f-408f-8597-00b1972dace1', 'heading2': 'a', 'heading3': 'b', 'parent': None}])
+
+    def test_import_file_replaces_id_col(self):
+        rows = self._import_rows(['id', 'occurrenceid', 'eventid', 'heading'], [('urn:uuid:1', 'urn:uuid:2', 'urn:uuid:1', 'b')], 'occurrenceid', 'occurrenceid')
+        self.assertEqual(rows, [{'id': '2', 'occurrenceid': 'urn:uuid:2', 'eventid': 'urn:uuid:1', 'heading': 'b', 'parent': None}])
+
+    def test_import_file_with_purl_materialsampleid_url(self):
+        rows = self._import_rows(['id', 'occurrenceid', 'materialsampleid'], [('urn:uuid:1', 'urn:uuid:1', 'http://purl.org/nhmuio/id/82b6903f-7613-4aba-b83b-948d0df6391a')], 'occurrenceid', 'occurrenceid')
+        self.assertEqual(rows, [{'id': '82b6903f-7613-4aba-b83b-948d0df6391a', 'occurrenceid': 'urn:uuid:1', 'materialsampleid': '82b6903f-7613-4aba-b83b-948d0df6391a', 'parent': None}])
+
+    def test_import_file_with_materialsampleid_uuid(self):
+        rows = self._import_rows(['id', 'occurrenceid', 'materialsampleid'], [('urn:uuid:1', 'urn:uuid:1', 'b55cbe46-5f2f-4c07-8223-9d4b0c8ed811')], 'occurrenceid', 'occurrenceid')
+        self.assertEqual(rows, [{'id': 'b55cbe46-5f2f-4c07-8223-9d4b0c8ed811', 'occurrenceid': 'urn:uuid:1', 'materialsampleid': 'b55cbe46-5f2f-4c07-8223-9d4b0c8ed811', 'parent': None}])
+
+    def test_import_file_with_multiple_materialsampleid(self):
+        rows = self._import_rows(['id', 'occurrenceid', 'materialsampleid'], [('urn:uuid:1', 'urn:uuid:1', 'b55cbe46-5f2f-4c07-8223-9d4b0c8ed811|a55cbe46-5f2f-4c07-8223-9d4b0c8ed811')], 'occurrenceid', 'occurrenceid')
+        # Note that the second materialsampleid gets deleted
+        self.assertEqual(rows, [{'id': 'b55cbe46-5f2f-4c07-8223-9d4b0c8ed811', 'occurrenceid': 'urn:uuid:1', 'materialsampleid': 'b55cbe46-5f2f-4c07-8223-9d4b0c8ed811', 'parent': None}])
+
+    def test_import_file_with_duplicate_materialsampleid(self):
+        rows = self._import_rows(['id', 'occurrenceid', 'materialsampleid'], [
+            ('urn:uuid:1', 'urn:uuid:1', 'b55cbe46-5f2f-4c07-8223-9d4b0c8ed811'),
+            ('urn:uuid:2', 'urn:uuid:2', 'b55cbe46-5f2f-4c07-8223-9d4b0c8ed811'),
+            ('urn:uuid:3', 'urn:uuid:3', '3136D80A-E74C-11E4-A2DC-00155D012A60'),
+            ('urn:uuid:4', 'urn:uuid:4', '3136D80A-E74C-11E4-A2DC-00155D012A60,5FF9E4CE-E74D-11E4-891B-00155D012A60'),
+            ('urn:uuid:5', 'urn:uuid:5', 'http://purl.org/nhmuio/id/bdb4f713-5ef6-472b-9e9c-3d03dcb4b6b7'),
+            ('urn:uuid:6', 'urn:uuid:6', 'bdb4f713-5ef6-472b-9e9c-3d03dcb4b6b7')], 'occurrenceid', 'occurrenceid')
+        self.assertEqual([(row['id'], row['occurrenceid'], row['materialsampleid'], row['parent']) for row in rows],
+                         [('1', 'urn:uuid:1', '', None), ('2', 'urn:uuid:2', '', None),
+                          ('3', 'urn:uuid:3', '', None), ('4', 'urn:uuid:4', '', None),
+                          ('5', 'urn:uuid:5', '', None), ('6', 'urn:uuid:6', '', None)])
+
+    def test_import_file_with_invalid_materialsampleid(self):
+        rows = self._import_rows(['id', 'occurrenceid', 'materialsampleid'], [('urn:uuid:1', 'urn:uuid:1', 'abc')], 'occurrenceid', 'occurrenceid')
+        self.assertEqual(rows, [{'id': '1', 'occurrenceid': 'urn:uuid:1', 'materialsampleid': 'abc', 'parent': None}])
+
+    def test_import_file_ids_are_always_converted_to_lowercase(self):
+        rows = self._import_rows(['id', 'occurrenceid', 'materialsampleid'], [('urn:uuid:1A', 'urn:uuid:1A', 'ABC')], 'materialsampleid', 'occurrenceid')
+        self.assertEqual([tuple(row.values()) for row in rows], [('abc', 'urn:uuid:1A', 'ABC', '1a')])
+
+    def test_import_file_strips_prefixes_from_id_and_parent(self):
+        rows = self._import_rows(['id', 'measurementid'], [('http://purl.org/nhmuio/id/1', 'urn:uuid:2')], 'measurementid', 'occurrenceid')
+        self.assertEqual(rows, [{'id': '2', 'measurementid': 'urn:uuid:2', 'parent': '1'}])
+
+    def test_import_occurrence_file_with_event_core(self):
+        rows = self._import_rows(['id', 'occurrenceid', 'heading2', 'heading3'], [('urn:uuid:1', 'urn:uuid:2', 'a', 'b')], 'occurrenceid', 'eventid')  # Should keep eventid as parent
+        self.assertEqual(rows, [{'id': '2', 'occurrenceid': 'urn:uuid:2', 'parent': '1', 'heading2': 'a', 'heading3': 'b'}])
+
+    def test_import_file_keeps_copy_escapes_and_empty_fields(self):
+        rows = self._import_rows(['occurrenceid', 'remarks', 'sex'], [('URN:UUID:A\\\\B', 'line\\none', ''), ('', 'no id', '')], 'occurrenceid', 'occurrenceid')
+        self.assertEqual(rows, [{'occurrenceid': 'URN:UUID:A\\B', 'remarks': 'line\none', 'sex': None, 'parent': None, 'id': 'a\\b'},
+                                {'occurrenceid': None, 'remarks': 'no id', 'sex': None, 'parent': None, 'id': None}])
+
+    def test_import_file_passes_bad_rows_through_to_copy(self):
+        with self.assertRaises(p.errors.BadCopyFileFormat):
+            with transaction.atomic():
+                self._import_rows(['occurrenceid', 'heading'], [('urn:uuid:1', 'a', 'extra')], 'occurrenceid', 'occurrenceid')
+
+    def test_import_dwca_with_no_id_col_imports_nothing(self):
+        # This happens e.g. http://data.nina.no:8080/ipt/archive.do?r=arko_strandeng occurrence.txt
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            zip_file_location = os.path.join(tmp_dir, 'dwca.zip')
+            with ZipFile(zip_file_location, 'w') as zf:
+                zf.writestr('occurrence.txt', 'id\theading\nurn:uuid:1\tb\n')
+            with self.assertLogs():
+                self.assertIsNone(migration_processing.import_dwca('my_dataset_id', zip_file_location))
+        self.assertEqual(ResolvableObjectMigration.objects.count(), 0)
+
+    def test_import_dwca_of_bad_zip_fails(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            zip_file_location = os.path.join(tmp_dir, 'dwca.zip')
+            with open(zip_file_location, 'w') as f:
+                f.write('not a zip file')
+            with self.assertLogs():
+                self.assertIsNone(migration_processing.import_dwca('my_dataset_id', zip_file_location))
 
     def test_add_dataset_id(self):
         with connection.cursor() as cursor:
@@ -241,6 +225,15 @@ class MigrationProcessingTest(TestCase):
                     {'id': 'b', 'parent': None, 'data': {'id': 'b', 'scientificname': 'another'}, 'type': 'occurrence', 'dataset_id': 'dataset_id'}]
         self.assertEqual([model_to_dict(x) for x in ResolvableObjectMigration.objects.all()], expected)
 
+    def test_insert_json_into_migration_table_in_keyset_batches(self):
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TABLE temp (id text, parent text, scientificname text)')
+            cursor.execute("INSERT INTO temp SELECT 'id' || lpad(i::text, 3, '0'), NULL, 'name' FROM generate_series(1, 250) AS i")
+            cursor.execute("INSERT INTO temp VALUES (NULL, NULL, 'no id')")
+        count = migration_processing.insert_json_into_migration_table('dataset_id', 'occurrence', batch_size=AdaptiveBatchSize(initial=100, minimum=100, maximum=100))
+        self.assertEqual(count, 250)
+        self.assertEqual(ResolvableObjectMigration.objects.count(), 250)
+
     def test_insert_with_previous_dataset(self):
         with connection.cursor() as cursor:
             cursor.execute('CREATE TABLE temp (id text, parent text, sname text)')
@@ -263,38 +256,22 @@ class MigrationProcessingTest(TestCase):
         result = [model_to_dict(x) for x in ResolvableObjectMigration.objects.all()]
         self.assertEqual(sorted(result, key=lambda x: x['id']), expected)
 
-    def test_remove_duplicates(self):
+    def _import_two_datasets(self, duplicates):
         with connection.cursor() as cursor:
             cursor.execute('CREATE TABLE temp (id text, parent text, sname text)')
             cursor.execute("INSERT INTO temp VALUES ('x', NULL, 'a-name')")
             cursor.execute("INSERT INTO temp VALUES ('b', NULL, 'b-name')")
-        migration_processing.insert_json_into_migration_table('a_d_id', 'occurrence')
+        migration_processing.insert_json_into_migration_table('a_d_id', 'occurrence', duplicates=duplicates)
 
         with connection.cursor() as cursor:
             cursor.execute('DROP TABLE temp')
             cursor.execute('CREATE TABLE temp (id text, parent text, sname text)')
             cursor.execute("INSERT INTO temp VALUES ('x', NULL, 'c-name')")
             cursor.execute("INSERT INTO temp VALUES ('d', NULL, 'd-name')")
-        migration_processing.remove_duplicates()
-        with connection.cursor() as cursor:
-            cursor.execute('SELECT COUNT(*) FROM temp')
-            temp_count = cursor.fetchone()[0]
-        self.assertEqual(temp_count, 1)
+        return migration_processing.insert_json_into_migration_table('b_d_id', 'occurrence', duplicates=duplicates)
 
     def test_insert_with_previous_dataset_with_duplicates_keeps_first_result(self):
-        with connection.cursor() as cursor:
-            cursor.execute('CREATE TABLE temp (id text, parent text, sname text)')
-            cursor.execute("INSERT INTO temp VALUES ('x', NULL, 'a-name')")
-            cursor.execute("INSERT INTO temp VALUES ('b', NULL, 'b-name')")
-        migration_processing.insert_json_into_migration_table('a_d_id', 'occurrence')
-
-        with connection.cursor() as cursor:
-            cursor.execute('DROP TABLE temp')
-            cursor.execute('CREATE TABLE temp (id text, parent text, sname text)')
-            cursor.execute("INSERT INTO temp VALUES ('x', NULL, 'c-name')")
-            cursor.execute("INSERT INTO temp VALUES ('d', NULL, 'd-name')")
-        migration_processing.remove_duplicates()
-        migration_processing.insert_json_into_migration_table('b_d_id', 'occurrence')
+        self.assertEqual(self._import_two_datasets(None), 1)
         expected = [
             {'id': 'b', 'parent': None, 'data': {'id': 'b', 'sname': 'b-name'}, 'type': 'occurrence', 'dataset_id': 'a_d_id'},
             {'id': 'x', 'parent': None, 'data': {'id': 'x', 'sname': 'a-name'}, 'type': 'occurrence', 'dataset_id': 'a_d_id'},
@@ -303,43 +280,57 @@ class MigrationProcessingTest(TestCase):
         results = [model_to_dict(x) for x in ResolvableObjectMigration.objects.all()]
         self.assertEqual(results, expected)
 
-    def test_record_duplicates_works_with_records_with_duplicate_ids(self):
-        file = '/srv/test_duplicates.txt'
-        create_duplicates_file(file)
+    def test_logs_duplicates(self):
+        duplicates = migration_processing.DuplicateLog(tempfile.mkdtemp())
+        self._import_two_datasets(duplicates)
+        self.assertEqual(duplicates.read('a_d_id'), [])
+        self.assertEqual(duplicates.read('b_d_id'), [{'id': 'x', 'dataset_id': 'b_d_id', 'type': 'occurrence', 'duplicate_of': 'a_d_id'}])
+        self.assertTrue(duplicates.path('b_d_id').endswith('/b_d_id.jsonl.gz'))
+
+    def test_logs_duplicates_with_payloads(self):
+        duplicates = migration_processing.DuplicateLog(tempfile.mkdtemp(), payloads=True)
+        self._import_two_datasets(duplicates)
+        expected = [{'id': 'x', 'dataset_id': 'b_d_id', 'type': 'occurrence', 'duplicate_of': 'a_d_id',
+                     'data': {'id': 'x', 'sname': 'c-name'}, 'old_data': {'id': 'x', 'sname': 'a-name'}}]
+        self.assertEqual(duplicates.read('b_d_id'), expected)
+
+    def test_logs_duplicates_within_a_file(self):
+        duplicates = migration_processing.DuplicateLog(tempfile.mkdtemp())
         with connection.cursor() as cursor:
             cursor.execute('CREATE TABLE temp (id text, parent text, sname text)')
-            cursor.execute("INSERT INTO temp VALUES ('x', NULL, 'a-name')")
-            cursor.execute("INSERT INTO temp VALUES ('b', NULL, 'b-name')")
-        migration_processing.insert_json_into_migration_table('a_d_id', 'occurrence')
+            cursor.execute("INSERT INTO temp VALUES ('x', NULL, 'a-name'), ('x', NULL, 'b-name'), ('y', NULL, 'c-name')")
+        self.assertEqual(migration_processing.insert_json_into_migration_table('a_d_id', 'occurrence', duplicates=duplicates), 2)
+        self.assertEqual(duplicates.read('a_d_id'), [{'id': 'x', 'dataset_id': 'a_d_id', 'type': 'occurrence', 'duplicate_of': 'a_d_id'}])
 
+    def test_logs_duplicates_across_batches(self):
+        # Each id three times, so batches of 100 end between rows with the same id
+        duplicates = migration_processing.DuplicateLog(tempfile.mkdtemp())
         with connection.cursor() as cursor:
-            cursor.execute('DROP TABLE temp')
             cursor.execute('CREATE TABLE temp (id text, parent text, sname text)')
-            cursor.execute("INSERT INTO temp VALUES ('x', NULL, 'c-name')")
-            cursor.execute("INSERT INTO temp VALUES ('d', NULL, 'd-name')")
-        migration_processing.record_duplicates('b_d_id', 'occurrence', file)
-
-        with open(file) as f:
-            content = f.readlines()
-
-        self.assertEqual(len(content), 2)  # Including header
-        result = [line.rstrip('\n') for line in content]
-        expected = ['x', '{"id":"x","parent":null,"sname":"c-name"}', 'b_d_id', 'occurrence', '{"id": "x", "sname": "a-name"}', 'a_d_id']
-        self.assertEqual(result[1].split('|'), expected)
-
-    def test_record_duplicates_works_with_weird_char_encoding(self):
-        file = '/srv/duplicates.txt'
-        create_duplicates_file(file)
-        count = migration_processing.import_dwca('my_dataset_id', '/srv/populator/tests/mock_data/dwca-molltax-v1.195.zip')
+            cursor.execute("INSERT INTO temp SELECT 'id' || lpad((i % 50)::text, 3, '0'), NULL, 'name' || i FROM generate_series(0, 149) AS i")
+        count = migration_processing.insert_json_into_migration_table('a_d_id', 'occurrence', duplicates=duplicates,
+                                                                      batch_size=AdaptiveBatchSize(initial=100, minimum=100, maximum=100))
+        self.assertEqual(count, 50)
+        self.assertEqual(len(duplicates.read('a_d_id')), 100)
+        self.assertEqual(ResolvableObjectMigration.objects.get(id='id001').data['sname'], 'name1')
+
+    def test_logs_the_later_rows_with_the_same_id(self):
+        duplicates = migration_processing.DuplicateLog(tempfile.mkdtemp(), payloads=True)
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TABLE temp (id text, parent text, sname text)')
+            cursor.execute("INSERT INTO temp VALUES ('x', NULL, 'first'), ('x', NULL, 'second')")
+        migration_processing.insert_json_into_migration_table('a_d_id', 'occurrence', duplicates=duplicates)
+        self.assertEqual(ResolvableObjectMigration.objects.get(id='x').data['sname'], 'first')
+        self.assertEqual([duplicate['data']['sname'] for duplicate in duplicates.read('a_d_id')], ['second'])
+
+    def test_logs_duplicates_with_weird_char_encoding(self):
+        duplicates = migration_processing.DuplicateLog(tempfile.mkdtemp(), payloads=True)
+        count = migration_processing.import_dwca('my_dataset_id', '/srv/populator/tests/mock_data/dwca-molltax-v1.195.zip', duplicates=duplicates)
         self.assertEqual(count, 23227)
-        count = migration_processing.import_dwca('my_dataset_id', '/srv/populator/tests/mock_data/dwca-molltax-v1.195.zip')
+        count = migration_processing.import_dwca('my_dataset_id', '/srv/populator/tests/mock_data/dwca-molltax-v1.195.zip', duplicates=duplicates)
         self.assertEqual(count, 0)
         self.assertEqual(ResolvableObjectMigration.objects.count(), 23227)
-
-        with open(file) as f:
-            content = f.readlines()
-        self.assertEqual(len(content), 23228)
-        os.remove(file)
+        self.assertEqual(len(duplicates.read('my_dataset_id')), 23227)
 
 
 class GetCoreTest(TestCase):
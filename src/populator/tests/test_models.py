@@ -1,5 +1,6 @@
 from django.test import TestCase
-from populator.models import Statistic
+from populator.models import RecordCount, Statistic
+from populator.management.commands import _statistics
 from website.models import ResolvableObject, Dataset
 
 
@@ -22,3 +23,29 @@ class ResolvableObjectModelTests(TestCase):
 
     def test_gets_total_count(self):
         self.assertEqual(Statistic.objects.get_total_count(), 5)
+
+    def test_gets_preserved_specimen_count(self):
+        ResolvableObject.objects.create(id='6', data={'basisofrecord': 'PreservedSpecimen'}, dataset=self.dataset)
+        ResolvableObject.objects.create(id='7', data={'basisofrecord': 'Preservedspecimen'}, dataset=self.dataset)
+        _statistics.recount()
+        self.assertEqual(Statistic.objects.get_preserved_specimen_count(), 2)
+
+    def test_generation_only_goes_up(self):
+        self.assertIsNone(Statistic.objects.get_generation())
+        Statistic.objects.create(name='generation', value=2 ** 40)  # Later than now
+        self.assertEqual(Statistic.objects.set_generation(), 2 ** 40 + 1)
+        self.assertEqual(Statistic.objects.get_generation(), 2 ** 40 + 1)
+
+
+class RecordCountModelTests(TestCase):
+    def test_summary(self):
+        RecordCount.objects.create(dataset_id='a', type='occurrence', basisofrecord='PreservedSpecimen', deleted=False, count=5)
+        RecordCount.objects.create(dataset_id='a', type='occurrence', basisofrecord='PreservedSpecimen', deleted=True, count=1)
+        RecordCount.objects.create(dataset_id='b', type='event', basisofrecord='', deleted=False, count=2)
+        self.assertEqual(RecordCount.objects.summary(), {
+            'total': 8, 'active': 7, 'deleted': 1,
+            'datasets': {'a': {'active': 5, 'deleted': 1}, 'b': {'active': 2, 'deleted': 0}},
+            'types': {'occurrence': {'active': 5, 'deleted': 1}, 'event': {'active': 2, 'deleted': 0}},
+            'basisofrecord': {'PreservedSpecimen': {'active': 5, 'deleted': 1}, '': {'active': 2, 'deleted': 0}},
+        })
+        self.assertEqual(RecordCount.objects.filter(dataset_id='a').total(), 6)
@@ -0,0 +1,51 @@
+from populator.management.commands import _parallel_import
+from populator.management.commands import _migration_processing as migration_processing
+from populator.models import ResolvableObjectMigration, ResolvableObject, Run
+from populator.tests import gbif_mocks
+from django.core.management import call_command
+from django.db import connection
+from io import StringIO
+import tempfile
+import responses
+from django.test import TransactionTestCase
+
+
+class ParallelImportTest(TransactionTestCase):
+    SMALL_TEST_FILE = '/srv/populator/tests/mock_data/dwca-seabird_estimates-v1.0.zip'
+    SMALL_TEST_FILE_B = '/srv/populator/tests/mock_data/dwca-molltax-v1.195.zip'
+
+    def test_imports_datasets_in_worker_processes(self):
+        archives = [('a', self.SMALL_TEST_FILE), ('b', self.SMALL_TEST_FILE_B)]
+        counts = dict(_parallel_import.import_archives(iter(archives), workers=2))
+        self.assertEqual(counts, {'a': 20191, 'b': 23227})
+        self.assertEqual(ResolvableObjectMigration.objects.filter(dataset_id='a').count(), 20191)
+        self.assertEqual(ResolvableObjectMigration.objects.filter(dataset_id='b').count(), 23227)
+
+    def test_datasets_sharing_ids_are_imported_once(self):
+        archives = [('a', self.SMALL_TEST_FILE), ('b', self.SMALL_TEST_FILE), ('c', self.SMALL_TEST_FILE)]
+        duplicates = migration_processing.DuplicateLog(tempfile.mkdtemp())
+        counts = dict(_parallel_import.import_archives(iter(archives), workers=3, duplicates=duplicates))
+        self.assertEqual(sorted(counts.keys()), ['a', 'b', 'c'])
+        self.assertEqual(sum(counts.values()), 20191)
+        self.assertEqual(ResolvableObjectMigration.objects.count(), 20191)
+        self.assertEqual(sum(len(duplicates.read(key)) for key in 'abc'), 2 * 20191)
+
+    def test_drops_staging_tables(self):
+        list(_parallel_import.import_archives(iter([('a-1', self.SMALL_TEST_FILE), ('b', self.SMALL_TEST_FILE_B)]), workers=2))
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_name IN ('temp_a_1', 'temp_b')")
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_imports_in_this_process_with_one_worker(self):
+        counts = list(_parallel_import.import_archives(iter([('a', self.SMALL_TEST_FILE)])))
+        self.assertEqual(counts, [('a', 20191)])
+
+    @responses.activate
+    def test_populate_resolver_with_import_workers(self):
+        gbif_mocks.mock_two_datasets()
+        call_command('populate_resolver', '--import-workers', '2', stdout=StringIO())
+        self.assertEqual(ResolvableObject.objects.count(), 20191 + 23227)
+        self.assertEqual(Run.objects.get().stage, Run.FINISHED)
+
+    def test_staging_table_name(self):
+        self.assertEqual(migration_processing.staging_table_name('07044577-BD82-4089'), 'temp_07044577_bd82_4089')
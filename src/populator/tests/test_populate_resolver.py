@@ -1,12 +1,16 @@
 from io import StringIO
-from django.core.management import call_command
+from django.core.management import call_command, CommandError
 import responses
 from unittest import mock
 from django.test import TestCase
-from populator.models import Statistic, ResolvableObject
+from populator.models import Statistic, ResolvableObject, ResolvableObjectMigration, Run, RunDataset
+from populator.management.commands import _migration_processing
 from website.models import Dataset
 from datetime import datetime
+import shutil
+import tempfile
 from populator.management.commands.populate_resolver import sync_dataset
+from populator.tests import gbif_mocks
 
 
 class SyncDatasetTest(TestCase):
@@ -48,7 +52,7 @@ class PopulateResolverTest(TestCase):
         mock_datasets[1]['title'] = 'changed'
 
         mock_json = {'offset': 0, 'limit': 200, 'endOfRecords': 1, 'count': 2, 'results': mock_datasets}
-        api_url = self.GBIF_API_DATASET_URL.format('search?limit=5000&publishingCountry=NO')
+        api_url = self.GBIF_API_DATASET_URL.format('search?limit=1000&offset=0&publishingCountry=NO')
         responses.add(responses.GET, api_url, json=mock_json, status=200)
         responses.add(responses.GET, self.GBIF_API_DATASET_URL.format('a'), json=mock_datasets[0], status=200)
         responses.add(responses.GET, self.GBIF_API_DATASET_URL.format('b'), json=mock_datasets[1], status=200)
@@ -88,12 +92,151 @@ class PopulateResolverTest(TestCase):
         call_command('populate_resolver', stdout=StringIO())
         self.assertEqual(ResolvableObject.objects.count(), 20191)
 
+    @responses.activate
+    def test_it_adds_dataset_records_to_resolver_with_prefetching(self):
+        self._mock_get_dataset_list()
+        self._mock_get_dataset_detailed_info()
+        with open(self.SMALL_TEST_FILE, 'rb') as dwc_zip_stream:
+            responses.add(responses.GET, self.endpoints_example[0]['url'], body=dwc_zip_stream.read(), status=200,
+                          content_type='application/zip', stream=True)
+        call_command('populate_resolver', prefetch=2, disk_budget=100, stdout=StringIO())
+        self.assertEqual(ResolvableObject.objects.count(), 20191)
+
+    @responses.activate
+    def test_it_does_not_import_identical_archive_again(self):
+        cache_dir = tempfile.mkdtemp()
+        self._mock_get_dataset_list()
+        self._mock_get_dataset_detailed_info()
+        with open(self.SMALL_TEST_FILE, 'rb') as dwc_zip_stream:
+            responses.add(responses.GET, self.endpoints_example[0]['url'], body=dwc_zip_stream.read(), status=200,
+                          content_type='application/zip', stream=True)
+        call_command('populate_resolver', archive_cache=cache_dir, stdout=StringIO())
+        self.assertEqual(ResolvableObject.objects.count(), 20191)
+
+        dataset = Dataset.objects.get(id='d34ed8a4-d3cb-473c-a11c-79c5fec4d649')
+        dataset.data['modified'] = '2000-01-01T00:00:00.000+0000'  # GBIF bumps modified without the archive changing
+        dataset.save()
+        with mock.patch('populator.management.commands._migration_processing.import_dwca') as import_dwca:
+            call_command('populate_resolver', archive_cache=cache_dir, stdout=StringIO())
+            import_dwca.assert_not_called()
+        self.assertEqual(ResolvableObject.objects.count(), 20191)
+        self.assertEqual(ResolvableObject.objects.exclude(deleted_date__isnull=True).count(), 0)
+        shutil.rmtree(cache_dir)
+
+    @responses.activate
+    def test_resume_carries_on_with_ingestion_where_it_stopped(self):
+        url_a, url_b = gbif_mocks.mock_two_datasets()
+        import_dwca = _migration_processing.import_dwca
+
+        def import_first_then_stop(dataset_key, zip_file_location, **kwargs):
+            if dataset_key == 'a34ed8a4-d3cb-473c-a11c-79c5fec4d640':
+                raise RuntimeError('stopped')
+            return import_dwca(dataset_key, zip_file_location, **kwargs)
+
+        with mock.patch('populator.management.commands._migration_processing.import_dwca', side_effect=import_first_then_stop):
+            with self.assertRaises(RuntimeError):
+                call_command('populate_resolver', stdout=StringIO())
+        run = Run.objects.get()
+        self.assertEqual(dict(run.datasets.values_list('dataset_key', 'stage')),
+                         {'d34ed8a4-d3cb-473c-a11c-79c5fec4d649': RunDataset.IMPORTED, 'a34ed8a4-d3cb-473c-a11c-79c5fec4d640': RunDataset.DOWNLOADED})
+        self.assertEqual(ResolvableObject.objects.count(), 0)
+
+        call_command('populate_resolver', '--resume', stdout=StringIO())
+        self.assertEqual(len([call for call in responses.calls if call.request.url == url_a]), 1)  # Not downloaded again
+        self.assertEqual(len([call for call in responses.calls if call.request.url == url_b]), 2)
+        self.assertEqual(ResolvableObject.objects.count(), 20191 + 23227)
+        run.refresh_from_db()
+        self.assertEqual(run.stage, Run.FINISHED)
+        self.assertEqual(set(run.datasets.values_list('stage', flat=True)), {RunDataset.MERGED})
+
+    @responses.activate
+    def test_resume_goes_straight_to_merging_a_run_which_stopped_there(self):
+        Dataset.objects.create(id='a', data={})
+        run = Run.objects.create(stage=Run.MERGING)
+        RunDataset.objects.create(run=run, dataset_key='a', url='http://data.gbif.no/archive.do?r=dataset', stage=RunDataset.IMPORTED)
+        ResolvableObjectMigration.objects.create(id='1', data={'id': '1'}, type='occurrence', dataset_id='a')
+        call_command('populate_resolver', '--resume', stdout=StringIO())  # Any request to GBIF would fail
+        self.assertEqual(ResolvableObject.objects.get().id, '1')
+        run.refresh_from_db()
+        self.assertEqual(run.stage, Run.FINISHED)
+
+    @responses.activate
+    def test_resume_of_a_skip_run_does_not_delete_datasets(self):
+        dataset = Dataset.objects.create(id='a', data={})
+        ResolvableObject.objects.create(id='1', data={'id': '1'}, type='occurrence', dataset=dataset)
+        ResolvableObjectMigration.objects.create(id='1', data={'id': '1', 'changed': 'yes'}, type='occurrence', dataset_id='a')
+        with mock.patch('populator.management.commands._cache_data.merge_in_new_data', side_effect=RuntimeError('stopped')):
+            with self.assertRaises(RuntimeError):
+                call_command('populate_resolver', '--skip', stdout=StringIO())
+        call_command('populate_resolver', '--resume', stdout=StringIO())  # Any request to GBIF would fail
+        self.assertIsNone(Dataset.objects.get().deleted_date)
+        record = ResolvableObject.objects.get()
+        self.assertIsNone(record.deleted_date)
+        self.assertEqual(record.data['changed'], 'yes')
+        self.assertEqual(Run.objects.get().stage, Run.FINISHED)
+
+    @responses.activate
+    def test_without_resume_starts_a_new_run(self):
+        Run.objects.create(stage=Run.INGESTING)
+        self._mock_get_dataset_list()
+        self._mock_get_dataset_detailed_info()
+        with open(self.SMALL_TEST_FILE, 'rb') as dwc_zip_stream:
+            responses.add(responses.GET, self.endpoints_example[0]['url'], body=dwc_zip_stream.read(), status=200, content_type='application/zip', stream=True)
+        call_command('populate_resolver', stdout=StringIO())
+        self.assertEqual(list(Run.objects.order_by('id').values_list('stage', flat=True)), [Run.INGESTING, Run.FINISHED])
+        self.assertEqual(ResolvableObject.objects.count(), 20191)
+
+    @responses.activate
+    def test_refreshes_a_single_dataset(self):
+        gbif_mocks.mock_two_datasets()
+        call_command('populate_resolver', stdout=StringIO())
+        key_a, key_b = 'd34ed8a4-d3cb-473c-a11c-79c5fec4d649', 'a34ed8a4-d3cb-473c-a11c-79c5fec4d640'
+        changed = ResolvableObject.objects.filter(dataset_id=key_a).order_by('id').first()
+        ResolvableObject.objects.filter(id=changed.id).update(data={'id': changed.id})
+        ResolvableObject.objects.filter(dataset_id=key_b).update(data={'id': 'untouched'})
+        calls = len(responses.calls)
+
+        call_command('populate_resolver', '--dataset', key_a, stdout=StringIO())  # Its modified date has not changed
+        self.assertNotIn('search', ' '.join(call.request.url for call in responses.calls[calls:]))
+        self.assertEqual(ResolvableObject.objects.get(id=changed.id).data, changed.data)
+        self.assertEqual(ResolvableObject.objects.filter(dataset_id=key_b, data={'id': 'untouched'}).count(), 23227)
+        self.assertEqual(ResolvableObject.objects.exclude(deleted_date__isnull=True).count(), 0)
+        self.assertEqual(Dataset.objects.filter(deleted_date__isnull=True).count(), 2)
+        run = Run.objects.get(dataset_key=key_a)
+        self.assertEqual(run.stage, Run.FINISHED)
+        self.assertEqual(list(run.datasets.values_list('dataset_key', 'stage')), [(key_a, RunDataset.MERGED)])
+
+    @responses.activate
+    def test_failed_import_keeps_the_records_of_the_dataset(self):
+        url_a, url_b = gbif_mocks.mock_two_datasets()
+        call_command('populate_resolver', stdout=StringIO())
+        key_a, key_b = 'd34ed8a4-d3cb-473c-a11c-79c5fec4d649', 'a34ed8a4-d3cb-473c-a11c-79c5fec4d640'
+        responses.replace(responses.GET, url_b, body=b'not a zip file', status=200, content_type='application/zip')
+        Dataset.objects.filter(id=key_b).update(data={'label': 'B', 'modified': '2000-01-01T00:00:00.0+0000'})  # Changed
+
+        with self.assertLogs(level='ERROR'):
+            call_command('populate_resolver', stdout=StringIO())
+        self.assertEqual(ResolvableObject.objects.filter(dataset_id=key_b, deleted_date__isnull=True).count(), 23227)
+        self.assertFalse(ResolvableObjectMigration.objects.filter(dataset_id=key_b).exists())
+        run = Run.objects.order_by('id').last()
+        self.assertEqual(run.datasets.get(dataset_key=key_b).stage, RunDataset.DOWNLOADED)
+        self.assertNotIn('modified', Dataset.objects.get(id=key_b).data)  # So the next run imports it again
+
+        with self.assertLogs(level='ERROR'):
+            call_command('populate_resolver', '--dataset', key_b, stdout=StringIO())
+        self.assertEqual(ResolvableObject.objects.filter(dataset_id=key_b, deleted_date__isnull=True).count(), 23227)
+        self.assertEqual(ResolvableObject.objects.filter(dataset_id=key_a, deleted_date__isnull=True).count(), 20191)
+
+    def test_dataset_cannot_be_combined_with_resume(self):
+        with self.assertRaises(CommandError):
+            call_command('populate_resolver', '--dataset', 'a', '--resume', stdout=StringIO())
+
     @responses.activate
     def test_it_does_not_add_datasets_in_big_dict(self):
         self.assertEqual(ResolvableObject.objects.count(), 0)
         mock_datasets = [{'title': 'a', 'doi': 'doi:mine', 'comments': '', 'key': 'b124e1e0-4755-430f-9eab-894f25a9b59c', 'modified': '2021-01-05T08:24:15.254+0000'}]
         mock_json = {'offset': 0, 'limit': 200, 'endOfRecords': 1, 'count': 1, 'results': mock_datasets}
-        api_url = self.GBIF_API_DATASET_URL.format('search?limit=5000&publishingCountry=NO')
+        api_url = self.GBIF_API_DATASET_URL.format('search?limit=1000&offset=0&publishingCountry=NO')
         responses.add(responses.GET, api_url, json=mock_json, status=200)
         self._mock_get_dataset_detailed_info()
         with open(self.SMALL_TEST_FILE, 'rb') as dwc_zip_stream:
@@ -145,7 +288,7 @@ class PopulateResolverTest(TestCase):
         mock_datasets = [{'title': 'A', 'doi': 'doi:mine', 'key': 'd34ed8a4-d3cb-473c-a11c-79c5fec4d649', 'modified': '2021-01-05T08:24:15.254+0000'},
                          {'title': 'B', 'doi': 'doi:mine', 'key': 'a34ed8a4-d3cb-473c-a11c-79c5fec4d640', 'modified': '2021-01-05T08:24:15.254+0000'}]
         mock_json = {'offset': 0, 'limit': 200, 'endOfRecords': 1, 'count': 200, 'results': mock_datasets}
-        api_url = self.GBIF_API_DATASET_URL.format('search?limit=5000&publishingCountry=NO')
+        api_url = self.GBIF_API_DATASET_URL.format('search?limit=1000&offset=0&publishingCountry=NO')
         responses.add(responses.GET, api_url, json=mock_json, status=200)
 
         url = self.GBIF_API_DATASET_URL.format('d34ed8a4-d3cb-473c-a11c-79c5fec4d649')
@@ -214,7 +357,7 @@ class PopulateResolverTest(TestCase):
     def _mock_get_dataset_list(self):  # Mocks out the call to the GBIF api to get a list of datasets
         mock_datasets = [{'title': 'My dataset', 'doi': 'doi:mine', 'comments': 'long comment', 'key': 'd34ed8a4-d3cb-473c-a11c-79c5fec4d649', 'modified': '2021-01-05T08:24:15.254+0000'}]
         mock_json = {'offset': 0, 'limit': 200, 'endOfRecords': 1, 'count': 1, 'results': mock_datasets}
-        api_url = self.GBIF_API_DATASET_URL.format('search?limit=5000&publishingCountry=NO')
+        api_url = self.GBIF_API_DATASET_URL.format('search?limit=1000&offset=0&publishingCountry=NO')
         responses.add(responses.GET, api_url, json=mock_json, status=200)
 
     def _mock_get_dataset_detailed_info(self):
@@ -0,0 +1,83 @@
+from populator.management.commands._prefetch import ArchivePrefetcher
+from django.test import SimpleTestCase
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+
+class ArchivePrefetcherTest(SimpleTestCase):
+    def setUp(self):
+        self.download_dir = tempfile.mkdtemp()
+        self.lock = threading.Lock()
+        self.started = []
+
+    def tearDown(self):
+        shutil.rmtree(self.download_dir)
+
+    def fake_download(self, size=10):
+        def download(dataset_key, url):
+            with self.lock:
+                self.started.append(dataset_key)
+            if url == 'broken':
+                return None
+            time.sleep(0.01)
+            location = os.path.join(self.download_dir, f'{dataset_key}.zip')
+            with open(location, 'wb') as f:
+                f.write(b'x' * size)
+            return location
+        return download
+
+    def test_yields_archives_in_order_serially(self):
+        prefetcher = ArchivePrefetcher(download_dir=self.download_dir, download=self.fake_download())
+        results = list(prefetcher.fetch([('a', 'url'), ('b', 'url')]))
+        self.assertEqual(results, [('a', os.path.join(self.download_dir, 'a.zip')), ('b', os.path.join(self.download_dir, 'b.zip'))])
+
+    def test_yields_archives_in_order_with_workers(self):
+        archives = [(key, 'url') for key in 'abcdefgh']
+        prefetcher = ArchivePrefetcher(download_dir=self.download_dir, workers=3, download=self.fake_download())
+        results = []
+        for dataset_key, zip_file_location in prefetcher.fetch(archives):
+            results.append(dataset_key)
+            self.assertTrue(os.path.exists(zip_file_location))
+            prefetcher.release(dataset_key)
+        self.assertEqual(results, list('abcdefgh'))
+        self.assertEqual(os.listdir(self.download_dir), [])
+
+    def test_yields_none_for_failed_downloads(self):
+        prefetcher = ArchivePrefetcher(download_dir=self.download_dir, workers=2, download=self.fake_download())
+        results = dict(prefetcher.fetch([('a', 'url'), ('b', 'broken'), ('c', 'url')]))
+        self.assertEqual(results['b'], None)
+        self.assertTrue(results['c'])
+
+    def test_prefetches_ahead_of_the_importer(self):
+        prefetcher = ArchivePrefetcher(download_dir=self.download_dir, workers=2, download=self.fake_download())
+        fetched = prefetcher.fetch([(key, 'url') for key in 'abcde'])
+        next(fetched)
+        time.sleep(0.1)
+        self.assertEqual(self.started, ['a', 'b', 'c'])  # The current archive and the next two
+        fetched.close()
+
+    def test_stops_downloading_when_disk_budget_is_full(self):
+        prefetcher = ArchivePrefetcher(download_dir=self.download_dir, workers=3, disk_budget=20, download=self.fake_download(size=10))
+        fetched = prefetcher.fetch([(key, 'url') for key in 'abcde'])
+        next(fetched)
+        time.sleep(0.1)
+        self.assertEqual(self.started, ['a', 'b', 'c'])  # Started before anything was held
+        self.assertEqual(prefetcher.held_bytes(), 30)
+        prefetcher.release('a')
+        time.sleep(0.1)
+        self.assertEqual(self.started, ['a', 'b', 'c'])
+        next(fetched)
+        prefetcher.release('b')
+        time.sleep(0.1)
+        self.assertEqual(self.started, ['a', 'b', 'c', 'd', 'e'])
+        fetched.close()
+
+    def test_release_deletes_archive(self):
+        prefetcher = ArchivePrefetcher(download_dir=self.download_dir, download=self.fake_download())
+        dataset_key, zip_file_location = next(prefetcher.fetch([('a', 'url')]))
+        prefetcher.release(dataset_key)
+        self.assertFalse(os.path.exists(zip_file_location))
+        self.assertEqual(prefetcher.held_bytes(), 0)
@@ -0,0 +1,133 @@
+from populator.management.commands import _rebuild, _cache_data
+from populator.models import History, ResolvableObjectMigration, Run, RunDataset
+from populator.tests import gbif_mocks
+from website.models import ResolvableObject, Dataset
+from website import tables
+from django.core.management import call_command, CommandError
+from django.db import connection
+from django.test import TransactionTestCase
+from datetime import date, timedelta
+from io import StringIO
+from unittest import mock
+import responses
+
+
+class RebuildTest(TransactionTestCase):
+    def setUp(self):
+        self.dataset = Dataset.objects.create(id='dataset_id', data={'title': 'My dataset'})
+        self.other = Dataset.objects.create(id='other', data={'title': 'Other dataset'})
+        long_ago = date.today() - timedelta(days=100)
+        old = [('changed', self.dataset, {'location': 'old'}), ('same', self.dataset, {'location': 'same'}),
+               ('missing', self.dataset, {'location': 'old'}), ('moved', self.dataset, {'location': 'old'}),
+               ('other', self.other, {'location': 'old'})]
+        for id_, dataset, data in old:
+            ResolvableObject.objects.create(id=id_, type='occurrence', dataset=dataset, data=data)
+        ResolvableObject.objects.update(created_date=long_ago)
+        ResolvableObject.objects.filter(id='same').update(deleted_date=long_ago)
+        new = [('changed', self.dataset, {'location': 'new'}), ('same', self.dataset, {'location': 'same'}),
+               ('added', self.dataset, {'location': 'new'}), ('moved', self.other, {'location': 'new'})]
+        for id_, dataset, data in new:
+            ResolvableObjectMigration.objects.create(id=id_, type='occurrence', dataset_id=dataset.id, data=data)
+
+    def tearDown(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {_rebuild.NEXT}, {_rebuild.PREVIOUS}')
+
+    def _contents(self):
+        records = ResolvableObject.objects.order_by('id').values_list('id', 'data', 'dataset_id', 'created_date', 'deleted_date', 'data_hash')
+        history = History.objects.order_by('resolvable_object_id').values_list('resolvable_object_id', 'changed_data')
+        return list(records), list(history)
+
+    def test_gives_the_same_result_as_merging_in_place(self):
+        _rebuild.rebuild_resolvableobject()
+        rebuilt = self._contents()
+        _rebuild.rollback()
+        History.objects.all().delete()
+        _cache_data.merge_in_new_data()
+        self.assertEqual(rebuilt, self._contents())
+        self.assertEqual(rebuilt[1], [('changed', {'location': 'old'})])
+
+    def test_keeps_record_whose_id_another_dataset_imported(self):
+        # 'moved' was imported with the other dataset, which does not take it over, nor is it missing from its own
+        _rebuild.rebuild_resolvableobject()
+        moved = ResolvableObject.objects.get(id='moved')
+        self.assertEqual((moved.dataset_id, moved.data, moved.deleted_date), ('dataset_id', {'location': 'old'}, None))
+        self.assertEqual(ResolvableObject.objects.get(id='missing').deleted_date, date.today())
+
+    def test_gives_the_same_result_as_merging_in_place_for_some_datasets(self):
+        _rebuild.rebuild_resolvableobject(dataset_ids=['other'])
+        rebuilt = self._contents()
+        _rebuild.rollback()
+        History.objects.all().delete()
+        _cache_data.merge_in_new_data(dataset_ids=['other'])
+        self.assertEqual(rebuilt, self._contents())
+
+    def test_keeps_previous_generation_and_rolls_back_to_it(self):
+        before = self._contents()[0]
+        _rebuild.rebuild_resolvableobject()
+        self.assertTrue(_rebuild.has_previous_generation())
+        self.assertEqual(ResolvableObject.objects.get(id='changed').data, {'location': 'new'})
+        call_command('rollback_rebuild', stdout=StringIO())
+        self.assertEqual(self._contents()[0], before)
+        call_command('rollback_rebuild', stdout=StringIO())  # And forward again
+        self.assertEqual(ResolvableObject.objects.get(id='changed').data, {'location': 'new'})
+
+    def test_rollback_without_previous_generation(self):
+        with self.assertRaises(CommandError):
+            call_command('rollback_rebuild', stdout=StringIO())
+
+    def test_swapped_in_table_has_the_same_indexes_constraints_and_triggers(self):
+        def definitions():
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT indexrelid::regclass::text, indisprimary FROM pg_index WHERE indrelid = 'website_resolvableobject'::regclass ORDER BY 1")
+                indexes = cursor.fetchall()
+                cursor.execute("""SELECT conname, conrelid::regclass::text, convalidated FROM pg_constraint
+                                  WHERE conrelid = 'website_resolvableobject'::regclass OR confrelid = 'website_resolvableobject'::regclass ORDER BY 1, 2""")
+                constraints = cursor.fetchall()
+                cursor.execute("SELECT tgname FROM pg_trigger WHERE tgrelid = 'website_resolvableobject'::regclass AND NOT tgisinternal")
+                triggers = cursor.fetchall()
+                cursor.execute("""SELECT inhrelid::regclass::text, indexrelid::regclass::text FROM pg_inherits
+                                  INNER JOIN pg_index ON indrelid = inhrelid
+                                  WHERE inhparent = 'website_resolvableobject'::regclass ORDER BY 1, 2""")
+                return indexes, constraints, triggers, cursor.fetchall()
+
+        before = definitions()
+        self.assertEqual(len({partition for partition, index in before[3]}), 16)
+        _rebuild.rebuild_resolvableobject()
+        self.assertEqual(definitions(), before)
+        ResolvableObject.objects.create(id='created', type='occurrence', dataset=self.dataset, data={'location': 'x'})
+        self.assertIsNotNone(ResolvableObject.objects.get(id='created').data_hash)
+        History.objects.create(resolvable_object_id='created', changed_data={})
+
+    def test_maintain_partitions(self):
+        out = StringIO()
+        call_command('maintain_partitions', '--reindex', '--partition', 'website_resolvableobject_p0', stdout=out)
+        self.assertEqual(out.getvalue().count('\n'), 1)
+        with self.assertRaises(CommandError):
+            call_command('maintain_partitions', '--partition', 'populator_history', stdout=StringIO())
+
+    @responses.activate
+    def test_populate_resolver_with_rebuild(self):
+        ResolvableObjectMigration.objects.all().delete()
+        gbif_mocks.mock_two_datasets()
+        call_command('populate_resolver', '--rebuild', stdout=StringIO())
+        self.assertEqual(ResolvableObject.objects.filter(deleted_date__isnull=True).count(), 20191 + 23227)
+        self.assertEqual(Run.objects.get().stage, Run.FINISHED)
+        self.assertTrue(_rebuild.has_previous_generation())
+
+    def test_resume_carries_on_with_the_rebuild_the_run_started(self):
+        run = Run.objects.create(stage=Run.MERGING, rebuild=True)
+        RunDataset.objects.create(run=run, dataset_key='dataset_id', stage=RunDataset.IMPORTED)
+        RunDataset.objects.create(run=run, dataset_key='other', stage=RunDataset.IMPORTED)
+        with mock.patch.object(tables, 'swap', side_effect=RuntimeError('lock timeout')):
+            with self.assertRaises(RuntimeError):
+                call_command('populate_resolver', '--resume', stdout=StringIO())
+        self.assertTrue(RunDataset.objects.filter(merge_last_id__isnull=False).exists())  # The history was checkpointed
+        self.assertEqual(ResolvableObject.objects.get(id='changed').data, {'location': 'old'})
+
+        call_command('populate_resolver', '--resume', stdout=StringIO())  # Without --rebuild
+        self.assertEqual(ResolvableObject.objects.get(id='changed').data, {'location': 'new'})
+        self.assertEqual(ResolvableObject.objects.get(id='added').data, {'location': 'new'})
+        self.assertTrue(_rebuild.has_previous_generation())
+        run.refresh_from_db()
+        self.assertEqual(run.stage, Run.FINISHED)
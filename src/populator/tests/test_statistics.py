@@ -0,0 +1,45 @@
+from populator.management.commands import _cache_data, _statistics
+from populator.models import RecordCount, ResolvableObjectMigration
+from website.models import ResolvableObject, Dataset
+from django.core.management import call_command
+from django.test import TransactionTestCase
+from io import StringIO
+
+
+class RecordCountTest(TransactionTestCase):
+    def setUp(self):
+        self.dataset = Dataset.objects.create(id='dataset_id', data={'title': 'My dataset'})
+        self.other = Dataset.objects.create(id='other', data={'title': 'Other dataset'})
+        old = [('changed', self.dataset, {'basisofrecord': 'HumanObservation'}), ('same', self.dataset, {'basisofrecord': 'PreservedSpecimen'}),
+               ('undeleted', self.dataset, {'basisofrecord': 'PreservedSpecimen'}), ('missing', self.dataset, {}),
+               ('taken', self.other, {'basisofrecord': 'PreservedSpecimen'})]
+        for id_, dataset, data in old:
+            ResolvableObject.objects.create(id=id_, type='occurrence', dataset=dataset, data=data)
+        ResolvableObject.objects.filter(id='undeleted').update(deleted_date='2020-01-01')
+        _statistics.recount()
+        new = [('changed', {'basisofrecord': 'PreservedSpecimen'}), ('same', {'basisofrecord': 'PreservedSpecimen'}),
+               ('undeleted', {'basisofrecord': 'PreservedSpecimen'}), ('added', {}), ('taken', {'basisofrecord': 'MaterialSample'})]
+        for id_, data in new:
+            ResolvableObjectMigration.objects.create(id=id_, type='occurrence', dataset_id=self.dataset.id, data=data)
+
+    def _counts(self):
+        return sorted(RecordCount.objects.exclude(count=0).values_list('dataset_id', 'type', 'basisofrecord', 'deleted', 'count'))
+
+    def test_merge_keeps_the_counts_up_to_date(self):
+        _cache_data.merge_in_new_data(dataset_ids=['dataset_id'])
+        self.assertEqual(self._counts(), [
+            ('dataset_id', 'occurrence', '', False, 1),  # added
+            ('dataset_id', 'occurrence', '', True, 1),  # missing
+            ('dataset_id', 'occurrence', 'PreservedSpecimen', False, 3),  # changed, same and undeleted
+            ('other', 'occurrence', 'PreservedSpecimen', False, 1),  # taken belongs to the other dataset and is left alone
+        ])
+        merged = self._counts()
+        _statistics.recount()
+        self.assertEqual(self._counts(), merged)
+
+    def test_count_records_command(self):
+        RecordCount.objects.all().delete()
+        out = StringIO()
+        call_command('count_records', '--dataset', 'other', stdout=out)
+        self.assertEqual(self._counts(), [('other', 'occurrence', 'PreservedSpecimen', False, 1)])
+        self.assertIn('total count now 1', out.getvalue())
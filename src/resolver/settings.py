@@ -145,6 +145,17 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 10
 }
 
+# Seconds clients and proxies may reuse a response before revalidating it. The data only changes when the resolver is
+# populated, weekly, and revalidating an unchanged response is cheap
+HTTP_CACHE_MAX_AGE = int(os.environ.get('HTTP_CACHE_MAX_AGE', 86400))
+
+# Cache of rendered list pages (website/result_cache.py): memory, file, django or none
+RESULT_CACHE_BACKEND = os.environ.get('RESULT_CACHE_BACKEND', 'memory')
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 1000))  # Pages kept by each process with the memory backend
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', '/tmp/result-cache')
+RESULT_CACHE_DIR_SIZE = int(os.environ.get('RESULT_CACHE_DIR_SIZE', 2 ** 30))  # Bytes the file backend may take up on disk
+RESULT_CACHE_ALIAS = os.environ.get('RESULT_CACHE_ALIAS', 'default')
+
 INTERNAL_IPS = ['127.0.0.1',]
 def show_toolbar(request):
     return DEBUG
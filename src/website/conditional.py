@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from populator.models import Statistic
+import hashlib
+
+
+class ConditionalMixin:
+    """
+    Answers conditional GET requests with 304 Not Modified before anything is serialized. The data only changes when
+    the resolver is populated, which sets the generation, so the generation is the Last-Modified date of every
+    response and part of the ETag of those which do not override get_validators with something finer.
+    """
+    def get_validators(self, request, *args, **kwargs):
+        """(version, generation) of the response to request, a version of None leaves the request unconditional"""
+        generation = Statistic.objects.get_generation()
+        params = sorted((key, sorted(values)) for key, values in request.query_params.lists())
+        return (f'{generation}:{request.path}:{params}' if generation else None), generation
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional(super().retrieve, request, *args, **kwargs)
+
+    def conditional(self, respond, request, *args, **kwargs):
+        version, generation = self.get_validators(request, *args, **kwargs)
+        self.generation = generation
+        if version is None:
+            return respond(request, *args, **kwargs)
+        # Each renderer gives a different representation, so the media type is part of the ETag
+        etag = quote_etag(hashlib.md5(f'{version}:{request.accepted_renderer.media_type}'.encode()).hexdigest())
+        response = get_conditional_response(request, etag=etag, last_modified=generation)
+        if response is None:
+            response = respond(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if generation:
+                response['Last-Modified'] = http_date(generation)
+            patch_cache_control(response, public=True, max_age=settings.HTTP_CACHE_MAX_AGE)
+            patch_vary_headers(response, ['Accept'])
+        return response
@@ -0,0 +1,68 @@
+from django.db import connection, transaction, OperationalError
+from psycopg2 import errors
+from populator.models import RecordCount
+from .result_cache import MemoryCache
+import json
+
+# Counts for _add_counts=true. Each strategy returns (count, exact), or None if it cannot count the query, and the first
+# which can is used: the record counts kept by the merge for the filters they cover, an exact count of queries the
+# planner expects few results for as long as it takes less than EXACT_COUNT_TIMEOUT, and otherwise the planner's
+# estimate. Counts are kept for the generation they were made in, per filter set.
+RECORD_COUNT_FILTERS = ['dataset_id', 'type', 'basisofrecord']
+PAGINATION_PARAMS = ['offset', 'limit', 'cursor', 'format', '_add_counts']
+EXACT_COUNT_TIMEOUT = '2s'
+EXACT_COUNT_MAX_ESTIMATE = 1000000
+_counts = MemoryCache(10000)
+
+
+def get_filters(request):
+    return {key: item for key, item in request.query_params.items() if key not in PAGINATION_PARAMS}
+
+
+def from_record_counts(filters, queryset):
+    if set(filters) <= set(RECORD_COUNT_FILTERS):
+        return RecordCount.objects.filter(**filters).total(), True
+    return None
+
+
+def exact_within_timeout(filters, queryset):
+    if estimate(queryset) > EXACT_COUNT_MAX_ESTIMATE:
+        return None
+    try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"SET LOCAL statement_timeout = '{EXACT_COUNT_TIMEOUT}'")
+            return queryset.count(), True
+    except OperationalError as e:
+        if isinstance(e.__cause__, errors.QueryCanceled):
+            return None
+        raise
+
+
+def planner_estimate(filters, queryset):
+    return estimate(queryset), False
+
+
+STRATEGIES = [from_record_counts, exact_within_timeout, planner_estimate]
+
+
+def estimate(queryset):
+    """The number of rows the planner expects queryset to return"""
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    # psycopg2 only parses json columns, EXPLAIN gives text
+    plan = json.loads(plan) if isinstance(plan, str) else plan
+    return plan[0]['Plan']['Plan Rows']
+
+
+def count(request, queryset, generation=None):
+    """(count, exact) of queryset, the results of request, cached for generation if it is given"""
+    filters = get_filters(request)
+    key = (generation, tuple(sorted(filters.items())))
+    result = _counts.get(key) if generation else None
+    if result is None:
+        result = next(result for result in (strategy(filters, queryset) for strategy in STRATEGIES) if result)
+        if generation:
+            _counts.set(key, result)
+    return result
@@ -0,0 +1,55 @@
+from django.db import transaction
+from .models import ResolvableObject
+from .serializers import ResolvableObjectSerializer
+import json
+import zlib
+
+# The records of a dataset streamed to the client, so that aggregators can fetch a dataset in one request instead of
+# crawling its pages. Records are read through a server side cursor and written out CHUNK_SIZE at a time, so memory
+# use stays the same however large the dataset is.
+CHUNK_SIZE = 2000
+
+
+def records(dataset):
+    """The records of dataset as the resolver serializes them, in no particular order"""
+    serializer = ResolvableObjectSerializer()
+    # In a transaction, as outside of one the cursor would be kept open past it and Postgres would materialize all of
+    # the results before the first row is read
+    with transaction.atomic():
+        for obj in ResolvableObject.objects.filter(dataset=dataset).iterator(chunk_size=CHUNK_SIZE):
+            obj.dataset = dataset  # The same for all of them, rather than joined into every row
+            yield serializer.to_representation(obj)
+
+
+def ndjson(dataset):
+    for record in records(dataset):
+        yield json.dumps(record) + '\n'
+
+
+def jsonld(dataset):
+    """A JSON-LD array of the records, each with its own context"""
+    yield '['
+    for i, record in enumerate(records(dataset)):
+        yield (',\n' if i else '\n') + json.dumps(record)
+    yield '\n]\n'
+
+
+def chunked(lines, size=CHUNK_SIZE):
+    """lines encoded and joined size at a time, so the response is not written a record at a time"""
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == size:
+            yield ''.join(chunk).encode()
+            chunk = []
+    if chunk:
+        yield ''.join(chunk).encode()
+
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(wbits=31)  # 16 + 15, a gzip header and trailer rather than zlib's
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -0,0 +1,31 @@
+# Generated by Django 3.1.14 on 2026-10-18 15:52
+
+from django.db import migrations, models
+
+# data_hash is always worked out by the database, from the canonical text of the jsonb, so it cannot go stale
+SET_DATA_HASH = ("CREATE OR REPLACE FUNCTION set_data_hash() RETURNS trigger AS $$"
+                 " BEGIN"
+                 "   NEW.data_hash = md5(NEW.data::text);"
+                 "   RETURN NEW;"
+                 " END;"
+                 " $$ LANGUAGE plpgsql;")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('website', '0004_auto_20230103_1613'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resolvableobject',
+            name='data_hash',
+            field=models.CharField(blank=True, editable=False, max_length=32, null=True),
+        ),
+        migrations.RunSQL(SET_DATA_HASH, 'DROP FUNCTION IF EXISTS set_data_hash();'),
+        migrations.RunSQL(
+            'CREATE TRIGGER website_resolvableobject_data_hash BEFORE INSERT OR UPDATE OF data ON website_resolvableobject FOR EACH ROW EXECUTE PROCEDURE set_data_hash();',
+            'DROP TRIGGER IF EXISTS website_resolvableobject_data_hash ON website_resolvableobject;'
+        ),
+    ]
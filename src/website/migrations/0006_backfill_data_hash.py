@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+BATCH_SIZE = 50000
+
+
+def backfill_data_hash(apps, schema_editor):
+    # In batches which each commit on their own, so existing rows are not all locked and rewritten in one transaction
+    with schema_editor.connection.cursor() as cursor:
+        last_id = ''
+        while True:
+            cursor.execute("""WITH batch AS (
+                                  SELECT id FROM website_resolvableobject WHERE id > %s ORDER BY id LIMIT %s
+                              ), updated AS (
+                                  UPDATE website_resolvableobject SET data_hash = md5(data::text)
+                                  FROM batch WHERE website_resolvableobject.id = batch.id AND data_hash IS NULL
+                              )
+                              SELECT max(id) FROM batch""", [last_id, BATCH_SIZE])
+            last_id = cursor.fetchone()[0]
+            if last_id is None:
+                return
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('website', '0005_resolvableobject_data_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_data_hash, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='resolvableobject',
+            index=models.Index(fields=['id', 'data_hash'], name='website_res_id_hash_idx'),
+        ),
+    ]
@@ -0,0 +1,114 @@
+from django.db import connection, migrations, transaction
+import re
+
+# The statements are written out here rather than taken from website.tables, so the migration keeps doing what it did
+# when it was written however that module changes. Indexes of the copy get the suffix _converting, which is taken off
+# when it is swapped in; partitions are named <table>_p<n>
+TABLE = 'website_resolvableobject'
+CONVERTING = TABLE + '_converting'
+SUFFIX = '_converting'
+PARTITIONS = 16
+BATCH_SIZE = 50000
+
+
+def create_copy(cursor, partitions):
+    cursor.execute(f'DROP TABLE IF EXISTS {CONVERTING}')
+    partition_by = ' PARTITION BY HASH (id)' if partitions else ''
+    cursor.execute(f'CREATE TABLE {CONVERTING} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING STORAGE){partition_by}')
+    for remainder in range(partitions or 0):
+        cursor.execute(f'CREATE TABLE {CONVERTING}_p{remainder} PARTITION OF {CONVERTING} '
+                       f'FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})')
+
+
+def copy_indexes_constraints_and_triggers(cursor):
+    cursor.execute("""SELECT pg_index.indexrelid::regclass::text, pg_get_indexdef(pg_index.indexrelid), pg_constraint.contype
+                      FROM pg_index
+                      LEFT JOIN pg_constraint ON pg_constraint.conindid = pg_index.indexrelid AND pg_constraint.conrelid = pg_index.indrelid
+                      WHERE pg_index.indrelid = %s::regclass""", [TABLE])
+    for name, definition, constraint_type in cursor.fetchall():
+        if constraint_type:
+            cursor.execute('SELECT pg_get_constraintdef(oid) FROM pg_constraint WHERE conindid = %s::regclass AND conrelid = %s::regclass',
+                           [name, TABLE])
+            cursor.execute(f'ALTER TABLE {CONVERTING} ADD CONSTRAINT {name}{SUFFIX} {cursor.fetchone()[0]}')
+        else:
+            cursor.execute(re.sub(r'^(CREATE (?:UNIQUE )?INDEX) \S+ ON (?:ONLY )?\S+ ', rf'\1 {name}{SUFFIX} ON {CONVERTING} ', definition))
+
+    cursor.execute("""SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+                      WHERE conrelid = %s::regclass AND contype NOT IN ('p', 'u', 'x', 'n') AND conparentid = 0""", [TABLE])
+    for name, definition in cursor.fetchall():
+        cursor.execute(f'ALTER TABLE {CONVERTING} ADD CONSTRAINT {name} {definition}')
+
+    cursor.execute('SELECT pg_get_triggerdef(oid) FROM pg_trigger WHERE tgrelid = %s::regclass AND NOT tgisinternal', [TABLE])
+    for definition, in cursor.fetchall():
+        cursor.execute(re.sub(r' ON \S+ ', f' ON {CONVERTING} ', definition, count=1))
+
+
+def swap():
+    # The foreign keys referencing the table (from populator_history, which is not partitioned at this point) are
+    # moved to the copy without checking the rows while the locks are held, and validated afterwards
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("SET LOCAL lock_timeout = '10s'")
+        cursor.execute("""SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) FROM pg_constraint
+                          WHERE confrelid = %s::regclass AND contype = 'f' AND conparentid = 0""", [TABLE])
+        foreign_keys = cursor.fetchall()
+        for referencing_table, name, definition in foreign_keys:
+            cursor.execute(f'ALTER TABLE {referencing_table} DROP CONSTRAINT {name}')
+        cursor.execute(f'DROP TABLE {TABLE}')
+
+        cursor.execute('SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = %s::regclass', [CONVERTING])
+        for index, in cursor.fetchall():
+            cursor.execute(f'ALTER INDEX {index} RENAME TO {index[:-len(SUFFIX)]}')
+        cursor.execute('SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = %s::regclass', [CONVERTING])
+        for partition, in cursor.fetchall():
+            new_partition = TABLE + partition[len(CONVERTING):]
+            cursor.execute('SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = %s::regclass', [partition])
+            for index, in cursor.fetchall():
+                if index.startswith(partition):
+                    cursor.execute(f'ALTER INDEX {index} RENAME TO {new_partition}{index[len(partition):]}')
+            cursor.execute(f'ALTER TABLE {partition} RENAME TO {new_partition}')
+        cursor.execute(f'ALTER TABLE {CONVERTING} RENAME TO {TABLE}')
+
+        for referencing_table, name, definition in foreign_keys:
+            cursor.execute(f'ALTER TABLE {referencing_table} ADD CONSTRAINT {name} {definition} NOT VALID')
+    with connection.cursor() as cursor:
+        for referencing_table, name, definition in foreign_keys:
+            cursor.execute(f'ALTER TABLE {referencing_table} VALIDATE CONSTRAINT {name}')
+
+
+def convert(partitions):
+    # Copies the table into a new one in batches which each commit on their own, then swaps it in. The API keeps
+    # reading the old table while it is copied, populate_resolver must not run until the migration is done
+    with connection.cursor() as cursor:
+        create_copy(cursor, partitions)
+        last_id = ''
+        while last_id is not None:
+            cursor.execute(f"""WITH batch AS (
+                                   INSERT INTO {CONVERTING} SELECT * FROM {TABLE} WHERE id > %s ORDER BY id LIMIT %s
+                                   RETURNING id
+                               )
+                               SELECT max(id) FROM batch""", [last_id, BATCH_SIZE])
+            last_id = cursor.fetchone()[0]
+        copy_indexes_constraints_and_triggers(cursor)
+    swap()
+    with connection.cursor() as cursor:
+        cursor.execute(f'ANALYZE {TABLE}')
+
+
+def partition(apps, schema_editor):
+    convert(PARTITIONS)
+
+
+def unpartition(apps, schema_editor):
+    convert(None)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('website', '0006_backfill_data_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition, unpartition),
+    ]
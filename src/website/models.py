@@ -18,10 +18,14 @@ class ResolvableObject(models.Model):
     dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE)
     created_date = models.DateField(auto_now_add=True)
     deleted_date = models.DateField(null=True, blank=True)
+    data_hash = models.CharField(max_length=32, null=True, blank=True, editable=False)  # md5 of data, set by a trigger
 
     class Meta:
+        # The table is hash partitioned by id (migration 0007), indexes added here are built on every partition and
+        # cannot be added concurrently
         indexes = [
-            GinIndex(fields=['data'])
+            GinIndex(fields=['data']),
+            models.Index(fields=['id', 'data_hash'], name='website_res_id_hash_idx'),
         ]
         # CREATE INDEX idxginscientificname ON website_resolvableobject USING GIN ((data -> 'scientificname'));
         # CREATE INDEX ro_data_gin_idx ON website_resolvableobject USING GIN (data jsonb_path_ops);
@@ -1,7 +1,8 @@
-from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.pagination import LimitOffsetPagination, CursorPagination
 from rest_framework.response import Response
-from populator.models import Statistic
+from rest_framework.utils.urls import replace_query_param
 from collections import OrderedDict
+from . import counting
 
 
 class CustomPagination(LimitOffsetPagination):
@@ -17,11 +18,56 @@ class CustomPagination(LimitOffsetPagination):
 
 
 class CustomCountPagination(LimitOffsetPagination):
-    def get_count(self, queryset):
-        no_filters = ['WHERE "website_resolvableobject"."data" @> {}',
-                      'WHERE "website_resolvableobject"."data" @> \'{}\'']
-        if no_filters[0] in str(queryset.query) or no_filters[1] in str(queryset.query):
-            return Statistic.objects.get_total_count()
-        elif 'WHERE "website_resolvableobject"."data" @> {"basisofrecord": "Preservedspecimen"}' in str(queryset.query):
-            return Statistic.objects.get_preserved_specimen_count()
-        return queryset.count()
\ No newline at end of file
+    # The count may be an estimate (website/counting.py), so pages are not cut off at it and whether there is a next
+    # page is told by whether this one is full
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        self.offset = self.get_offset(request)
+        self.count, self.count_exact = counting.count(request, queryset, getattr(view, 'generation', None))
+        if self.count > self.limit and self.template is not None:
+            self.display_page_controls = True
+        self.page = list(queryset[self.offset:self.offset + self.limit])
+        return self.page
+
+    def get_next_link(self):
+        if self.count_exact:
+            return super().get_next_link()
+        if len(self.page) < self.limit:
+            return None
+        url = replace_query_param(self.request.build_absolute_uri(), self.limit_query_param, self.limit)
+        return replace_query_param(url, self.offset_query_param, self.offset + self.limit)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('count', self.count),
+            ('count_exact', self.count_exact),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+
+class IdCursorPagination(CursorPagination):
+    """
+    Pages through the records in id order, each page starting after the last id of the one before, so a page costs the
+    same however deep it is. The count is only given with _add_counts=true.
+    """
+    ordering = 'id'
+    page_size_query_param = 'limit'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = self.count_exact = None
+        if request.query_params.get('_add_counts') == 'true':
+            self.count, self.count_exact = counting.count(request, queryset, getattr(view, 'generation', None))
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        response = OrderedDict([('next', self.get_next_link()), ('previous', self.get_previous_link())])
+        if self.count is not None:
+            response['count'] = self.count
+            response['count_exact'] = self.count_exact
+        response['results'] = data
+        return Response(response)
@@ -37,3 +37,25 @@ class JSONLDRenderer(BaseRenderer):
 
         return json.dumps(data)
 
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Renderer for newline delimited JSON, one object a line. The dataset export streams its records itself, this only
+    renders errors
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return ''
+
+        return json.dumps(data) + '\n'
+
+
+class JSONLDExportRenderer(JSONLDRenderer):
+    """
+    JSON-LD as asked for from the dataset export, with ?format=jsonld
+    """
+    format = 'jsonld'
@@ -0,0 +1,187 @@
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+# Rendered pages of list queries, so the same search asked for again by a portal does not go through the GIN index
+# again. Keys include the generation set when populate_resolver finishes, so a populate makes every cached page stale
+# whichever process cached it. The backend is chosen with RESULT_CACHE_BACKEND: memory (an LRU in each process), file (a
+# directory shared by the processes on a host), django (the Django cache named RESULT_CACHE_ALIAS, e.g. a local
+# memcached) or none. Entries are (content, content type).
+
+
+class MemoryCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class FileCache:
+    # An entry is its content type on the first line and its content after it, in a directory named after the first two
+    # characters of its key. Reading an entry touches it, so the modification times order the entries by their last use
+    # and the least recently used ones are removed once the entries take up more than max_bytes. Each process only looks
+    # at the size of the directory after it has written a tenth of max_bytes, so together they can go over it a little
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.written = 0
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as file:
+                content_type = file.readline()[:-1].decode()
+                content = file.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(self.path(key))
+        except OSError:
+            pass  # Evicted since
+        return content, content_type
+
+    def set(self, key, value):
+        # Written to a temporary file and moved into place, so a reader never sees half an entry. Caching is best
+        # effort: the directory can be removed by clear() in another process while the entry is written, and the
+        # response is served all the same
+        content, content_type = value
+        data = content_type.encode() + b'\n' + content
+        try:
+            os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as file:
+                file.write(data)
+            try:
+                os.replace(file.name, self.path(key))
+            except OSError:
+                os.remove(file.name)
+                raise
+        except OSError:
+            return
+        with self.lock:
+            self.written += len(data)
+            if self.written < self.max_bytes / 10:
+                return
+            self.written = 0
+        self.evict()
+
+    def entries(self):
+        """(last used, size, path) of the entries"""
+        entries = []
+        for directory in os.scandir(self.directory):
+            if not directory.is_dir():
+                continue  # Temporary files being written
+            for entry in os.scandir(directory.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        """Removes the least recently used entries until the rest take up no more than max_bytes"""
+        try:
+            entries = sorted(self.entries())
+        except FileNotFoundError:
+            return  # Cleared
+        size = sum(entry_size for last_used, entry_size, path in entries)
+        for last_used, entry_size, path in entries:
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class DjangoCache:
+    def __init__(self, alias):
+        self.cache = caches[alias]
+
+    def get(self, key):
+        return self.cache.get(f'result:{key}')
+
+    def set(self, key, value):
+        self.cache.set(f'result:{key}', value, timeout=None)
+
+    def clear(self):
+        self.cache.clear()
+
+
+_caches = {}
+
+
+def get_cache():
+    """The cache of RESULT_CACHE_BACKEND, None if results are not cached"""
+    backend = settings.RESULT_CACHE_BACKEND
+    if backend not in _caches:
+        if backend == 'memory':
+            _caches[backend] = MemoryCache(settings.RESULT_CACHE_SIZE)
+        elif backend == 'file':
+            _caches[backend] = FileCache(settings.RESULT_CACHE_DIR, settings.RESULT_CACHE_DIR_SIZE)
+        elif backend == 'django':
+            _caches[backend] = DjangoCache(settings.RESULT_CACHE_ALIAS)
+        else:
+            _caches[backend] = None
+    return _caches[backend]
+
+
+def clear():
+    cache = get_cache()
+    if cache:
+        cache.clear()
+
+
+def make_key(generation, path, query_params, media_type):
+    """The same for requests whatever the order of their parameters"""
+    params = sorted((key, sorted(values)) for key, values in query_params.lists())
+    return hashlib.sha1(repr((generation, path, params, media_type)).encode()).hexdigest()
+
+
+def cached_response(key, respond):
+    """
+    The response respond() gives, from the cache if an identical request was answered before. respond returns a response
+    ready to render, only successful ones are cached.
+    """
+    cache = get_cache()
+    entry = cache.get(key) if cache else None
+    if entry:
+        content, content_type = entry
+        return HttpResponse(content, content_type=content_type)
+    response = respond()
+    if cache and response.status_code == 200:
+        response.render()
+        cache.set(key, (response.content, response['Content-Type']))
+    return response
@@ -0,0 +1,134 @@
+from django.db import connection, transaction
+import re
+
+# Building a copy of a table next to it and swapping it in by renames, used to partition website_resolvableobject and to
+# rebuild it. Index names are unique in the schema, so the indexes of a copy get a suffix which is taken off when it is
+# swapped in. Partitions are named after their table, <table>_p<n>, and are renamed with it.
+
+
+def create_copy(table, new_table, partitions=None):
+    """Empty table with the columns of table and no indexes, hash partitioned by id into partitions if given"""
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {new_table}')
+        partition_by = ' PARTITION BY HASH (id)' if partitions else ''
+        cursor.execute(f'CREATE TABLE {new_table} (LIKE {table} INCLUDING DEFAULTS INCLUDING STORAGE){partition_by}')
+        for remainder in range(partitions or 0):
+            cursor.execute(f'CREATE TABLE {new_table}_p{remainder} PARTITION OF {new_table} '
+                           f'FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder})')
+
+
+def partition_count(table):
+    """The number of hash partitions of table, None if it is not partitioned"""
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT count(*) FROM pg_inherits WHERE inhparent = %s::regclass', [table])
+        return cursor.fetchone()[0] or None
+
+
+def get_partitions(table):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = %s::regclass ORDER BY 1', [table])
+        return [partition for partition, in cursor.fetchall()]
+
+
+def copy_indexes_constraints_and_triggers(table, new_table, suffix, exclude=()):
+    # Indexes on a partitioned table are built partition by partition. Constraints which are not indexes and triggers
+    # belong to their table and keep their names. Indexes and constraints named in exclude are left out
+    with connection.cursor() as cursor:
+        cursor.execute("""SELECT pg_index.indexrelid::regclass::text, pg_get_indexdef(pg_index.indexrelid), pg_constraint.contype
+                          FROM pg_index
+                          LEFT JOIN pg_constraint ON pg_constraint.conindid = pg_index.indexrelid AND pg_constraint.conrelid = pg_index.indrelid
+                          WHERE pg_index.indrelid = %s::regclass""", [table])
+        for name, definition, constraint_type in cursor.fetchall():
+            if name in exclude:
+                continue
+            if constraint_type:
+                cursor.execute('SELECT pg_get_constraintdef(oid) FROM pg_constraint WHERE conindid = %s::regclass AND conrelid = %s::regclass',
+                               [name, table])
+                cursor.execute(f'ALTER TABLE {new_table} ADD CONSTRAINT {name}{suffix} {cursor.fetchone()[0]}')
+            else:
+                cursor.execute(re.sub(r'^(CREATE (?:UNIQUE )?INDEX) \S+ ON (?:ONLY )?\S+ ', rf'\1 {name}{suffix} ON {new_table} ', definition))
+
+        cursor.execute("""SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+                          WHERE conrelid = %s::regclass AND contype NOT IN ('p', 'u', 'x', 'n') AND conparentid = 0""", [table])
+        for name, definition in cursor.fetchall():
+            if name not in exclude:
+                cursor.execute(f'ALTER TABLE {new_table} ADD CONSTRAINT {name} {definition}')
+
+        cursor.execute('SELECT pg_get_triggerdef(oid) FROM pg_trigger WHERE tgrelid = %s::regclass AND NOT tgisinternal', [table])
+        for definition, in cursor.fetchall():
+            cursor.execute(re.sub(r' ON \S+ ', f' ON {new_table} ', definition, count=1))
+
+
+def swap(table, renames, drop=None, lock_timeout='10s'):
+    """
+    Renames tables with their indexes and partitions in one short transaction. renames is a list of (table, new name,
+    suffix of its index names, new suffix), drop a table which is dropped first. Foreign keys referencing table are
+    moved to whichever table has its name afterwards, without checking existing rows while the locks are held; they
+    are validated once the swap is committed.
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+        cursor.execute("""SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) FROM pg_constraint
+                          WHERE confrelid = %s::regclass AND contype = 'f' AND conparentid = 0""", [table])
+        foreign_keys = cursor.fetchall()
+        for referencing_table, name, definition in foreign_keys:
+            cursor.execute(f'ALTER TABLE {referencing_table} DROP CONSTRAINT {name}')
+        if drop:
+            cursor.execute(f'DROP TABLE IF EXISTS {drop}')
+        for old_name, new_name, suffix, new_suffix in renames:
+            rename_table(cursor, old_name, new_name, suffix, new_suffix)
+        # A partitioned table cannot take a NOT VALID foreign key, its partitions get one each instead
+        for referencing_table, name, definition in foreign_keys:
+            for partition in get_leaf_partitions(referencing_table):
+                cursor.execute(f'ALTER TABLE {partition} ADD CONSTRAINT {name} {definition} NOT VALID')
+    with connection.cursor() as cursor:
+        for referencing_table, name, definition in foreign_keys:
+            partitions = get_leaf_partitions(referencing_table)
+            for partition in partitions:
+                cursor.execute(f'ALTER TABLE {partition} VALIDATE CONSTRAINT {name}')
+            if partitions != [referencing_table]:
+                # Takes over the validated foreign keys of the partitions without checking the rows again
+                cursor.execute(f'ALTER TABLE {referencing_table} ADD CONSTRAINT {name} {definition}')
+
+
+def get_leaf_partitions(table):
+    """The partitions of table which hold its rows, the table itself if it is not partitioned"""
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT relid::text FROM pg_partition_tree(%s::regclass) WHERE isleaf ORDER BY 1', [table])
+        return [partition for partition, in cursor.fetchall()] or [table]
+
+
+def rename_table(cursor, table, new_table, suffix, new_suffix):
+    cursor.execute('SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = %s::regclass', [table])
+    for index, in cursor.fetchall():
+        cursor.execute(f'ALTER INDEX {index} RENAME TO {index[:len(index) - len(suffix)]}{new_suffix}')
+    # Partitions and their indexes are named after the table
+    for partition in get_partitions(table):
+        new_partition = new_table + partition[len(table):]
+        cursor.execute('SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = %s::regclass', [partition])
+        for index, in cursor.fetchall():
+            if index.startswith(partition):
+                cursor.execute(f'ALTER INDEX {index} RENAME TO {new_partition}{index[len(partition):]}')
+        cursor.execute(f'ALTER TABLE {partition} RENAME TO {new_partition}')
+    cursor.execute(f'ALTER TABLE {table} RENAME TO {new_table}')
+
+
+def create_index_concurrently(table, name, definition):
+    """
+    Builds an index like definition (as given by pg_get_indexdef) on table as name, without blocking writes. A
+    partitioned table cannot have its index built concurrently, so it is built on each partition and the partition
+    indexes are attached to an index on the table itself, which is valid once all of them are.
+    """
+    def on(index, relation, concurrently=''):
+        return re.sub(r'^(CREATE (?:UNIQUE )?INDEX) \S+ ON (?:ONLY )?\S+ ', rf'\1 {concurrently}{index} ON {relation} ', definition)
+
+    partitions = get_partitions(table)
+    with connection.cursor() as cursor:
+        if not partitions:
+            cursor.execute(on(name, table, 'CONCURRENTLY '))
+            return
+        for partition in partitions:
+            cursor.execute(on(f'{partition}_{name}', partition, 'CONCURRENTLY '))
+        cursor.execute(on(name, f'ONLY {table}'))
+        for partition in partitions:
+            cursor.execute(f'ALTER INDEX {name} ATTACH PARTITION {partition}_{name}')
@@ -0,0 +1,80 @@
+from website.models import ResolvableObject, Dataset
+from website import result_cache
+from populator.models import Statistic, History
+from rest_framework.test import APITestCase
+from rest_framework.reverse import reverse
+from django.utils.http import http_date
+
+
+class ConditionalRequestTests(APITestCase):
+    def setUp(self):
+        result_cache.clear()
+        self.dataset = Dataset.objects.create(id='d', data={'label': 'My dataset', 'type': 'occurrence'})
+        self.object = ResolvableObject.objects.create(id='abc', dataset=self.dataset, data={'id': 'abc', 'test': 'a'})
+        History.objects.create(resolvable_object=self.object, changed_data={'test': 'b'})
+        self.generation = Statistic.objects.set_generation()
+        self.url = reverse('resolvableobject-detail', ['abc'])
+
+    def _get(self, url, **headers):
+        return self.client.get(url, HTTP_ACCEPT='application/ld+json', **headers)
+
+    def test_sets_validators_and_cache_control(self):
+        response = self._get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['ETag'].startswith('"'))
+        self.assertEqual(response['Last-Modified'], http_date(self.generation))
+        self.assertIn('max-age=', response['Cache-Control'])
+        self.assertIn('Accept', response['Vary'])
+
+    def test_unchanged_record_is_not_modified_without_loading_it(self):
+        etag = self._get(self.url)['ETag']
+        with self.assertNumQueries(1):
+            response = self._get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_record_keeps_its_etag_over_a_populate_which_leaves_it_unchanged(self):
+        etag = self._get(self.url)['ETag']
+        Statistic.objects.set_generation()
+        self.assertEqual(self._get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_changed_record_gets_a_new_etag(self):
+        etag = self._get(self.url)['ETag']
+        self.object.data = {'id': 'abc', 'test': 'changed'}
+        self.object.save()
+        response = self._get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_changed_dataset_changes_the_etag_of_its_records(self):
+        etag = self._get(self.url)['ETag']
+        self.dataset.data = {'label': 'Renamed dataset', 'type': 'occurrence'}
+        self.dataset.save()
+        self.assertEqual(self._get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_representations_have_different_etags(self):
+        self.assertNotEqual(self._get(self.url)['ETag'], self.client.get(self.url, HTTP_ACCEPT='application/json')['ETag'])
+
+    def test_not_modified_since_the_last_populate(self):
+        response = self._get(self.url, HTTP_IF_MODIFIED_SINCE=http_date(self.generation))
+        self.assertEqual(response.status_code, 304)
+
+    def test_modified_by_a_later_populate(self):
+        url = reverse('history-list')
+        last_modified = self._get(url)['Last-Modified']
+        self.assertEqual(self._get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        Statistic.objects.filter(name='generation').update(value=self.generation + 10)
+        self.assertEqual(self._get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 200)
+
+    def test_lists_change_etag_with_the_generation(self):
+        for url in [reverse('history-list'), reverse('dataset-list'), reverse('resolvableobject-list') + '?test=a']:
+            etag = self._get(url)['ETag']
+            self.assertEqual(self._get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            Statistic.objects.filter(name='generation').update(value=self.generation + 10)
+            self.assertEqual(self._get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+            Statistic.objects.filter(name='generation').update(value=self.generation)
+
+    def test_missing_record_has_no_validators(self):
+        response = self._get(reverse('resolvableobject-detail', ['missing']))
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(response.has_header('ETag'))
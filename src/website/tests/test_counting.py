@@ -0,0 +1,74 @@
+from website.models import ResolvableObject, Dataset
+from website import counting
+from populator.management.commands import _statistics
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, APITestCase
+from rest_framework.request import Request
+from rest_framework.reverse import reverse
+from unittest import mock
+
+
+class CountingTests(TestCase):
+    def setUp(self):
+        self.dataset = Dataset.objects.create(id='d', data={'label': 'My dataset', 'type': 'occurrence'})
+        for item in 'abcde':
+            ResolvableObject.objects.create(id=item, dataset=self.dataset, type='occurrence', data={'id': item, 'scientificname': 'Galium'})
+        _statistics.recount()
+
+    def _count(self, query, queryset=None, generation=None):
+        request = Request(APIRequestFactory().get('/' + query))
+        return counting.count(request, queryset if queryset is not None else ResolvableObject.objects.all(), generation)
+
+    def test_counts_from_record_counts(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self._count('?dataset_id=d&limit=1&_add_counts=true'), (5, True))
+
+    def test_counts_exactly_when_few_results_are_expected(self):
+        queryset = ResolvableObject.objects.filter(data__contains={'scientificname': 'Galium'})
+        self.assertEqual(self._count('?scientificname=Galium', queryset), (5, True))
+
+    @mock.patch.object(counting, 'EXACT_COUNT_MAX_ESTIMATE', 0)
+    def test_estimates_when_many_results_are_expected(self):
+        count, exact = self._count('?scientificname=Galium', ResolvableObject.objects.filter(data__contains={'scientificname': 'Galium'}))
+        self.assertFalse(exact)
+        self.assertGreaterEqual(count, 1)
+
+    @mock.patch.object(counting, 'EXACT_COUNT_TIMEOUT', '1ms')
+    def test_estimates_when_the_exact_count_takes_too_long(self):
+        queryset = ResolvableObject.objects.extra(where=['pg_sleep(0.01) IS NOT NULL'])
+        count, exact = self._count('?slow=true', queryset)
+        self.assertFalse(exact)
+
+    def test_caches_counts_per_generation_and_filters(self):
+        queryset = ResolvableObject.objects.filter(data__contains={'scientificname': 'Galium'})
+        self._count('?scientificname=Galium&offset=5', queryset, generation=1)
+        with self.assertNumQueries(0):
+            self.assertEqual(self._count('?scientificname=Galium&limit=2', queryset, generation=1), (5, True))
+        with CaptureQueriesContext(connection) as queries:
+            self._count('?scientificname=Galium', queryset, generation=2)
+        self.assertTrue(any('COUNT(*)' in query['sql'] for query in queries))
+
+
+class EstimatedCountPaginationTests(APITestCase):
+    def setUp(self):
+        dataset = Dataset.objects.create(id='d', data={'label': 'My dataset', 'type': 'occurrence'})
+        for item in 'abcde':
+            ResolvableObject.objects.create(id=item, dataset=dataset, data={'id': item, 'scientificname': 'Galium'})
+
+    @mock.patch.object(counting, 'EXACT_COUNT_MAX_ESTIMATE', 0)
+    def test_pages_are_not_cut_off_at_an_estimated_count(self):
+        url = reverse('resolvableobject-list') + '?scientificname=Galium&limit=2&_add_counts=true'
+        ids = []
+        while url:
+            results = self.client.get(url, HTTP_ACCEPT='application/ld+json').json()
+            self.assertFalse(results['count_exact'])
+            ids += [result['owl:sameas'] for result in results['results']]
+            url = results['next']
+        self.assertEqual(ids, ['a', 'b', 'c', 'd', 'e'])
+
+    def test_exact_count(self):
+        url = reverse('resolvableobject-list') + '?scientificname=Galium&limit=2&_add_counts=true'
+        results = self.client.get(url, HTTP_ACCEPT='application/ld+json').json()
+        self.assertEqual((results['count'], results['count_exact']), (5, True))
@@ -0,0 +1,58 @@
+from website.models import ResolvableObject, Dataset
+from rest_framework.test import APITestCase
+from rest_framework.reverse import reverse
+import gzip
+import json
+
+
+class ExportTests(APITestCase):
+    def setUp(self):
+        self.dataset = Dataset.objects.create(id='d', data={'label': 'My dataset', 'type': 'occurrence'})
+        other = Dataset.objects.create(id='other', data={'label': 'Other dataset', 'type': 'occurrence'})
+        for item in 'abcde':
+            ResolvableObject.objects.create(id=item, dataset=self.dataset, type='occurrence', data={'id': item, 'scientificname': 'Galium'})
+        ResolvableObject.objects.create(id='f', dataset=other, data={'id': 'f'})
+        self.url = reverse('dataset-export', ['d'])
+
+    def _content(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_exports_records_as_ndjson(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        records = [json.loads(line) for line in self._content(response).decode().splitlines()]
+        self.assertEqual(sorted(record['owl:sameas'] for record in records), ['a', 'b', 'c', 'd', 'e'])
+        detail = self.client.get(reverse('resolvableobject-detail', ['a']), HTTP_ACCEPT='application/ld+json').json()
+        self.assertIn(detail, records)
+
+    def test_exports_records_as_jsonld(self):
+        response = self.client.get(self.url + '?format=jsonld')
+        self.assertEqual(response['Content-Type'], 'application/ld+json')
+        records = json.loads(self._content(response))
+        self.assertEqual(len(records), 5)
+        self.assertEqual(records[0]['dc:isPartOf']['label'], 'My dataset')
+
+    def test_exports_empty_dataset(self):
+        Dataset.objects.create(id='empty', data={'label': 'Empty', 'type': 'occurrence'})
+        response = self.client.get(reverse('dataset-export', ['empty']) + '?format=jsonld')
+        self.assertEqual(json.loads(self._content(response)), [])
+
+    def test_gzips_for_clients_which_accept_it(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(len(gzip.decompress(self._content(response)).decode().splitlines()), 5)
+
+    def test_queries_do_not_grow_with_the_records(self):
+        with self.assertNumQueries(4):  # The dataset, and the server side cursor the records are fetched through in a savepoint
+            response = self.client.get(self.url)
+            self._content(response)
+        for item in 'ghijk':
+            ResolvableObject.objects.create(id=item, dataset=self.dataset, data={'id': item})
+        with self.assertNumQueries(4):
+            response = self.client.get(self.url)
+            self._content(response)
+
+    def test_missing_dataset(self):
+        response = self.client.get(reverse('dataset-export', ['missing']))
+        self.assertEqual(response.status_code, 404)
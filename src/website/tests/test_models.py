@@ -1,5 +1,6 @@
 from django.test import TestCase
 from website.models import ResolvableObject, Dataset
+from django.db import connection
 from django.db.utils import IntegrityError
 
 
@@ -20,3 +21,22 @@ class ResolvableObjectModelTests(TestCase):
         ResolvableObject.objects.create(**args)
         self.assertRaises(IntegrityError, ResolvableObject.objects.create, **args)
 
+    def test_data_hash_is_kept_up_to_date(self):
+        dataset = Dataset.objects.create(id='dataset_id', data={'label': 'My dataset'})
+        ResolvableObject.objects.create(id='a', data={'id': 'a'}, dataset=dataset)
+        first_hash = ResolvableObject.objects.get(id='a').data_hash
+        self.assertEqual(len(first_hash), 32)
+        ResolvableObject.objects.filter(id='a').update(data={'id': 'a', 'type': 'occurrence'})
+        self.assertNotEqual(ResolvableObject.objects.get(id='a').data_hash, first_hash)
+        ResolvableObject.objects.filter(id='a').update(data={'id': 'a'})
+        self.assertEqual(ResolvableObject.objects.get(id='a').data_hash, first_hash)
+
+    def test_objects_are_spread_over_the_partitions(self):
+        dataset = Dataset.objects.create(id='dataset_id', data={'label': 'My dataset'})
+        ResolvableObject.objects.bulk_create(ResolvableObject(id=f'id{i}', data={}, dataset=dataset) for i in range(200))
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT tableoid::regclass::text, count(*) FROM website_resolvableobject GROUP BY 1')
+            counts = dict(cursor.fetchall())
+        self.assertEqual(len(counts), 16)
+        self.assertEqual(sum(counts.values()), 200)
+        self.assertEqual(ResolvableObject.objects.get(id='id150').id, 'id150')
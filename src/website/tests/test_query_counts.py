@@ -0,0 +1,40 @@
+from website.models import ResolvableObject, Dataset
+from populator.models import History
+from populator.management.commands import _statistics
+from rest_framework.test import APITestCase
+from rest_framework.reverse import reverse
+
+# The number of queries each endpoint may make, whatever the page size. A page which costs a query per object fails here.
+# Each includes the one for the validators of conditional requests (website/conditional.py)
+BUDGETS = [
+    ('resolvableobject-list', [], '?limit={}', 2),
+    ('resolvableobject-list', [], '?limit={}&_add_counts=true', 3),
+    ('resolvableobject-list', [], '?limit={}&_add_counts=true&dataset_id=d0', 4),  # The filter checks the dataset exists
+    ('resolvableobject-list', [], '?limit={}&_add_counts=true&basisofrecord=PreservedSpecimen', 3),
+    ('resolvableobject-list', [], '?cursor=&limit={}', 2),
+    ('resolvableobject-list', [], '?cursor=&limit={}&_add_counts=true', 3),
+    ('resolvableobject-detail', ['o1'], '', 2),
+    ('history-list', [], '?resolvable_object=o1', 3),
+    ('history-list', [], '', 3),
+    ('dataset-list', [], '?limit={}', 3),
+    ('dataset-detail', ['d0'], '', 2),
+    ('statistics-list', [], '?dataset_id=d0', 1),
+]
+
+
+class QueryBudgetTests(APITestCase):
+    def setUp(self):
+        datasets = [Dataset.objects.create(id=f'd{i}', data={'label': f'Dataset {i}', 'type': 'occurrence'}) for i in range(5)]
+        for i in range(20):
+            obj = ResolvableObject.objects.create(id=f'o{i}', dataset=datasets[i % 5], type='occurrence',
+                                                  data={'id': f'o{i}', 'basisofrecord': 'PreservedSpecimen'})
+            History.objects.create(resolvable_object=obj, changed_data={'id': f'o{i}'})
+        _statistics.recount()
+
+    def test_endpoints_stay_within_their_query_budget(self):
+        for name, args, query, budget in BUDGETS:
+            for page_size in [1, 5, 20]:
+                url = reverse(name, args) + query.format(page_size)
+                with self.subTest(url=url), self.assertNumQueries(budget):
+                    response = self.client.get(url, HTTP_ACCEPT='application/json')
+                    self.assertEqual(response.status_code, 200)
@@ -0,0 +1,113 @@
+from website.models import ResolvableObject, Dataset
+from website import result_cache
+from populator.models import Statistic
+from django.http import QueryDict
+from django.test import SimpleTestCase, override_settings
+from rest_framework.test import APITestCase
+from rest_framework.reverse import reverse
+from unittest import mock
+import json
+import os
+import tempfile
+import time
+
+
+class ResultCacheViewTests(APITestCase):
+    def setUp(self):
+        result_cache.clear()
+        self.dataset = Dataset.objects.create(id='d', data={'label': 'My dataset', 'type': 'occurrence'})
+        for item in 'abc':
+            ResolvableObject.objects.create(id=item, dataset=self.dataset, data={'id': item, 'scientificname': 'Galium'})
+        Statistic.objects.set_generation()
+        self.url = reverse('resolvableobject-list') + '?scientificname=Galium&limit=2'
+
+    def _get(self, url):
+        return self.client.get(url, HTTP_ACCEPT='application/ld+json')
+
+    def test_repeated_query_is_answered_from_the_cache(self):
+        response = self._get(self.url)
+        with self.assertNumQueries(1):  # The generation
+            cached = self._get(reverse('resolvableobject-list') + '?limit=2&scientificname=Galium')
+        self.assertEqual(cached.content, response.content)
+        self.assertEqual(cached['Content-Type'], response['Content-Type'])
+        self.assertEqual(cached['ETag'], response['ETag'])
+
+    def test_pages_and_formats_are_cached_apart(self):
+        first = self._get(self.url)
+        second = self._get(self.url + '&offset=2')
+        self.assertNotEqual(first.content, second.content)
+        as_json = self.client.get(self.url, HTTP_ACCEPT='application/json')
+        self.assertEqual(as_json['Content-Type'], 'application/json')
+
+    def test_new_generation_is_not_answered_from_the_cache(self):
+        self._get(self.url)
+        ResolvableObject.objects.create(id='0', dataset=self.dataset, data={'id': '0', 'scientificname': 'Galium'})
+        Statistic.objects.filter(name='generation').update(value=Statistic.objects.get_generation() + 1)
+        results = json.loads(self._get(self.url).content)['results']
+        self.assertEqual(results[0]['owl:sameas'], '0')
+
+    def test_nothing_is_cached_before_the_first_populate(self):
+        Statistic.objects.filter(name='generation').delete()
+        self._get(self.url)
+        with self.assertNumQueries(2):
+            self._get(self.url)
+
+    @override_settings(RESULT_CACHE_BACKEND='none')
+    def test_cache_can_be_turned_off(self):
+        self._get(self.url)
+        with self.assertNumQueries(2):
+            self._get(self.url)
+
+
+class ResultCacheBackendTests(SimpleTestCase):
+    def test_memory_cache_evicts_least_recently_used(self):
+        cache = result_cache.MemoryCache(2)
+        cache.set('a', (b'a', 'text/plain'))
+        cache.set('b', (b'b', 'text/plain'))
+        cache.get('a')
+        cache.set('c', (b'c', 'text/plain'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), (b'a', 'text/plain'))
+
+    def test_file_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = result_cache.FileCache(directory, 2 ** 20)
+            self.assertIsNone(cache.get('abcdef'))
+            cache.set('abcdef', (b'{"results": []}\n', 'application/ld+json'))
+            self.assertEqual(cache.get('abcdef'), (b'{"results": []}\n', 'application/ld+json'))
+            cache.clear()
+            self.assertIsNone(cache.get('abcdef'))
+
+    def test_file_cache_evicts_least_recently_used_over_its_size(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = result_cache.FileCache(directory, 30)  # Each entry takes 12 bytes
+            cache.set('aa', (b'a', 'text/plain'))
+            cache.set('bb', (b'b', 'text/plain'))
+            os.utime(cache.path('aa'), (time.time() - 100,) * 2)
+            os.utime(cache.path('bb'), (time.time() - 50,) * 2)
+            cache.get('aa')
+            cache.set('cc', (b'c', 'text/plain'))
+            self.assertIsNone(cache.get('bb'))
+            self.assertEqual(cache.get('aa'), (b'a', 'text/plain'))
+            self.assertEqual(cache.get('cc'), (b'c', 'text/plain'))
+
+    def test_file_cache_skips_entries_when_the_directory_is_cleared_meanwhile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = result_cache.FileCache(directory, 2 ** 20)
+            with mock.patch.object(result_cache.os, 'replace', side_effect=FileNotFoundError):
+                cache.set('abcdef', (b'content', 'application/json'))
+            self.assertIsNone(cache.get('abcdef'))
+            self.assertEqual([entry.name for entry in os.scandir(directory)], ['ab'])  # No temporary file is left
+            cache.clear()
+            cache.set('abcdef', (b'content', 'application/json'))
+            self.assertEqual(cache.get('abcdef'), (b'content', 'application/json'))
+
+    def test_django_cache(self):
+        cache = result_cache.DjangoCache('default')
+        cache.set('abcdef', (b'content', 'application/json'))
+        self.assertEqual(cache.get('abcdef'), (b'content', 'application/json'))
+
+    def test_key_ignores_parameter_order(self):
+        key = result_cache.make_key(1, '/', QueryDict('a=1&b=2'), 'application/json')
+        self.assertEqual(key, result_cache.make_key(1, '/', QueryDict('b=2&a=1'), 'application/json'))
+        self.assertNotEqual(key, result_cache.make_key(2, '/', QueryDict('b=2&a=1'), 'application/json'))
@@ -1,5 +1,6 @@
 from website.models import ResolvableObject, Dataset
-from populator.models import Statistic, History
+from populator.models import Statistic, History, RecordCount
+from populator.management.commands import _statistics
 import json
 from rest_framework.test import APITestCase
 from rest_framework.reverse import reverse
@@ -111,6 +112,46 @@ class ResolverViewTests(APITestCase):
         results = json.loads(response.content.decode('utf-8').lower())
         self.assertEqual(results['count'], 3)
 
+    def test_count_comes_from_record_counts(self):
+        ResolvableObject.objects.create(id='a', data={'basisofrecord': 'PreservedSpecimen'}, dataset=self.dataset)
+        RecordCount.objects.create(dataset_id='a', type='occurrence', basisofrecord='PreservedSpecimen', deleted=False, count=7)
+        RecordCount.objects.create(dataset_id='a', type='occurrence', basisofrecord='HumanObservation', deleted=False, count=2)
+        url = reverse('resolvableobject-list') + '?limit=1&_add_counts=true'
+        response = self.client.get(url + '&basisofrecord=PreservedSpecimen&dataset_id=a', HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json()['count'], 7)
+        response = self.client.get(url, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json()['count'], 9)
+
+    def test_cursor_pagination_walks_all_results_in_id_order(self):
+        for item in 'ecadb':
+            ResolvableObject.objects.create(id=item, data={'id': item, 'scientificname': 'Galium'}, dataset=self.dataset)
+        ResolvableObject.objects.create(id='f', data={'id': 'f', 'scientificname': 'Eudyptes'}, dataset=self.dataset)
+        url, ids = reverse('resolvableobject-list') + '?cursor=&limit=2&scientificname=Galium', []
+        while url:
+            results = self.client.get(url, HTTP_ACCEPT='application/ld+json').json()
+            self.assertNotIn('count', results)
+            ids += [result['owl:sameas'] for result in results['results']]
+            url = results['next']
+        self.assertEqual(ids, ['a', 'b', 'c', 'd', 'e'])
+
+    def test_cursor_pages_cost_the_same_at_any_depth(self):
+        for item in 'abcdefgh':
+            ResolvableObject.objects.create(id=item, data={'id': item}, dataset=self.dataset)
+        url = reverse('resolvableobject-list') + '?cursor=&limit=2'
+        while url:
+            with self.assertNumQueries(2):  # The generation and the page
+                url = self.client.get(url, HTTP_ACCEPT='application/json').json()['next']
+
+    def test_cursor_pagination_with_count(self):
+        for item in 'abc':
+            ResolvableObject.objects.create(id=item, data={'id': item, 'scientificname': 'Galium'}, dataset=self.dataset)
+        response = self.client.get(reverse('resolvableobject-list') + '?cursor=&limit=1&scientificname=Galium&_add_counts=true', HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json()['count'], 3)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('resolvableobject-list') + '?cursor=nonsense', HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 404)
+
     def test_filters_on_scientific_name(self):
         id = 'urn:uuid:5c0884ce-608c-4716-ba0e-cb389dca5580'
         ResolvableObject.objects.create(id=id, dataset=self.dataset, data={'id': id, 'basisOfRecord': 'preservedspecimen', 'scientificname': 'Galium odoratum'})
@@ -171,6 +212,7 @@ class ResolverViewTests(APITestCase):
         ResolvableObject.objects.create(id=id, dataset=self.dataset, data={'id': id, 'basisOfRecord': 'preservedspecimen', 'scientificname': 'Eudyptes moseleyi'})
         id = 'urn:uuid:7c0884ce-608c-4716-ba0e-cb389dca5582'
         ResolvableObject.objects.create(id=id, dataset=self.dataset, data={'id': id, 'basisOfRecord': 'preservedspecimen', 'scientificname': 'Eudyptes moseleyi'})
+        _statistics.recount()  # Counts are kept by the merge, without filters they are not worked out on the fly
 
         url = reverse('resolvableobject-list')
         response = self.client.get(url + '?_add_counts=true', HTTP_ACCEPT='application/ld+json')
@@ -222,6 +264,24 @@ class ResolverViewTests(APITestCase):
         response = self.client.get(url, HTTP_ACCEPT='application/ld+json')
         self.assertTrue(response.status_code == 200)
 
+    def test_resolves_prefixed_upper_case_id_to_normalized_id(self):
+        ResolvableObject.objects.create(id='5c0884ce-608c-4716-ba0e-cb389dca5580', dataset=self.dataset, data={'id': 'x'})
+        url = reverse('resolvableobject-detail', ['urn:uuid:5C0884CE-608C-4716-BA0E-CB389DCA5580'])
+        response = self.client.get(url, HTTP_ACCEPT='application/ld+json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['owl:sameas'], 'x')
+
+    def test_resolves_id_stored_with_upper_case(self):
+        ResolvableObject.objects.create(id='O-V-ABC', dataset=self.dataset, data={'id': 'x'})
+        response = self.client.get(reverse('resolvableobject-detail', ['O-V-ABC']), HTTP_ACCEPT='application/ld+json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_resolves_object_and_its_dataset_in_one_query(self):
+        ResolvableObject.objects.create(id='abc', dataset=self.dataset, data={'id': 'abc'})
+        with self.assertNumQueries(2):  # After the one for the validators of conditional requests
+            response = self.client.get(reverse('resolvableobject-detail', ['urn:uuid:ABC']), HTTP_ACCEPT='application/ld+json')
+        self.assertEqual(response.status_code, 200)
+
     def _simple_request_occurrence(self, http_accept):
         id = 'urn:uuid:5c0884ce-608c-4716-ba0e-cb389dca5580'
         ResolvableObject.objects.create(id=id, dataset=self.dataset, data={'id': id, 'basisOfRecord': 'preservedspecimen'})
@@ -235,3 +295,14 @@ class ResolverViewTests(APITestCase):
         url = reverse('resolvableobject-detail', [id])
         response = self.client.get(url, HTTP_ACCEPT=http_accept)
         return response.content.decode('utf-8').lower()
+
+
+class StatisticsViewTests(APITestCase):
+    def test_lists_record_counts(self):
+        RecordCount.objects.create(dataset_id='a', type='occurrence', basisofrecord='PreservedSpecimen', deleted=False, count=7)
+        RecordCount.objects.create(dataset_id='b', type='occurrence', basisofrecord='PreservedSpecimen', deleted=True, count=2)
+        response = self.client.get(reverse('statistics-list'), HTTP_ACCEPT='application/json')
+        self.assertEqual(response.json()['total'], 9)
+        self.assertEqual(response.json()['datasets']['b'], {'active': 0, 'deleted': 2})
+        response = self.client.get(reverse('statistics-list') + '?dataset_id=a', HTTP_ACCEPT='application/json')
+        self.assertEqual((response.json()['active'], response.json()['deleted']), (7, 0))
@@ -1,17 +1,24 @@
 from .models import ResolvableObject, Dataset
-from populator.models import History
-from rest_framework import viewsets, renderers, pagination
+from populator.models import History, RecordCount, Statistic
+from populator.identifiers import normalize_id
+from rest_framework import viewsets, renderers, pagination, mixins
+from rest_framework.response import Response
+from rest_framework.decorators import action
 from .serializers import ResolvableObjectSerializer, DatasetSerializer, HistorySerializer
-from .renderers import RDFRenderer, JSONLDRenderer
-from .paginators import CustomPagination, CustomCountPagination
+from .renderers import RDFRenderer, JSONLDRenderer, NDJSONRenderer, JSONLDExportRenderer
+from .paginators import CustomPagination, CustomCountPagination, IdCursorPagination
+from .conditional import ConditionalMixin
+from . import result_cache, export
 from django_filters.rest_framework import DjangoFilterBackend
 from collections import defaultdict
 import json
-from django.shortcuts import get_object_or_404
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse
+from django.db.models import Subquery
+from django.utils.cache import patch_vary_headers
+import hashlib
 
 
-class HistoryViewSet(viewsets.ReadOnlyModelViewSet):
+class HistoryViewSet(ConditionalMixin, viewsets.ReadOnlyModelViewSet):
     """
     Search through past changes made to GBIF Norway resolver records.
     Every time a new ingestion of data is made, the provenance is stored and is accessible here.
@@ -41,13 +48,15 @@ class HistoryViewSet(viewsets.ReadOnlyModelViewSet):
                 continue
         if 'resolvable_object' in query_params:
             query['resolvable_object_id'] = query_params['resolvable_object']
-        return History.objects.filter(**query)
+        return History.objects.filter(**query).order_by('id')
 
 
-class ResolvableObjectViewSet(viewsets.ReadOnlyModelViewSet):
+class ResolvableObjectViewSet(ConditionalMixin, viewsets.ReadOnlyModelViewSet):
     """
     GBIF Norway's resolver provides data published to gbif.org by Norwegian publishers. Query by appending e.g.
-    `?scientificname=Galium+odoratum` to filter on scientific name. Add '_add_counts=true' to return the result count (not performant).
+    `?scientificname=Galium+odoratum` to filter on scientific name. Add '_add_counts=true' to return the result count, with
+    count_exact false if it is an estimate.
+    To walk through all the results, e.g. of a dataset, start with `?cursor=&limit=1000` and follow the next links.
     """
     renderer_classes = (renderers.JSONRenderer, renderers.BrowsableAPIRenderer, JSONLDRenderer, RDFRenderer)
     queryset = ResolvableObject.objects.all()
@@ -59,18 +68,51 @@ class ResolvableObjectViewSet(viewsets.ReadOnlyModelViewSet):
 
     def get_queryset(self):
         query_params = self.request.query_params
-        non_data_fields =['offset', 'limit', 'format', 'type', '_add_counts', 'dataset_id', 'deleted_date', 'deleted_date__gte', 'deleted_date__lte', 'type']
+        non_data_fields =['offset', 'limit', 'cursor', 'format', 'type', '_add_counts', 'dataset_id', 'deleted_date', 'deleted_date__gte', 'deleted_date__lte', 'type']
         data_args = {key: item for key, item in query_params.items() if key not in non_data_fields }
         args = { 'data__contains': data_args }
 
-        if '_add_counts' in query_params and query_params['_add_counts'] == 'true':
+        if 'cursor' in query_params:
+            self.pagination_class = IdCursorPagination
+        elif '_add_counts' in query_params and query_params['_add_counts'] == 'true':
             self.pagination_class = CustomCountPagination
-        return ResolvableObject.objects.filter(**args)
+        # Ordered, so pages are stable: the table is partitioned and an unordered scan goes through it partition by partition.
+        # The serializer nests the dataset, which is joined rather than fetched for each object
+        return ResolvableObject.objects.select_related('dataset').filter(**args).order_by('id')
 
-    def get_object(self):
-        queryset = self.filter_queryset(self.get_queryset())
+    def list(self, request, *args, **kwargs):
+        return self.conditional(self.cached_list, request, *args, **kwargs)
+
+    def cached_list(self, request, *args, **kwargs):
+        def respond():
+            return self.finalize_response(request, mixins.ListModelMixin.list(self, request, *args, **kwargs), *args, **kwargs)
+
+        # Pages are cached for a generation, so not before the first populate, and not as browsable API pages, which
+        # differ by user
+        if not self.generation or request.accepted_renderer.format == 'api':
+            return respond()
+        key = result_cache.make_key(self.generation, request.path, request.query_params, request.accepted_renderer.media_type)
+        return result_cache.cached_response(key, respond)
+
+    def get_validators(self, request, *args, **kwargs):
+        if self.action != 'retrieve':
+            return super().get_validators(request, *args, **kwargs)
+        # A record keeps its ETag over populate runs which leave it and its dataset as they were. It is found from the
+        # hash of its data without loading the data itself, along with the generation in the same query
+        ids = resolution_ids(self.kwargs[self.lookup_url_kwarg or self.lookup_field])
+        generation = Statistic.objects.filter(name='generation').values('value')
+        rows = (ResolvableObject.objects.filter(id__in=ids).annotate(generation=Subquery(generation))
+                .values_list('id', 'data_hash', 'type', 'deleted_date', 'dataset__data', 'dataset__deleted_date', 'generation'))
+        rows = {row[0]: row for row in rows}
+        row = next((rows[id_] for id_ in ids if id_ in rows), None)
+        if row is None:
+            return None, None
+        id_, data_hash, type_, deleted_date, dataset_data, dataset_deleted_date, generation = row
+        dataset = hashlib.md5(json.dumps(dataset_data, sort_keys=True).encode()).hexdigest()
+        # data_hash is set by a trigger, without it the record may have changed in any run
+        return f'{id_}:{data_hash or generation}:{type_}:{deleted_date}:{dataset}:{dataset_deleted_date}', generation
 
-        # Perform the lookup filtering.
+    def get_object(self):
         lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
 
         assert lookup_url_kwarg in self.kwargs, (
@@ -80,27 +122,29 @@ class ResolvableObjectViewSet(viewsets.ReadOnlyModelViewSet):
                 (self.__class__.__name__, lookup_url_kwarg)
         )
 
-        # Remove urn:uuid:prefix
-        filter_kwargs = {self.lookup_field: self.kwargs[lookup_url_kwarg].replace('urn:uuid:', '')}
-        # obj = get_object_or_404(queryset, **filter_kwargs) - this takes too long and hangs as of 2024-04-21
-        try:
-            print(f'getting object with {filter_kwargs} with {filter_kwargs["id__iexact"].lower}')
-            obj = ResolvableObject.objects.get(id=filter_kwargs['id__iexact'].lower())
-            print(f'successfully got object {obj.id} with lowercase lookup')
-        except ResolvableObject.DoesNotExist:
-            try:
-                print(f'getting object with {filter_kwargs}')
-                obj = ResolvableObject.objects.get(id=filter_kwargs['id__iexact'])
-                print(f'successfully got object {obj.id}')
-            except ResolvableObject.DoesNotExist:
-                raise Http404("Object does not exist")
+        # get_object_or_404 with id__iexact takes too long and hangs as of 2024-04-21, so the id is looked up as it is
+        # stored instead, with the dataset joined in the same query
+        ids = resolution_ids(self.kwargs[lookup_url_kwarg])
+        objects = {obj.id: obj for obj in ResolvableObject.objects.select_related('dataset').filter(id__in=ids)}
+        obj = next((objects[id_] for id_ in ids if id_ in objects), None)
+        if obj is None:
+            raise Http404("Object does not exist")
 
         # May raise a permission denied
         self.check_object_permissions(self.request, obj)
 
         return obj
 
-class DatasetViewSet(viewsets.ReadOnlyModelViewSet):
+
+def resolution_ids(value):
+    """
+    The ids a record requested as value can be stored under, best match first: normalized the way ingestion normalizes
+    ids, and for records imported before ids were normalized, only without the urn:uuid: prefix
+    """
+    return list(dict.fromkeys([normalize_id(value), value.replace('urn:uuid:', '')]))
+
+
+class DatasetViewSet(ConditionalMixin, viewsets.ReadOnlyModelViewSet):
     """
     Datasets endpoint
     """
@@ -108,3 +152,36 @@ class DatasetViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = Dataset.objects.all()
     serializer_class = DatasetSerializer
     pagination_class = pagination.LimitOffsetPagination
+
+    @action(detail=True, renderer_classes=[NDJSONRenderer, JSONLDExportRenderer])
+    def export(self, request, pk=None):
+        """
+        All the records of the dataset in one response, as newline delimited JSON (`?format=ndjson`, the default) or as
+        a JSON-LD array (`?format=jsonld`), gzipped for clients which accept it
+        """
+        dataset = self.get_object()
+        renderer = request.accepted_renderer
+        lines = export.jsonld(dataset) if renderer.format == 'jsonld' else export.ndjson(dataset)
+        content = export.chunked(lines)
+        gzip = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+        response = StreamingHttpResponse(export.gzipped(content) if gzip else content, content_type=renderer.media_type)
+        if gzip:
+            response['Content-Encoding'] = 'gzip'
+        patch_vary_headers(response, ['Accept-Encoding'])
+        response['Content-Disposition'] = f'attachment; filename="{dataset.id}.{renderer.format}"'
+        return response
+
+
+class StatisticsViewSet(viewsets.GenericViewSet):
+    """
+    Numbers of active and deleted records in the resolver, in total and by dataset, type and basis of record. Kept up
+    to date by every ingestion. Narrow them down with e.g. `?dataset_id=[uuid]`, `?type=occurrence` or `?basisofrecord=PreservedSpecimen`.
+    """
+    renderer_classes = (renderers.JSONRenderer, renderers.BrowsableAPIRenderer)
+    queryset = RecordCount.objects.all()
+    pagination_class = None
+    filter_backends = []
+
+    def list(self, request):
+        filters = {key: item for key, item in request.query_params.items() if key in ['dataset_id', 'type', 'basisofrecord']}
+        return Response(self.get_queryset().filter(**filters).summary())